@@ -1,21 +1,59 @@
 #!/usr/bin/python
 
 import os
-import errno
 import sqlite3
 import sys
-from time import time
-import _pickle as cPickle
-from _pickle import loads, dumps, PickleBuffer
+import threading
+from functools import wraps
+from time import time, perf_counter
+from _pickle import loads
 
 import logging
 import json
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, timedelta
+
+from bloom import BloomFilter
+from cache_backends import CacheBackend, STATS_GRANULARITIES, items_with_timeouts, nest_stats
+from codec import encode_value, decode_value
+from l1cache import L1Cache
+from metrics import SQLITE_SECONDS
 
 logger = logging.getLogger(__name__)
 
 
-class SqliteCache:
+def fts_query(search):
+    """ Turn free text into an FTS5 query matching every word
+
+        Words are quoted so punctuation in titles and keys (imdb:tt0111161)
+        is not read as query syntax, a trailing * keeps its prefix meaning.
+    """
+
+    terms = []
+    for word in search.split():
+        prefix = word.endswith('*') and len(word) > 1
+        word = word.rstrip('*').replace('"', '""')
+        if word:
+            terms.append(f'"{word}"*' if prefix else f'"{word}"')
+    return ' '.join(terms) or '""'
+
+
+def _timed(method):
+    """ Record the method's latency in pg_sqlite_operation_seconds """
+
+    operation = method.__name__
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        started = perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            SQLITE_SECONDS.observe(perf_counter() - started, operation)
+    return wrapper
+
+
+class SqliteCache(CacheBackend):
     """
         SqliteCache
 
@@ -37,12 +75,22 @@ class SqliteCache:
     _create_index = 'CREATE INDEX IF NOT EXISTS keyname_index ON entries (key)'
     _create_index_reviews = 'CREATE INDEX IF NOT EXISTS keyname_index ON reviews (key)'
 
-    _get_sql = 'SELECT val, exp FROM entries WHERE key = ?'
+    _get_sql = 'SELECT val, exp FROM entries WHERE key = ? AND (exp = 0 OR exp > ?)'
     _get_sql_exp = 'SELECT exp FROM entries WHERE key = ?'
+    _get_stale_sql = 'SELECT val FROM entries WHERE key = ? AND exp > 0 AND exp <= ? AND exp > ?'
     _del_sql = 'DELETE FROM entries WHERE key = ?'
-    _set_sql = 'REPLACE INTO entries (key, val, exp) VALUES (?, ?, ?)'
-    _add_sql = 'INSERT INTO entries (key, val, exp) VALUES (?, ?, ?)'
+    # rewriting a key keeps its hit count so refreshed entries aren't evicted first under lfu
+    _set_sql = ('INSERT INTO entries (key, val, exp, atime) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET val = excluded.val, exp = excluded.exp, atime = excluded.atime')
+    _add_sql = 'INSERT INTO entries (key, val, exp, atime) VALUES (?, ?, ?, ?)'
+    _touch_sql = 'UPDATE entries SET atime = ?, hits = hits + ? WHERE key = ?'
     _clear_sql = "DELETE FROM cache"  # Corrected SQL statement
+    _get_many_sql = 'SELECT key, val, exp FROM entries WHERE key IN ({}) AND (exp = 0 OR exp > ?)'
+    _negative_many_sql = 'SELECT key FROM negative_cache WHERE key IN ({}) AND exp > ?'
+    _del_many_sql = 'DELETE FROM entries WHERE key IN ({})'
+
+    # stay well below SQLITE_MAX_VARIABLE_NUMBER for IN (...) lists
+    _batch_size = 500
 
     _create_sql_stats = '''
     CREATE TABLE IF NOT EXISTS stats (
@@ -68,35 +116,234 @@ class SqliteCache:
     )
     '''
 
+    # connection tuning applied once when a pooled connection is opened
+    _statement_cache_size = 128
+    _mmap_size = 64 * 1024 * 1024  # 64MB
+
+    # tables holding rows with an expiry timestamp, swept in the background,
+    # and whether expired rows are kept around for stale serving
+    _expiring_tables = (('entries', 'exp', True), ('omdb_cache', 'expires', False),
+                        ('negative_cache', 'exp', False))
+    _sweep_batch_size = 200
+    _sweep_pause = 0.05  # seconds between batches so requests get the write lock
+    _vacuum_pages = 256
+
+    # stats_series retention in days for rows that have been rolled up, months are kept forever
+    _stats_retention = {'minute': 2, 'hour': 30, 'day': 730}
+    _rollup_delay = 5 * 60  # seconds a bucket stays open for late stats flushes
+
+    # tables that can be exported and imported, with their value and expiry columns
+    _snapshot_tables = {'entries': ('val', 'exp'), 'omdb_cache': ('value', 'expires')}
+
+    # size cap, entries are evicted in batches down to _evict_target of the budget
+    _eviction_orders = {'lru': 'atime', 'lfu': 'hits, atime'}
+    _evict_batch_size = 200
+    _evict_target = 0.9
+    _evict_check_every = 100  # writes between budget checks
+
+    # log rows deleted per retention batch
+    _log_trim_batch_size = 1000
+
     # other properties
     connection = None
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, l1_max_bytes=None, stale_grace=None, max_entries=None, max_bytes=None,
+                 eviction_policy=None, log_retention_days=None, log_max_rows=None):
         self.db_path = db_path
+        # Log retention applied by trim_logs, 0 disables either limit
+        if log_retention_days is None:
+            log_retention_days = float(os.environ.get('LOG_RETENTION_DAYS', 30))
+        if log_max_rows is None:
+            log_max_rows = int(os.environ.get('LOG_MAX_ROWS', 100000))
+        self.log_retention_days = log_retention_days
+        self.log_max_rows = log_max_rows
+        # Size cap of the entries table, 0 means unlimited
+        if max_entries is None:
+            max_entries = int(os.environ.get('CACHE_MAX_ENTRIES', 0))
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('CACHE_MAX_BYTES', 0))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.eviction_policy = (eviction_policy or os.environ.get('CACHE_EVICTION_POLICY', 'lru')).lower()
+        if self.eviction_policy not in self._eviction_orders:
+            raise ValueError(f"Unknown eviction policy {self.eviction_policy}, use lru or lfu")
+        # Reads are recorded in memory and written to atime/hits in batches
+        self._touches = {}
+        self._touches_lock = threading.Lock()
+        self._touch_batch = int(os.environ.get('CACHE_TOUCH_BATCH', 100))
+        self._writes_since_check = 0
+        self._evict_lock = threading.Lock()
+        self._evict_due = False
+        self.last_eviction = None
+        # One background worker flushes touches and evicts, woken by _wake_worker
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._worker_wanted = threading.Event()
+        # How long past expiry an entry may still be served as stale
+        if stale_grace is None:
+            stale_grace = float(os.environ.get('CACHE_STALE_GRACE', 7 * 24 * 60 * 60))
+        self.stale_grace = stale_grace
+        # In-memory tier in front of the entries table, 0 disables it
+        if l1_max_bytes is None:
+            l1_max_bytes = int(os.environ.get('CACHE_L1_MAX_BYTES', 32 * 1024 * 1024))
+        self.l1 = L1Cache(l1_max_bytes) if l1_max_bytes > 0 else None
+        # One connection per thread, reused for every call made on that thread
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self.connections_opened = 0
+        self._legacy_pending = False
+        self._sweeper = None
+        self._sweeper_stop = threading.Event()
+        self.last_sweep = None
+        self._stats_migration_pending = False
         self._create_tables()
+        if self._stats_migration_pending:
+            self._migrate_stats()
+        self._negative_filter = None
+        self._negative_lock = threading.Lock()
+        # keys added while a rebuild is reading the table, None when no rebuild runs
+        self._negative_added = None
+        self._negative_filter_full = False
+        self._rebuild_negative_filter()
+        if self._legacy_pending:
+            threading.Thread(target=self.migrate_legacy_entries, name='cache-migration', daemon=True).start()
 
     def _create_tables(self):
         with self._get_conn() as conn:
+            # Tables from before the numeric expiry column are renamed and
+            # migrated in the background by migrate_legacy_entries
+            columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(entries)")}
+            if columns.get('exp', '').upper() == 'BLOB':
+                conn.execute("ALTER TABLE entries RENAME TO entries_legacy")
+            self._legacy_pending = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'entries_legacy'").fetchone() is not None
+            if self._legacy_pending:
+                # old set() kept the caller's casing, lookups are lowercased
+                conn.execute('CREATE INDEX IF NOT EXISTS entries_legacy_nocase_index ON entries_legacy (key COLLATE NOCASE)')
+
             # Create entries table if it doesn't exist
             conn.execute('''CREATE TABLE IF NOT EXISTS entries
-                            (key TEXT PRIMARY KEY, val BLOB, exp BLOB)''')
+                            (key TEXT PRIMARY KEY, val BLOB, exp REAL, atime REAL, hits INTEGER NOT NULL DEFAULT 0)''')
+            # access tracking columns added after v2, rows from before have a NULL atime and are evicted first
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(entries)")}
+            if 'atime' not in columns:
+                conn.execute('ALTER TABLE entries ADD COLUMN atime REAL')
+            if 'hits' not in columns:
+                conn.execute('ALTER TABLE entries ADD COLUMN hits INTEGER NOT NULL DEFAULT 0')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_exp_index ON entries (exp)')
+            if self.eviction_policy == 'lfu':
+                conn.execute('CREATE INDEX IF NOT EXISTS entries_hits_index ON entries (hits, atime)')
+            else:
+                conn.execute('CREATE INDEX IF NOT EXISTS entries_atime_index ON entries (atime)')
             
             # Create logs table if it doesn't exist
             conn.execute('''CREATE TABLE IF NOT EXISTS logs
                             (id INTEGER PRIMARY KEY, timestamp TEXT, level TEXT, message TEXT)''')
+            # the rowid is part of every index entry, so this also serves ORDER BY timestamp, id
+            conn.execute('CREATE INDEX IF NOT EXISTS logs_timestamp_index ON logs (timestamp)')
+            conn.execute('CREATE INDEX IF NOT EXISTS logs_level_index ON logs (level, timestamp)')
+            self.log_search = self._create_log_search(conn)
             
             # Create stats table if it doesn't exist
             conn.execute('''CREATE TABLE IF NOT EXISTS stats
                             (key TEXT PRIMARY KEY, value TEXT)''')
+
+            # Create stats_series table (counts per time bucket) if it doesn't exist,
+            # the grouped stats rows from before it are moved over by _migrate_stats
+            self._stats_migration_pending = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_series'").fetchone() is None
+            conn.execute('''CREATE TABLE IF NOT EXISTS stats_series
+                            (granularity TEXT, dimension TEXT, bucket_start TEXT, value TEXT, count INTEGER NOT NULL,
+                             PRIMARY KEY (granularity, dimension, bucket_start, value)) WITHOUT ROWID''')
+            # first bucket of each granularity that still has to be rolled up from the finer one
+            conn.execute('''CREATE TABLE IF NOT EXISTS stats_rollups
+                            (granularity TEXT PRIMARY KEY, rolled_until TEXT)''')
             
             # Create omdb_cache table if it doesn't exist
             conn.execute('''CREATE TABLE IF NOT EXISTS omdb_cache
                             (key TEXT PRIMARY KEY, value BLOB, expires REAL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS omdb_cache_expires_index ON omdb_cache (expires)')
+
+            # Create negative_cache table (keys known to have no data) if it doesn't exist
+            conn.execute('''CREATE TABLE IF NOT EXISTS negative_cache
+                            (key TEXT PRIMARY KEY, exp REAL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS negative_cache_exp_index ON negative_cache (exp)')
+
+            # Create aliases table (alternate key -> canonical key) if it doesn't exist
+            conn.execute('''CREATE TABLE IF NOT EXISTS aliases
+                            (alias TEXT PRIMARY KEY, key TEXT)''')
+
+    def _create_log_search(self, conn):
+        """ Full-text index over logs.message kept in sync by triggers
+
+            Returns False when this sqlite is built without FTS5, searches
+            then fall back to LIKE.
+        """
+
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'logs_fts'").fetchone() is not None
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS logs_fts USING fts5(message, content='logs', content_rowid='id')")
+        except sqlite3.OperationalError as e:
+            logger.warning(f"FTS5 is not available, log search falls back to LIKE: {e}")
+            return False
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS logs_fts_insert AFTER INSERT ON logs BEGIN
+                            INSERT INTO logs_fts (rowid, message) VALUES (new.id, new.message);
+                        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS logs_fts_delete AFTER DELETE ON logs BEGIN
+                            INSERT INTO logs_fts (logs_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS logs_fts_update AFTER UPDATE ON logs BEGIN
+                            INSERT INTO logs_fts (logs_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                            INSERT INTO logs_fts (rowid, message) VALUES (new.id, new.message);
+                        END''')
+        if not exists:
+            # index the rows logged before the search existed
+            conn.execute("INSERT INTO logs_fts (logs_fts) VALUES ('rebuild')")
+        return True
 
     def _get_conn(self):
-        conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+        """ Return this thread's pooled connection, opening it on first use """
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open_conn()
+            self._local.conn = conn
         return conn
 
+    def _open_conn(self):
+        conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False,
+                               cached_statements=self._statement_cache_size)
+        # only takes effect on new database files, see vacuum()
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # WAL lets readers proceed while a writer holds the lock
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA mmap_size={self._mmap_size}')
+        with self._connections_lock:
+            self._connections.append(conn)
+            self.connections_opened += 1
+        return conn
+
+    def close(self):
+        """ Close every pooled connection """
+
+        self.stop_sweeper()
+        self._stop_worker()
+        try:
+            self.flush_touches()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not record cache access times: {e}")
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
     def _create_table(self):
         create_table_sql = '''
         CREATE TABLE IF NOT EXISTS cache (
@@ -108,6 +355,7 @@ class SqliteCache:
         self.conn.execute(create_table_sql)
         self.conn.commit()
 
+    @_timed
     def get(self, key):
 
         """ Retreive a value from the Cache """
@@ -115,70 +363,96 @@ class SqliteCache:
         return_value = None
         key = key.lower()
 
-        # get a connection to run the lookup query with
+        # hot entries are served from memory without touching sqlite
+        if self.l1 is not None:
+            blob = self.l1.get(key)
+            if blob is not None:
+                self._touch(key)
+                return decode_value(blob)
+
+        # get a connection to run the lookup query with,
+        # expired rows are filtered out by the query itself
         with self._get_conn() as conn:
+            row = conn.execute(self._get_sql, (key, time())).fetchone()
+            if row is None and self._legacy_pending and self._migrate_legacy_key(conn, key):
+                row = conn.execute(self._get_sql, (key, time())).fetchone()
+
+        if row is not None:
+            return_value = decode_value(row[0])
+            self._touch(key)
+            if self.l1 is not None:
+                self.l1.set(key, bytes(row[0]), row[1])
 
-            # loop the response rows looking for a result
-            # that is not expired
-            for row in conn.execute(self._get_sql, (key,)):
-                #return_value = loads(row[0])
+        return return_value
 
-                expire = loads(row[1])
+    @_timed
+    def get_with_stale(self, key):
+        """ Retrieve a value, falling back to an expired one still inside the grace window
 
-                #xbmc.executebuiltin('Notification(%s,%s,3000,%s)' % ('expiry of {k} {kk}'.format(k=key, kk=provider), expire , ADDON.getAddonInfo('icon')))
+            Returns (value, is_stale). The caller is expected to refresh
+            stale values in the background.
+        """
 
-                if expire == 0 or expire > time():
-                    return_value = loads(row[0])
-                    #xbmc.executebuiltin('Notification(%s,%s,3000,%s)' % ('Cach for %s' % key, return_value , ADDON.getAddonInfo('icon')))
-                    # TODO: Delete the value that is expired?
-                else:
-                    self.delete(key)
-                    return_value = None
-                break
+        value = self.get(key)
+        if value is not None or self.stale_grace <= 0:
+            return value, False
 
-        return return_value
+        now = time()
+        with self._get_conn() as conn:
+            row = conn.execute(self._get_stale_sql, (key.lower(), now, now - self.stale_grace)).fetchone()
+        if row is None:
+            return None, False
+        self._touch(key.lower())
+        return decode_value(row[0]), True
 
+    @_timed
     def get_exp(self, key):
-        return_value = None
+        """ Return the expiry timestamp of a key, 0 for never or None if missing """
+
         key = key.lower()
 
         with self._get_conn() as conn:
-            #for row in conn.execute(self._get_sql_exp, (key,)):
-                try:
-                    expire = loads(conn.execute(self._get_sql_exp, (key,)))
-                except:
-                    expire = "No Result"
+            row = conn.execute(self._get_sql_exp, (key,)).fetchone()
 
-        return expire
+        return row[0] if row else None
 
+    @_timed
     def delete(self, key):
 
         """ Delete a cache entry """
 
+        key = key.lower()
         with self._get_conn() as conn:
             conn.execute(self._del_sql, (key,))
+        if self.l1 is not None:
+            self.l1.delete(key)
 
+    @_timed
     def update(self, key, show_info, timeout=None):
         """ Sets a k,v pair with an optional timeout """
 
+        key = key.lower()
         Default_caching_period = 30*24*60*60  # 30 days
         expire = time() + Default_caching_period if timeout is None else time() + float(timeout)
 
         # Serialize the value
-        val = PickleBuffer(dumps(show_info))
-        expire = PickleBuffer(dumps(expire))
+        blob = encode_value(show_info)
 
         # Write the updated value to the db
         with self._get_conn() as conn:
             try:
-                conn.execute(self._set_sql, (key, val, expire))
+                conn.execute(self._set_sql, (key, blob, expire, time()))
+                if self.l1 is not None:
+                    self.l1.set(key, blob, expire)
                 if isinstance(show_info, dict):
                     logger.info(f"Successfully updated results in cache for [{show_info.get('title', 'Unknown')}] [{show_info.get('provider', 'Unknown')}]")
                 else:
                     logger.info(f"Successfully updated results in cache for key: {key}")
             except:
                 logger.info(f"Failed to update results in cache for key: {key}")
+        self._count_writes(1)
 
+    @_timed
     def set(self, key, show_info, timeout=None):
         """ Adds a k,v pair with an optional timeout """
 
@@ -190,6 +464,7 @@ class SqliteCache:
         except:
             logger.info("Failed to log save attempt details")
 
+        key = key.lower()
         Default_caching_period = 30*24*60*60  # 30 days
 
         # Check if timeout is a dictionary and extract the value if it is
@@ -199,18 +474,478 @@ class SqliteCache:
         expire = time() + Default_caching_period if timeout is None else time() + float(timeout)
 
         # Serialize the value
-        val = PickleBuffer(dumps(show_info))
-        expire2 = PickleBuffer(dumps(expire))
+        blob = encode_value(show_info)
 
         # Adding a new entry that may cause a duplicate key error if the key already exists.
         # In this case, we will fall back to the update method.
         with self._get_conn() as conn:
             try:
-                conn.execute(self._add_sql, (key, val, expire2))
+                conn.execute(self._add_sql, (key, blob, expire, time()))
+                if self.l1 is not None:
+                    self.l1.set(key, blob, expire)
             except sqlite3.IntegrityError:
                 # Call the update method as fallback
                 logger.info(f'Attempting to set an existing key {key}. Falling back to update method.')
                 self.update(key, show_info, timeout)
+                return
+        self._count_writes(1)
+
+    @_timed
+    def get_many(self, keys):
+        """ Retrieve several values with a single connection and query per batch
+
+            Returns a dict of lowercased key -> value holding only the keys
+            that were found and are not expired. Expired rows are left for
+            get_with_stale and the sweeper, like in get().
+        """
+
+        results = {}
+        pending = []
+        for key in dict.fromkeys(k.lower() for k in keys):
+            blob = self.l1.get(key) if self.l1 is not None else None
+            if blob is not None:
+                results[key] = decode_value(blob)
+                self._touch(key)
+            else:
+                pending.append(key)
+
+        now = time()
+        with self._get_conn() as conn:
+            for chunk in _chunks(pending, self._batch_size):
+                sql = self._get_many_sql.format(','.join('?' * len(chunk)))
+                for key, val, exp in conn.execute(sql, (*chunk, now)):
+                    results[key] = decode_value(val)
+                    self._touch(key)
+                    if self.l1 is not None:
+                        self.l1.set(key, bytes(val), exp)
+
+        # rows that have not been moved out of the legacy table yet
+        if self._legacy_pending:
+            for key in pending:
+                if key not in results:
+                    value = self.get(key)
+                    if value is not None:
+                        results[key] = value
+        return results
+
+    @_timed
+    def set_many(self, items, timeout=None):
+        """ Store several k,v pairs in one transaction, replacing existing keys
+
+            Items are a dict or (key, value) pairs sharing `timeout`, or
+            (key, value, timeout) triples with their own expiry.
+        """
+
+        Default_caching_period = 30*24*60*60  # 30 days
+
+        rows = []
+        now = time()
+        for key, show_info, item_timeout in items_with_timeouts(items, timeout):
+            expire = now + Default_caching_period if item_timeout is None else now + float(item_timeout)
+            rows.append((key.lower(), encode_value(show_info), expire, now))
+
+        with self._get_conn() as conn:
+            conn.executemany(self._set_sql, rows)
+
+        if self.l1 is not None:
+            for key, blob, expire, _ in rows:
+                self.l1.set(key, blob, expire)
+        logger.info(f"Stored {len(rows)} results in cache")
+        self._count_writes(len(rows))
+        return len(rows)
+
+    @_timed
+    def get_many_with_stale(self, keys):
+        """ Like get_many, but also returns recently expired rows, in the same single query
+
+            Returns a dict of lowercased key -> (value, is_stale).
+        """
+
+        results = {}
+        pending = []
+        for key in dict.fromkeys(k.lower() for k in keys):
+            blob = self.l1.get(key) if self.l1 is not None else None
+            if blob is not None:
+                results[key] = (decode_value(blob), False)
+                self._touch(key)
+            else:
+                pending.append(key)
+
+        now = time()
+        oldest = now - self.stale_grace if self.stale_grace > 0 else now
+        with self._get_conn() as conn:
+            for chunk in _chunks(pending, self._batch_size):
+                sql = self._get_many_sql.format(','.join('?' * len(chunk)))
+                for key, val, exp in conn.execute(sql, (*chunk, oldest)):
+                    is_stale = 0 < exp <= now
+                    results[key] = (decode_value(val), is_stale)
+                    self._touch(key)
+                    if self.l1 is not None and not is_stale:
+                        self.l1.set(key, bytes(val), exp)
+
+        if self._legacy_pending:
+            for key in pending:
+                if key not in results:
+                    value, is_stale = self.get_with_stale(key)
+                    if value is not None:
+                        results[key] = (value, is_stale)
+        return results
+
+    def _migrate_legacy_key(self, conn, key):
+        """ Move a single key out of the legacy table, True if it was there """
+
+        row = conn.execute("SELECT rowid, key, val, exp FROM entries_legacy WHERE key = ? COLLATE NOCASE",
+                           (key,)).fetchone()
+        if row is None:
+            return False
+        self._migrate_legacy_rows(conn, [row])
+        return True
+
+    def _migrate_legacy_rows(self, conn, rows):
+        converted = []
+        for rowid, key, val, exp in rows:
+            try:
+                converted.append((key.lower(), encode_value(loads(val)), float(loads(exp))))
+            except Exception as e:
+                logger.warning(f"Dropping unreadable legacy cache row {key}: {e}")
+        # rows written in the new format since the migration started win
+        conn.executemany("INSERT OR IGNORE INTO entries (key, val, exp) VALUES (?, ?, ?)", converted)
+        conn.executemany("DELETE FROM entries_legacy WHERE rowid = ?", [(row[0],) for row in rows])
+
+    def migrate_legacy_entries(self, batch_size=500):
+        """ Convert rows of the pre-v2 entries table in small transactions
+
+            Each batch is committed on its own so readers and writers are
+            never blocked for longer than one batch. Returns the number of
+            rows processed.
+        """
+
+        migrated = 0
+        try:
+            while True:
+                with self._get_conn() as conn:
+                    rows = conn.execute("SELECT rowid, key, val, exp FROM entries_legacy LIMIT ?",
+                                        (batch_size,)).fetchall()
+                    if not rows:
+                        conn.execute("DROP TABLE entries_legacy")
+                        break
+                    self._migrate_legacy_rows(conn, rows)
+                migrated += len(rows)
+        except sqlite3.OperationalError as e:
+            # another instance finished the migration first
+            logger.info(f"Legacy cache migration stopped: {e}")
+        self._legacy_pending = False
+        logger.info(f"Migrated {migrated} legacy cache entries")
+        return migrated
+
+    @_timed
+    def sweep_expired(self):
+        """ Delete expired rows in small batches and give the space back to the OS
+
+            Every batch is its own short transaction followed by a pause, so
+            a sweep never holds the write lock long enough to stall requests.
+            Returns the number of rows deleted and bytes reclaimed.
+        """
+
+        started = time()
+        rows = 0
+        with self._get_conn() as conn:
+            page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+            pages_before = conn.execute('PRAGMA page_count').fetchone()[0]
+
+        for table, column, keeps_stale in self._expiring_tables:
+            sql = (f'DELETE FROM {table} WHERE rowid IN '
+                   f'(SELECT rowid FROM {table} WHERE {column} > 0 AND {column} <= ? LIMIT ?)')
+            grace = self.stale_grace if keeps_stale else 0
+            while True:
+                with self._get_conn() as conn:
+                    deleted = conn.execute(sql, (time() - grace, self._sweep_batch_size)).rowcount
+                rows += deleted
+                if deleted < self._sweep_batch_size:
+                    break
+                self._sweeper_stop.wait(self._sweep_pause)
+
+        # release free pages a chunk at a time (no-op unless auto_vacuum is incremental)
+        conn = self._get_conn()
+        while conn.execute('PRAGMA freelist_count').fetchone()[0] > 0:
+            pages = conn.execute('PRAGMA page_count').fetchone()[0]
+            # executescript steps the pragma to completion, execute() frees a single page
+            conn.executescript(f'PRAGMA incremental_vacuum({self._vacuum_pages})')
+            if conn.execute('PRAGMA page_count').fetchone()[0] == pages:
+                break
+            self._sweeper_stop.wait(self._sweep_pause)
+        pages_after = conn.execute('PRAGMA page_count').fetchone()[0]
+
+        result = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'rows': rows,
+            'bytes': max(pages_before - pages_after, 0) * page_size,
+            'duration': round(time() - started, 3),
+        }
+        self.last_sweep = result
+        logger.info(f"Cache sweep removed {result['rows']} expired rows and reclaimed {result['bytes']} bytes in {result['duration']}s")
+        return result
+
+    def _touch(self, key):
+        """ Record a read of key, written to the entries table in batches by the worker """
+
+        # access times only rank eviction victims, without a budget nothing reads them
+        if not self.max_entries and not self.max_bytes:
+            return
+        with self._touches_lock:
+            hits, _ = self._touches.get(key, (0, 0))
+            self._touches[key] = (hits + 1, time())
+            full = len(self._touches) >= self._touch_batch
+        if full:
+            self._wake_worker()
+
+    @_timed
+    def flush_touches(self):
+        """ Write pending access times and hit counts in one transaction """
+
+        with self._touches_lock:
+            touches, self._touches = self._touches, {}
+        if touches:
+            with self._get_conn() as conn:
+                conn.executemany(self._touch_sql, [(atime, hits, key) for key, (hits, atime) in touches.items()])
+        return len(touches)
+
+    def _count_writes(self, count):
+        """ Check the size budget in the background every _evict_check_every writes """
+
+        if not self.max_entries and not self.max_bytes:
+            return
+        self._writes_since_check += count
+        if self._writes_since_check < self._evict_check_every:
+            return
+        self._writes_since_check = 0
+        # a check requested while one is running makes the worker go again afterwards
+        self._evict_due = True
+        self._wake_worker()
+
+    def _wake_worker(self):
+        """ Hand touch flushing and eviction to the background worker, started on first use """
+
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run_worker, name='cache-eviction', daemon=True)
+                self._worker.start()
+        self._worker_wanted.set()
+
+    def _run_worker(self):
+        # a single long-lived thread, so it holds one pooled connection for the life of the cache
+        while True:
+            self._worker_wanted.wait()
+            self._worker_wanted.clear()
+            # replaced or stopped by close()
+            if self._worker is not threading.current_thread():
+                return
+            try:
+                self.flush_touches()
+            except sqlite3.Error as e:
+                # access times are a hint, losing a batch only skews eviction order
+                logger.warning(f"Could not record cache access times: {e}")
+            if self._evict_due:
+                self._evict_due = False
+                try:
+                    self.evict()
+                except sqlite3.Error as e:
+                    logger.error(f"Cache eviction failed: {e}")
+
+    def _stop_worker(self):
+        with self._worker_lock:
+            worker, self._worker = self._worker, None
+        if worker is not None:
+            self._worker_wanted.set()
+            worker.join(timeout=5)
+
+    @_timed
+    def evict(self):
+        """ Delete the least valuable entries until the table is back under its budget
+
+            Entries are ranked by last access (lru) or by hit count then last
+            access (lfu) and deleted in small transactions until the table is
+            down to _evict_target of max_entries / max_bytes, so a full cache
+            isn't evicted again on the very next write. Returns None when no
+            budget is configured.
+        """
+
+        if not self.max_entries and not self.max_bytes:
+            return None
+        if not self._evict_lock.acquire(blocking=False):
+            return None
+        try:
+            started = time()
+            self.flush_touches()
+            with self._get_conn() as conn:
+                count, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(length(val)), 0) FROM entries').fetchone()
+            excess_rows = count - int(self.max_entries * self._evict_target) if count > self.max_entries > 0 else 0
+            excess_bytes = size - int(self.max_bytes * self._evict_target) if size > self.max_bytes > 0 else 0
+
+            sql = (f'SELECT rowid, key, length(val) FROM entries '
+                   f'ORDER BY {self._eviction_orders[self.eviction_policy]} LIMIT ?')
+            rows = 0
+            freed = 0
+            while excess_rows > 0 or excess_bytes > 0:
+                victims = []
+                with self._get_conn() as conn:
+                    for rowid, key, length in conn.execute(sql, (self._evict_batch_size,)).fetchall():
+                        if excess_rows <= 0 and excess_bytes <= 0:
+                            break
+                        victims.append((rowid, key, length or 0))
+                        excess_rows -= 1
+                        excess_bytes -= length or 0
+                    if not victims:
+                        break
+                    conn.executemany('DELETE FROM entries WHERE rowid = ?', [(v[0],) for v in victims])
+                self.incr_stats({'cache_evictions': len(victims)})
+                if self.l1 is not None:
+                    for _, key, _ in victims:
+                        self.l1.delete(key)
+                rows += len(victims)
+                freed += sum(v[2] for v in victims)
+                self._sweeper_stop.wait(self._sweep_pause)
+        finally:
+            self._evict_lock.release()
+
+        result = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'policy': self.eviction_policy,
+            'rows': rows,
+            'bytes': freed,
+            'duration': round(time() - started, 3),
+        }
+        if rows:
+            self.last_eviction = result
+            logger.info(f"Cache eviction ({self.eviction_policy}) removed {rows} entries ({freed} bytes) in {result['duration']}s")
+        return result
+
+    def get_eviction_stats(self):
+        """ Size budget, eviction policy and how many entries it has evicted so far """
+
+        return {
+            'policy': self.eviction_policy,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'evicted': self.get_stat('cache_evictions') or 0,
+            'last_eviction': self.last_eviction,
+        }
+
+    def start_sweeper(self, interval=None):
+        """ Run sweep_expired every `interval` seconds on a daemon thread """
+
+        if self._sweeper is not None:
+            return
+        if interval is None:
+            interval = float(os.environ.get('CACHE_SWEEP_INTERVAL', 600))
+
+        def run():
+            while not self._sweeper_stop.wait(interval):
+                try:
+                    self.sweep_expired()
+                    self.flush_touches()
+                    self.evict()
+                    self.rollup_stats()
+                    self.trim_logs()
+                    if self._negative_filter_full:
+                        self._rebuild_negative_filter(self._negative_filter.capacity * 2)
+                except sqlite3.Error as e:
+                    logger.error(f"Cache sweep failed: {e}")
+
+        self._sweeper_stop.clear()
+        self._sweeper = threading.Thread(target=run, name='cache-sweeper', daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper_stop.set()
+            self._sweeper.join(timeout=5)
+            self._sweeper = None
+
+    def vacuum(self):
+        """ Rebuild the file with incremental auto-vacuum enabled (needed once for old files) """
+
+        conn = self._get_conn()
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+
+    def iter_rows(self, table, provider=None, min_exp=None):
+        """ Stream raw (key, blob, exp) rows of entries or omdb_cache in key order
+
+            Rows are read one batch at a time with keyset pagination, so
+            memory use does not depend on the table size. provider limits
+            entries to keys of that provider, min_exp skips rows expiring
+            before that timestamp (rows that never expire are always kept).
+        """
+
+        val_col, exp_col = self._snapshot_tables[table]
+        conditions = ['key > ?']
+        params = []
+        if provider:
+            # canonical keys are "<provider>:...", ';' sorts right after ':'
+            conditions.append('key >= ? AND key < ?')
+            params += [f'{provider}:', f'{provider};']
+        if min_exp is not None:
+            conditions.append(f'({exp_col} = 0 OR {exp_col} >= ?)')
+            params.append(min_exp)
+        sql = (f"SELECT key, {val_col}, {exp_col} FROM {table} WHERE {' AND '.join(conditions)} "
+               f"ORDER BY key LIMIT {self._batch_size}")
+
+        last_key = ''
+        while True:
+            with self._get_conn() as conn:
+                rows = conn.execute(sql, (last_key, *params)).fetchall()
+            for key, blob, exp in rows:
+                yield key, bytes(blob), exp
+            if len(rows) < self._batch_size:
+                break
+            last_key = rows[-1][0]
+
+    @_timed
+    def import_rows(self, table, rows):
+        """ Write (key, blob, exp) rows into entries or omdb_cache, one transaction per batch
+
+            A row is skipped when the key is already stored with the same or
+            a later expiry, so re-importing a snapshot only writes what
+            changed. Returns (written, skipped).
+        """
+
+        val_col, exp_col = self._snapshot_tables[table]
+        rank = lambda exp: float('inf') if exp == 0 else exp  # 0 means never expires
+        written = skipped = 0
+        now = time()
+        with self._get_conn() as conn:
+            for chunk in _chunks(rows, self._batch_size):
+                placeholders = ','.join('?' * len(chunk))
+                current = dict(conn.execute(f"SELECT key, {exp_col} FROM {table} WHERE key IN ({placeholders})",
+                                            [row[0] for row in chunk]))
+                changed = [row for row in chunk if row[0] not in current or rank(current[row[0]]) < rank(row[2])]
+                skipped += len(chunk) - len(changed)
+                if not changed:
+                    continue
+                with conn:
+                    if table == 'entries':
+                        conn.executemany(self._set_sql, [(key, blob, exp, now) for key, blob, exp in changed])
+                    else:
+                        conn.executemany(f"REPLACE INTO {table} (key, {val_col}, {exp_col}) VALUES (?, ?, ?)", changed)
+                if table == 'entries' and self.l1 is not None:
+                    for key, _, _ in changed:
+                        self.l1.delete(key)
+                written += len(changed)
+        return written, skipped
+
+    @_timed
+    def delete_many(self, keys):
+        """ Delete several cache entries in one transaction """
+
+        keys = [key.lower() for key in keys]
+        with self._get_conn() as conn:
+            for chunk in _chunks(keys, self._batch_size):
+                conn.execute(self._del_many_sql.format(','.join('?' * len(chunk))), chunk)
+
+        if self.l1 is not None:
+            for key in keys:
+                self.l1.delete(key)
 
     def clear(self):
         try:
@@ -218,8 +953,17 @@ class SqliteCache:
             with conn:
                 conn.execute("DELETE FROM entries")
                 conn.execute("DELETE FROM stats")
+                conn.execute("DELETE FROM stats_series")
+                conn.execute("DELETE FROM stats_rollups")
                 conn.execute("DELETE FROM logs")
                 conn.execute("DELETE FROM omdb_cache")
+                conn.execute("DELETE FROM aliases")
+                conn.execute("DELETE FROM negative_cache")
+            self._rebuild_negative_filter()
+            with self._touches_lock:
+                self._touches = {}
+            if self.l1 is not None:
+                self.l1.clear()
             logger.info('Cache cleared successfully')
         except Exception as e:
             logger.error(f"Failed to clear cache: {e}")
@@ -227,10 +971,10 @@ class SqliteCache:
 
     def __del__(self):
 
-        """ Cleans up the object by destroying the sqlite connection """
+        """ Cleans up the object by destroying the sqlite connections """
 
-        if self.connection:
-            self.connection.close()
+        if getattr(self, '_connections', None):
+            self.close()
 
     def get_cached_records_count(self):
         with self._get_conn() as conn:
@@ -249,26 +993,245 @@ class SqliteCache:
             result = cursor.fetchone()
             return json.loads(result[0]) if result else None
 
+    @_timed
     def get_all_stats(self):
         try:
             with self._get_conn() as conn:
                 cursor = conn.execute("SELECT key, value FROM stats")
-                return {key: json.loads(value) for key, value in cursor.fetchall()}
+                return nest_stats({key: json.loads(value) for key, value in cursor.fetchall()})
         except sqlite3.Error as e:
             logger.error(f"Error getting all stats: {e}")
             return {}  # Return an empty dict if there's an error
 
+    @_timed
+    def incr_stats(self, counts):
+        """ Add to several counters in one transaction without reading them first """
+
+        if not counts:
+            return
+        with self._get_conn() as conn:
+            conn.executemany("INSERT INTO stats (key, value) VALUES (?, ?) "
+                             "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + excluded.value",
+                             list(counts.items()))
+
+    @_timed
+    def add_stats_series(self, counts):
+        """ Add {(minute bucket, dimension, value): count} to the minute buckets """
+
+        if not counts:
+            return
+        with self._get_conn() as conn:
+            conn.executemany("INSERT INTO stats_series (granularity, dimension, bucket_start, value, count) "
+                             "VALUES ('minute', ?, ?, ?, ?) "
+                             "ON CONFLICT (granularity, dimension, bucket_start, value) "
+                             "DO UPDATE SET count = count + excluded.count",
+                             [(dimension, bucket, value, count) for (bucket, dimension, value), count in counts.items()])
+
+    @_timed
+    def get_stats_series(self, dimension, granularity, start='', end='~'):
+        """ Counts as {(bucket, value): count} for buckets in [start, end)
+
+            Buckets that have not been rolled up yet are summed from the
+            next finer granularity, so recent hits show up right away.
+        """
+
+        levels = list(STATS_GRANULARITIES)
+        with self._get_conn() as conn:
+            watermarks = dict(conn.execute("SELECT granularity, rolled_until FROM stats_rollups"))
+
+            def collect(granularity, start):
+                length = STATS_GRANULARITIES[granularity]
+                counts = Counter()
+                for bucket, value, count in conn.execute(
+                        "SELECT bucket_start, value, count FROM stats_series "
+                        "WHERE granularity = ? AND dimension = ? AND bucket_start >= ? AND bucket_start < ?",
+                        (granularity, dimension, start, end)):
+                    counts[(bucket, value)] += count
+                level = levels.index(granularity)
+                if level > 0:
+                    finer_start = max(start, watermarks.get(granularity) or '')
+                    for (bucket, value), count in collect(levels[level - 1], finer_start).items():
+                        counts[(bucket[:length], value)] += count
+                return counts
+
+            return dict(collect(granularity, start))
+
+    @_timed
+    def rollup_stats(self):
+        """ Fold closed buckets into the next coarser granularity and apply retention
+
+            minute -> hour -> day -> month. stats_rollups records how far each
+            granularity has been built, so every source row is added exactly
+            once. Rolled up rows older than _stats_retention are deleted.
+        """
+
+        now = datetime.now()
+        closed = (now - timedelta(seconds=self._rollup_delay)).strftime('%Y-%m-%d %H:%M')
+        levels = list(STATS_GRANULARITIES.items())
+        rolled = 0
+        for (source, _), (target, length) in zip(levels, levels[1:]):
+            until = closed[:length]
+            with self._get_conn() as conn:
+                row = conn.execute("SELECT rolled_until FROM stats_rollups WHERE granularity = ?", (target,)).fetchone()
+                since = row[0] if row else ''
+                if since >= until:
+                    continue
+                rolled += conn.execute(
+                    "INSERT INTO stats_series (granularity, dimension, bucket_start, value, count) "
+                    "SELECT ?, dimension, substr(bucket_start, 1, ?) AS bucket, value, SUM(count) FROM stats_series "
+                    "WHERE granularity = ? AND bucket_start >= ? AND bucket_start < ? "
+                    "GROUP BY dimension, bucket, value "
+                    "ON CONFLICT (granularity, dimension, bucket_start, value) "
+                    "DO UPDATE SET count = count + excluded.count",
+                    (target, length, source, since, until)).rowcount
+                conn.execute("REPLACE INTO stats_rollups (granularity, rolled_until) VALUES (?, ?)", (target, until))
+
+        deleted = 0
+        with self._get_conn() as conn:
+            watermarks = dict(conn.execute("SELECT granularity, rolled_until FROM stats_rollups"))
+            for (granularity, length), (coarser, _) in zip(levels, levels[1:]):
+                cutoff = (now - timedelta(days=self._stats_retention[granularity])).strftime('%Y-%m-%d %H:%M')[:length]
+                # never drop rows the coarser granularity has not absorbed yet
+                cutoff = min(cutoff, watermarks.get(coarser) or '')
+                deleted += conn.execute("DELETE FROM stats_series WHERE granularity = ? AND bucket_start < ?",
+                                        (granularity, cutoff)).rowcount
+        if rolled or deleted:
+            logger.info(f"Stats rollup wrote {rolled} buckets and removed {deleted} expired buckets")
+        return rolled, deleted
+
+    def _migrate_stats(self):
+        """ Move the grouped JSON stats (hits_by_day, countries, ...) into stats_series """
+
+        legacy = self.get_all_stats()
+        now = datetime.now().strftime('%Y-%m-%d %H:%M')
+        month, day, hour = now[:7], now[:10], now[:13]
+        rows = [('day', 'hits', bucket, 'total', count) for bucket, count in legacy.get('hits_by_day', {}).items()]
+        # the current month is rebuilt from its days when it is rolled up
+        rows += [('month', 'hits', bucket, 'total', count)
+                 for bucket, count in legacy.get('hits_by_month', {}).items() if bucket != month]
+        # all-time totals without a date, kept in the current month
+        for dimension, group in (('sex_nudity', 'sex_nudity_categories'), ('country', 'countries')):
+            rows += [('month', dimension, month, value, count) for value, count in legacy.get(group, {}).items()]
+
+        with self._get_conn() as conn:
+            conn.executemany("INSERT INTO stats_series (granularity, dimension, bucket_start, value, count) "
+                             "VALUES (?, ?, ?, ?, ?) "
+                             "ON CONFLICT (granularity, dimension, bucket_start, value) "
+                             "DO UPDATE SET count = count + excluded.count", rows)
+            if rows:
+                # the migrated months already hold the migrated days, rolling those days up
+                # again would count them twice; a new file has nothing to protect
+                conn.executemany("REPLACE INTO stats_rollups (granularity, rolled_until) VALUES (?, ?)",
+                                 [('hour', hour), ('day', day), ('month', month)])
+            groups = ('hits_by_year', 'hits_by_month', 'hits_by_day', 'sex_nudity_categories', 'countries')
+            for group in groups:
+                conn.execute("DELETE FROM stats WHERE key = ? OR key LIKE ?", (group, f'{group}:%'))
+        if rows:
+            logger.info(f"Moved {len(rows)} grouped stats into stats_series")
+
     # Logs methods
+    @_timed
     def add_log(self, level, message):
         timestamp = datetime.now().isoformat()
         with self._get_conn() as conn:
             conn.execute("INSERT INTO logs (timestamp, level, message) VALUES (?, ?, ?)", (timestamp, level, message))
 
-    def get_logs(self, limit=100, offset=0):
+    @_timed
+    def add_logs(self, rows):
+        """ Insert several (timestamp, level, message) rows in one transaction """
+
+        with self._get_conn() as conn:
+            conn.executemany("INSERT INTO logs (timestamp, level, message) VALUES (?, ?, ?)", rows)
+
+    @_timed
+    def get_logs(self, limit=100, offset=0, before=None, search=None, level=None, since=None, until=None):
+        where = []
+        params = []
+        if level:
+            where.append("level = ?")
+            params.append(level.upper())
+        window = []
+        if since:
+            window.append(("timestamp >= ?", since))
+        if until:
+            window.append(("timestamp < ?", until))
+
+        if search and self.log_search:
+            # walk the matches newest id first so LIMIT stops early even for common words,
+            # ids are handed out in logging order so this is the timestamp order too
+            sql = "SELECT logs.* FROM logs_fts JOIN logs ON logs.id = logs_fts.rowid WHERE logs_fts MATCH ?"
+            params.insert(0, fts_query(search))
+            if window:
+                # the time window as an id range from logs_timestamp_index, so fts5 only
+                # walks the matches inside it instead of every match filtered afterwards
+                with self._get_conn() as conn:
+                    first, last = conn.execute(
+                        "SELECT MIN(id), MAX(id) FROM logs WHERE " + " AND ".join(c for c, _ in window),
+                        [value for _, value in window]).fetchone()
+                if first is None:
+                    return []
+                where.append("logs_fts.rowid BETWEEN ? AND ?")
+                params.extend((first, last))
+            if before is not None:
+                where.append("logs_fts.rowid < ?")
+                params.append(before[1])
+            order = "logs_fts.rowid DESC"
+        else:
+            for condition, value in window:
+                where.append(condition)
+                params.append(value)
+            sql = "SELECT * FROM logs WHERE 1"
+            if search:
+                where.append("message LIKE ? ESCAPE '\\'")
+                params.append('%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+            if before is not None:
+                # keyset pagination, seeks straight to the cursor in logs_timestamp_index
+                where.append("(timestamp, id) < (?, ?)")
+                params.extend(before)
+            order = "timestamp DESC, id DESC"
+        for condition in where:
+            sql += " AND " + condition
+        sql += f" ORDER BY {order} LIMIT ? OFFSET ?"
         with self._get_conn() as conn:
-            cursor = conn.execute("SELECT * FROM logs ORDER BY timestamp DESC LIMIT ? OFFSET ?", (limit, offset))
-            return cursor.fetchall()
+            return conn.execute(sql, (*params, limit, offset)).fetchall()
+
+    @_timed
+    def trim_logs(self):
+        """ Delete logs older than log_retention_days and beyond the newest log_max_rows
 
+            Rows go in small batches like sweep_expired so the writer thread
+            of the log handler never waits long. Returns the number deleted.
+        """
+
+        deleted = 0
+        if self.log_retention_days > 0:
+            cutoff = (datetime.now() - timedelta(days=self.log_retention_days)).isoformat()
+            deleted += self._delete_logs_batched(
+                "DELETE FROM logs WHERE id IN (SELECT id FROM logs WHERE timestamp < ? LIMIT ?)", cutoff)
+        if self.log_max_rows > 0:
+            # the oldest row still kept, found by walking logs_timestamp_index from the newest end
+            with self._get_conn() as conn:
+                oldest_kept = conn.execute("SELECT timestamp, id FROM logs ORDER BY timestamp DESC, id DESC "
+                                           "LIMIT 1 OFFSET ?", (self.log_max_rows - 1,)).fetchone()
+            if oldest_kept is not None:
+                deleted += self._delete_logs_batched(
+                    "DELETE FROM logs WHERE id IN (SELECT id FROM logs WHERE (timestamp, id) < (?, ?) LIMIT ?)",
+                    *oldest_kept)
+        if deleted:
+            logger.info(f"Log retention removed {deleted} rows")
+        return deleted
+
+    def _delete_logs_batched(self, sql, *bounds):
+        deleted = 0
+        while True:
+            with self._get_conn() as conn:
+                count = conn.execute(sql, (*bounds, self._log_trim_batch_size)).rowcount
+            deleted += count
+            if count < self._log_trim_batch_size:
+                return deleted
+            self._sweeper_stop.wait(self._sweep_pause)
+
+    @_timed
     def get_omdb_cache(self, key):
         with self._get_conn() as conn:
             cursor = conn.execute("SELECT value, expires FROM omdb_cache WHERE key = ?", (key,))
@@ -276,12 +1239,13 @@ class SqliteCache:
             if result:
                 value, expires = result
                 if expires == 0 or expires > time():
-                    return loads(value)
+                    return decode_value(value)
         return None
 
+    @_timed
     def set_omdb_cache(self, key, value):
         expire = time() + 365 * 24 * 60 * 60  # 1 year expiry
-        val = PickleBuffer(dumps(value))
+        val = encode_value(value)
         with self._get_conn() as conn:
             conn.execute("INSERT OR REPLACE INTO omdb_cache (key, value, expires) VALUES (?, ?, ?)", 
                          (key, val, expire))
@@ -293,6 +1257,8 @@ class SqliteCache:
     def clear_stats(self):
         with self._get_conn() as conn:
             conn.execute("DELETE FROM stats")
+            conn.execute("DELETE FROM stats_series")
+            conn.execute("DELETE FROM stats_rollups")
 
     def get_logs_count(self):
         with self._get_conn() as conn:
@@ -306,23 +1272,136 @@ class SqliteCache:
         with self._get_conn() as conn:
             return conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
 
+    def _rebuild_negative_filter(self, capacity=None):
+        """ Load the live negative keys into a fresh Bloom filter """
+
+        with self._negative_lock:
+            self._negative_added = []
+        try:
+            with self._get_conn() as conn:
+                keys = [row[0] for row in conn.execute("SELECT key FROM negative_cache WHERE exp > ?", (time(),))]
+            if capacity is None:
+                capacity = int(os.environ.get('NEGATIVE_CACHE_CAPACITY', 100000))
+            bloom = BloomFilter(max(capacity, len(keys) * 2))
+            for key in keys:
+                bloom.add(key)
+            with self._negative_lock:
+                # set_negative calls that ran during the SELECT would be missing otherwise
+                for key in self._negative_added:
+                    bloom.add(key)
+                self._negative_filter = bloom
+                self._negative_filter_full = False
+        finally:
+            self._negative_added = None
+
+    @_timed
+    def set_negative(self, key, timeout):
+        """ Remember for `timeout` seconds that a key has no data """
+
+        key = key.lower()
+        with self._get_conn() as conn:
+            conn.execute("REPLACE INTO negative_cache (key, exp) VALUES (?, ?)", (key, time() + float(timeout)))
+        with self._negative_lock:
+            self._negative_filter.add(key)
+            if self._negative_added is not None:
+                self._negative_added.append(key)
+        if self._negative_filter.is_saturated():
+            # a full filter only lets more lookups through to sqlite, the sweeper regrows it
+            self._negative_filter_full = True
+
+    @_timed
+    def is_negative(self, key):
+        """ True if the key is a known miss, most unknown keys never reach sqlite """
+
+        key = key.lower()
+        if key not in self._negative_filter:
+            return False
+        with self._get_conn() as conn:
+            row = conn.execute("SELECT 1 FROM negative_cache WHERE key = ? AND exp > ?", (key, time())).fetchone()
+        return row is not None
+
+    @_timed
+    def are_negative(self, keys):
+        """ The lowercased keys among `keys` that are known misses, one query for the Bloom filter hits """
+
+        candidates = [key for key in dict.fromkeys(k.lower() for k in keys) if key in self._negative_filter]
+        found = set()
+        if candidates:
+            now = time()
+            with self._get_conn() as conn:
+                for chunk in _chunks(candidates, self._batch_size):
+                    sql = self._negative_many_sql.format(','.join('?' * len(chunk)))
+                    found.update(row[0] for row in conn.execute(sql, (*chunk, now)))
+        return found
+
+    def delete_negative(self, key):
+        with self._get_conn() as conn:
+            conn.execute("DELETE FROM negative_cache WHERE key = ?", (key.lower(),))
+
+    @_timed
+    def set_alias(self, alias, key, replace=True):
+        """ Point an alternate key at its canonical key """
+
+        verb = 'REPLACE' if replace else 'INSERT OR IGNORE'
+        with self._get_conn() as conn:
+            conn.execute(f"{verb} INTO aliases (alias, key) VALUES (?, ?)", (alias.lower(), key.lower()))
+
+    @_timed
+    def resolve_alias(self, alias):
+        """ Canonical key for an alias, None if the alias is unknown """
+
+        with self._get_conn() as conn:
+            row = conn.execute("SELECT key FROM aliases WHERE alias = ?", (alias.lower(),)).fetchone()
+        return row[0] if row else None
+
+    def get_l1_stats(self):
+        """ Hit, miss and eviction counters of the in-memory tier """
+
+        return self.l1.stats() if self.l1 is not None else None
+
     def ensure_omdb_cache_table(self):
         with self._get_conn() as conn:
             conn.execute('''CREATE TABLE IF NOT EXISTS omdb_cache
                             (key TEXT PRIMARY KEY, value BLOB, expires REAL)''')
 
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 # allow this module to be used to clear the cache
 if __name__ == '__main__':
     logger.info('ParentalGuide Cache Initiated')
     
+    # Use a default path or get it from an environment variable
+    default_db_path = os.environ.get('SQLITE_DB_PATH', 'cache.sqlite')
+
     # Clear cache if no arguments or if 'clear' is specified
     if len(sys.argv) == 1 or (len(sys.argv) == 2 and sys.argv[1] == 'clear'):
-        # Use a default path or get it from an environment variable
-        default_db_path = os.environ.get('SQLITE_DB_PATH', 'cache.sqlite')
         c = SqliteCache(default_db_path)
         c.clear()
         print(f' * Cache cleared (Database: {default_db_path})')
+    elif len(sys.argv) == 2 and sys.argv[1] == 'sweep':
+        c = SqliteCache(default_db_path)
+        result = c.sweep_expired()
+        print(f" * Removed {result['rows']} expired rows, reclaimed {result['bytes']} bytes (Database: {default_db_path})")
+    elif len(sys.argv) == 2 and sys.argv[1] == 'vacuum':
+        c = SqliteCache(default_db_path)
+        c.vacuum()
+        print(f' * Database rebuilt with incremental vacuum enabled (Database: {default_db_path})')
+    elif len(sys.argv) == 2 and sys.argv[1] == 'evict':
+        c = SqliteCache(default_db_path)
+        result = c.evict()
+        if result is None:
+            print(' * No size limit configured, set CACHE_MAX_ENTRIES or CACHE_MAX_BYTES')
+        else:
+            print(f" * Evicted {result['rows']} entries ({result['bytes']} bytes, {result['policy']}) (Database: {default_db_path})")
+    elif len(sys.argv) == 2 and sys.argv[1] == 'trim-logs':
+        c = SqliteCache(default_db_path)
+        print(f' * Removed {c.trim_logs()} log rows (Database: {default_db_path})')
     else:
-        print('[!] Usage: python %s [clear]' % sys.argv[0])
+        print('[!] Usage: python %s [clear|sweep|vacuum|evict|trim-logs]' % sys.argv[0])
         print('    Running without arguments or with "clear" will clear the cache.')
+        print('    "sweep" deletes expired entries, "vacuum" enables incremental vacuum on old files.')
+        print('    "evict" trims the cache to CACHE_MAX_ENTRIES / CACHE_MAX_BYTES.')
+        print('    "trim-logs" applies LOG_RETENTION_DAYS / LOG_MAX_ROWS to the logs table.')
         sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+"""
+Micro benchmarks for the cache layer.
+
+Usage: python benchmark.py [requests]
+
+Runs the database calls a cached /get_data hit makes (cache lookup, stats
+update and request logging) against a throwaway database and reports the
+number of sqlite connections opened and the time spent per request. Also
+compares the cost of decoding a cached entry in the legacy and current
+value formats, and the logging cost of a cached request.
+"""
+
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import tempfile
+import time
+import timeit
+from datetime import datetime
+
+import request_log
+from codec import encode_value, decode_value, FORMAT_PICKLE, FORMAT_JSON, COMPRESS_NONE, COMPRESS_ZLIB
+from SQLiteCache import SqliteCache
+
+
+class UnpooledSqliteCache(SqliteCache):
+    """ The original behaviour: a fresh connection for every call """
+
+    def _get_conn(self):
+        return sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+
+
+SAMPLE_RESULT = {
+    "id": "tt0111161",
+    "status": "Success",
+    "title": "The Shawshank Redemption",
+    "provider": "imdb",
+    "review-items": [
+        {"name": "Sex & Nudity", "description": "Brief nudity. " * 40, "cat": "Mild", "votes": "1,234 votes"},
+        {"name": "Violence & Gore", "description": "Prison violence. " * 40, "cat": "Moderate", "votes": "2,345 votes"},
+    ],
+    "review-link": "https://www.imdb.com/title/tt0111161/parentalguide",
+}
+
+STAT_COUNTS = {'total_hits': 1, 'cached_hits': 1}
+STAT_SERIES = {('2024-06-01 12:00', 'hits', 'total'): 1, ('2024-06-01 12:00', 'hits', 'cached'): 1,
+               ('2024-06-01 12:00', 'sex_nudity', 'Mild'): 1, ('2024-06-01 12:00', 'country', 'Testland'): 1}
+
+
+def simulate_cached_request(db, key):
+    """ Mirrors the database traffic of a cache hit in index.get_data """
+
+    db.get(key)
+    logs = [f'get_data status=200 provider=imdb key={key} cache=hit']
+    # stats_aggregator and the log writer batch these, flushing every request is the worst case
+    db.incr_stats(STAT_COUNTS)
+    db.add_stats_series(STAT_SERIES)
+    db.add_logs([(datetime.now().isoformat(), 'INFO', message) for message in logs])
+
+
+class ConnectCounter:
+    """ Counts sqlite3.connect calls while active """
+
+    def __init__(self):
+        self.count = 0
+        self._connect = sqlite3.connect
+
+    def __enter__(self):
+        def counting_connect(*args, **kwargs):
+            self.count += 1
+            return self._connect(*args, **kwargs)
+        sqlite3.connect = counting_connect
+        return self
+
+    def __exit__(self, *exc):
+        sqlite3.connect = self._connect
+
+
+def bench_connections(cache_cls, requests):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = cache_cls(os.path.join(tmp, 'bench.sqlite'))
+        key = 'imdb:tt0111161'
+        db.set(key, SAMPLE_RESULT)
+        with ConnectCounter() as counter:
+            start = time.perf_counter()
+            for _ in range(requests):
+                simulate_cached_request(db, key)
+            elapsed = time.perf_counter() - start
+        db.close()
+    return counter.count / requests, elapsed / requests * 1000
+
+
+def bench_decode(rounds):
+    """ Per-hit decode cost: legacy pickled val + pickled exp vs. header-prefixed blobs """
+
+    legacy_val = pickle.dumps(SAMPLE_RESULT)
+    legacy_exp = pickle.dumps(time.time() + 3600)
+
+    def legacy():
+        expire = pickle.loads(legacy_exp)
+        if expire == 0 or expire > time.time():
+            return pickle.loads(legacy_val)
+
+    timings = [('legacy (pickled val + exp)', legacy)]
+    for label, fmt, compression in (('v2 pickle', FORMAT_PICKLE, COMPRESS_NONE),
+                                    ('v2 pickle + zlib', FORMAT_PICKLE, COMPRESS_ZLIB),
+                                    ('v2 json', FORMAT_JSON, COMPRESS_NONE),
+                                    ('v2 json + zlib', FORMAT_JSON, COMPRESS_ZLIB)):
+        blob = encode_value(SAMPLE_RESULT, fmt, compression)
+        timings.append((f'{label} ({len(blob)} bytes)', lambda blob=blob: decode_value(blob)))
+
+    for label, fn in timings:
+        us = timeit.timeit(fn, number=rounds) / rounds * 1e6
+        print(f'  {label:30} {us:8.2f} us/decode')
+
+
+class FormattingHandler(logging.Handler):
+    """ Formats every record like the database handler does, then drops it """
+
+    def emit(self, record):
+        self.format(record)
+
+
+def legacy_request_logging(log, key):
+    """ The INFO lines get_data used to write for a cache hit """
+
+    log.info("Received request for /get_data")
+    log.info(f"Request parameters: imdb_id={key}, video_name=, release_year=None, provider=imdb")
+    log.info(f"Cached result structure: {json.dumps(SAMPLE_RESULT, indent=2)}")
+    log.info(f"Returning cached result for {SAMPLE_RESULT['title']} from imdb")
+
+
+def current_request_logging(log, key):
+    """ Lazy DEBUG lines, a payload dump and one request event """
+
+    log.debug("Request parameters: imdb_id=%s, video_name=%s, release_year=%s, provider=%s", key, '', None, 'imdb')
+    request_log.log_payload(log, "Cached result structure", SAMPLE_RESULT)
+    request_log.log_event(log, 'get_data', status=200, provider='imdb', key=key, cache='hit', ms=0.4)
+
+
+def bench_logging(rounds):
+    """ Per-request logging cost of a cache hit with a formatting handler attached """
+
+    log = logging.getLogger('benchmark.requests')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    handler = FormattingHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    handler.addFilter(request_log.SamplingFilter(rates={}, default_rate=1.0))
+    log.addHandler(handler)
+    key = 'imdb:tt0111161'
+    try:
+        for label, fn, sample_rate in (('before (eager INFO + json dump)', legacy_request_logging, 0),
+                                       ('after (unsampled request)', current_request_logging, 0),
+                                       ('after (sampled request)', current_request_logging, 1)):
+            token = request_log.begin_request(sample_rate)
+            try:
+                us = timeit.timeit(lambda: fn(log, key), number=rounds) / rounds * 1e6
+            finally:
+                request_log.end_request(token)
+            print(f'  {label:34} {us:8.2f} us/request')
+    finally:
+        log.removeHandler(handler)
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f'Simulating {requests} cached /get_data requests')
+    for label, cache_cls in (('before (connection per call)', UnpooledSqliteCache),
+                             ('after (pooled connections)', SqliteCache)):
+        per_request, ms = bench_connections(cache_cls, requests)
+        print(f'  {label:30} {per_request:6.2f} connections/request {ms:8.3f} ms/request')
+    print('Decoding a cached entry')
+    bench_decode(requests * 100)
+    print('Logging a cached request')
+    bench_logging(requests * 20)
+
+
+if __name__ == '__main__':
+    main()
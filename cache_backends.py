@@ -0,0 +1,801 @@
+"""
+    Cache backends.
+
+    CacheBackend is the interface every store implements: cached results,
+    stale serving, negative entries, aliases, stats, logs and the OMDb
+    cache. SqliteCache (SQLiteCache.py) is the default; MemoryCache keeps
+    everything in process and RedisCache talks the Redis protocol so several
+    app instances can share one cache.
+
+    The backend is picked with CACHE_BACKEND (sqlite, memory or redis) and
+    REDIS_URL, see create_cache().
+"""
+
+import json
+import os
+import socket
+import struct
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime
+from time import time
+from urllib.parse import urlparse
+
+from codec import encode_value, decode_value
+
+DEFAULT_CACHING_PERIOD = 30 * 24 * 60 * 60  # 30 days
+OMDB_CACHING_PERIOD = 365 * 24 * 60 * 60  # 1 year
+
+# time series buckets, finest first: a bucket is the local time truncated to
+# this many characters of "YYYY-MM-DD HH:MM", so rolling up is a prefix
+STATS_GRANULARITIES = {'minute': 16, 'hour': 13, 'day': 10, 'month': 7}
+
+
+def expiry_from_timeout(timeout):
+    """ Absolute expiry for a timeout in seconds, None means the default period """
+
+    # Check if timeout is a dictionary and extract the value if it is
+    if isinstance(timeout, dict):
+        timeout = timeout.get('timeout', None)
+    return time() + DEFAULT_CACHING_PERIOD if timeout is None else time() + float(timeout)
+
+
+def items_with_timeouts(items, timeout=None):
+    """ (key, value, timeout) for every set_many item
+
+        Items are a dict or (key, value) pairs using the call's timeout, or
+        (key, value, timeout) triples keeping their own.
+    """
+
+    if isinstance(items, dict):
+        items = items.items()
+    for item in items:
+        yield item if len(item) == 3 else (item[0], item[1], timeout)
+
+
+def default_stale_grace():
+    return float(os.environ.get('CACHE_STALE_GRACE', 7 * 24 * 60 * 60))
+
+
+def nest_stats(stats):
+    """ Fold flattened "group:member" counters into {group: {member: count}}
+
+        Stats written before counters were flattened hold the whole group
+        as one JSON dict, flattened counters are added on top of it.
+    """
+
+    nested = {}
+    for key, value in stats.items():
+        if ':' not in key:
+            if isinstance(value, dict):
+                group = nested.setdefault(key, {})
+                for member, count in value.items():
+                    group[member] = group.get(member, 0) + count
+            else:
+                nested[key] = value
+            continue
+        group, member = key.split(':', 1)
+        group = nested.setdefault(group, {})
+        group[member] = group.get(member, 0) + value
+    return nested
+
+
+def filter_logs(rows, before=None, search=None, level=None, since=None, until=None):
+    """ get_logs filtering for backends that keep their capped log list in memory """
+
+    words = search.lower().split() if search else []
+    level = level.upper() if level else None
+    if before is not None:
+        before = tuple(before)
+    return [row for row in rows
+            if (before is None or (row[1], row[0]) < before)
+            and (not level or row[2] == level)
+            and (not since or row[1] >= since)
+            and (not until or row[1] < until)
+            and all(word.rstrip('*') in row[3].lower() for word in words)]
+
+
+class CacheBackend(ABC):
+    """ Common API of every cache store """
+
+    last_sweep = None
+
+    # Cached results
+    @abstractmethod
+    def get(self, key):
+        """ Retrieve a live value, None if missing or expired """
+
+    @abstractmethod
+    def get_with_stale(self, key):
+        """ Retrieve a value as (value, is_stale), allowing recently expired ones """
+
+    @abstractmethod
+    def set(self, key, show_info, timeout=None):
+        """ Store a value with an optional timeout in seconds """
+
+    def update(self, key, show_info, timeout=None):
+        self.set(key, show_info, timeout)
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    def get_many(self, keys):
+        results = {}
+        for key in dict.fromkeys(k.lower() for k in keys):
+            value = self.get(key)
+            if value is not None:
+                results[key] = value
+        return results
+
+    def get_many_with_stale(self, keys):
+        """ Like get_many, as lowercased key -> (value, is_stale) including recently expired values """
+
+        results = {}
+        for key in dict.fromkeys(k.lower() for k in keys):
+            value, is_stale = self.get_with_stale(key)
+            if value is not None:
+                results[key] = (value, is_stale)
+        return results
+
+    def set_many(self, items, timeout=None):
+        """ Store several values, see items_with_timeouts for the accepted items """
+
+        count = 0
+        for key, show_info, item_timeout in items_with_timeouts(items, timeout):
+            self.set(key, show_info, item_timeout)
+            count += 1
+        return count
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    @abstractmethod
+    def get_exp(self, key):
+        """ Expiry timestamp of a key, 0 for never or None if missing """
+
+    @abstractmethod
+    def clear(self):
+        """ Remove cached results, stats, logs and OMDb lookups """
+
+    @abstractmethod
+    def get_cached_records_count(self):
+        pass
+
+    # Negative entries
+    @abstractmethod
+    def set_negative(self, key, timeout):
+        pass
+
+    @abstractmethod
+    def is_negative(self, key):
+        pass
+
+    @abstractmethod
+    def delete_negative(self, key):
+        pass
+
+    def are_negative(self, keys):
+        """ The lowercased keys among `keys` that are known misses """
+
+        return {key for key in dict.fromkeys(k.lower() for k in keys) if self.is_negative(key)}
+
+    # Aliases
+    @abstractmethod
+    def set_alias(self, alias, key, replace=True):
+        pass
+
+    @abstractmethod
+    def resolve_alias(self, alias):
+        pass
+
+    # Stats
+    @abstractmethod
+    def set_stat(self, key, value):
+        pass
+
+    @abstractmethod
+    def get_stat(self, key):
+        pass
+
+    @abstractmethod
+    def get_all_stats(self):
+        """ Every stat, "group:member" counters folded into one dict per group """
+
+    def incr_stats(self, counts):
+        """ Add to several counters, keys are plain names or "group:member" """
+
+        for key, amount in counts.items():
+            self.set_stat(key, (self.get_stat(key) or 0) + amount)
+
+    # Time series stats. Backends without a series table keep day and month
+    # buckets as "series.<granularity>.<dimension>" counter groups.
+    _series_granularities = ('day', 'month')
+
+    def add_stats_series(self, counts):
+        """ Add {(minute bucket, dimension, value): count} to the time series """
+
+        flat = {}
+        for (bucket, dimension, value), count in counts.items():
+            for granularity in self._series_granularities:
+                key = f"series.{granularity}.{dimension}:{bucket[:STATS_GRANULARITIES[granularity]]}\t{value}"
+                flat[key] = flat.get(key, 0) + count
+        self.incr_stats(flat)
+
+    def get_stats_series(self, dimension, granularity, start='', end='~'):
+        """ Counts as {(bucket, value): count} for buckets in [start, end) """
+
+        group = self.get_all_stats().get(f"series.{granularity}.{dimension}", {})
+        series = {}
+        for member, count in group.items():
+            bucket, value = member.split('\t', 1)
+            if start <= bucket < end:
+                series[(bucket, value)] = count
+        return series
+
+    def rollup_stats(self):
+        pass
+
+    @abstractmethod
+    def clear_stats(self):
+        pass
+
+    @abstractmethod
+    def get_stats_count(self):
+        pass
+
+    # Logs
+    @abstractmethod
+    def add_log(self, level, message):
+        pass
+
+    def add_logs(self, rows):
+        """ Store several (timestamp, level, message) log rows """
+
+        for timestamp, level, message in rows:
+            self.add_log(level, message)
+
+    @abstractmethod
+    def get_logs(self, limit=100, offset=0, before=None, search=None, level=None, since=None, until=None):
+        """ Rows of (id, timestamp, level, message), newest first
+
+            `before` is the (timestamp, id) of the last row of the previous
+            page, only rows older than it are returned. `search` matches
+            every word in the message, `level` is an exact level and
+            since/until bound the ISO timestamp.
+        """
+
+    def trim_logs(self):
+        """ Apply log retention, returns the number of rows deleted """
+
+        return 0
+
+    @abstractmethod
+    def clear_logs(self):
+        pass
+
+    @abstractmethod
+    def get_logs_count(self):
+        pass
+
+    # OMDb lookups
+    @abstractmethod
+    def get_omdb_cache(self, key):
+        pass
+
+    @abstractmethod
+    def set_omdb_cache(self, key, value):
+        pass
+
+    def ensure_omdb_cache_table(self):
+        pass
+
+    # Maintenance, only meaningful for some backends
+    def get_l1_stats(self):
+        return None
+
+    def get_eviction_stats(self):
+        return None
+
+    def start_sweeper(self, interval=None):
+        pass
+
+    def stop_sweeper(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryCache(CacheBackend):
+    """
+        Process-local backend, useful for tests and single-worker setups.
+
+        Values are stored encoded so callers can't mutate cached copies.
+    """
+
+    max_logs = 10000
+    # commands that are safe to send again when their replies were lost
+    read_only = frozenset(('GET', 'MGET', 'GETRANGE', 'EXISTS', 'HGET', 'HGETALL', 'HLEN', 'LRANGE', 'LLEN', 'SCAN'))
+
+    def __init__(self, stale_grace=None):
+        self.stale_grace = default_stale_grace() if stale_grace is None else stale_grace
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._negative = {}
+        self._aliases = {}
+        self._stats = {}
+        self._logs = deque(maxlen=self.max_logs)
+        self._log_id = 0
+        self._omdb = {}
+
+    def get(self, key):
+        entry = self._entries.get(key.lower())
+        if entry is None:
+            return None
+        blob, expire = entry
+        if expire == 0 or expire > time():
+            return decode_value(blob)
+        return None
+
+    def get_with_stale(self, key):
+        entry = self._entries.get(key.lower())
+        if entry is None:
+            return None, False
+        blob, expire = entry
+        now = time()
+        if expire == 0 or expire > now:
+            return decode_value(blob), False
+        if self.stale_grace > 0 and expire > now - self.stale_grace:
+            return decode_value(blob), True
+        return None, False
+
+    def set(self, key, show_info, timeout=None):
+        self._entries[key.lower()] = (encode_value(show_info), expiry_from_timeout(timeout))
+
+    def delete(self, key):
+        self._entries.pop(key.lower(), None)
+
+    def get_exp(self, key):
+        entry = self._entries.get(key.lower())
+        return entry[1] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._negative.clear()
+            self._aliases.clear()
+            self._stats.clear()
+            self._logs.clear()
+            self._omdb.clear()
+
+    def get_cached_records_count(self):
+        return len(self._entries)
+
+    def set_negative(self, key, timeout):
+        self._negative[key.lower()] = time() + float(timeout)
+
+    def is_negative(self, key):
+        expire = self._negative.get(key.lower())
+        return expire is not None and expire > time()
+
+    def delete_negative(self, key):
+        self._negative.pop(key.lower(), None)
+
+    def set_alias(self, alias, key, replace=True):
+        alias = alias.lower()
+        if replace or alias not in self._aliases:
+            self._aliases[alias] = key.lower()
+
+    def resolve_alias(self, alias):
+        return self._aliases.get(alias.lower())
+
+    def set_stat(self, key, value):
+        self._stats[key] = json.dumps(value)
+
+    def get_stat(self, key):
+        value = self._stats.get(key)
+        return json.loads(value) if value is not None else None
+
+    def get_all_stats(self):
+        return nest_stats({key: json.loads(value) for key, value in list(self._stats.items())})
+
+    def incr_stats(self, counts):
+        with self._lock:
+            for key, amount in counts.items():
+                self._stats[key] = json.dumps(json.loads(self._stats.get(key, '0')) + amount)
+
+    def clear_stats(self):
+        self._stats.clear()
+
+    def get_stats_count(self):
+        return len(self._stats)
+
+    def add_log(self, level, message):
+        self.add_logs([(datetime.now().isoformat(), level, message)])
+
+    def add_logs(self, rows):
+        with self._lock:
+            for timestamp, level, message in rows:
+                self._log_id += 1
+                self._logs.appendleft((self._log_id, timestamp, level, message))
+
+    def get_logs(self, limit=100, offset=0, before=None, search=None, level=None, since=None, until=None):
+        with self._lock:
+            logs = list(self._logs)
+        return filter_logs(logs, before, search, level, since, until)[offset:offset + limit]
+
+    def clear_logs(self):
+        self._logs.clear()
+
+    def get_logs_count(self):
+        return len(self._logs)
+
+    def get_omdb_cache(self, key):
+        entry = self._omdb.get(key)
+        if entry and (entry[1] == 0 or entry[1] > time()):
+            return decode_value(entry[0])
+        return None
+
+    def set_omdb_cache(self, key, value):
+        self._omdb[key] = (encode_value(value), time() + OMDB_CACHING_PERIOD)
+
+
+class RedisError(Exception):
+    pass
+
+
+class _RespConnection:
+    """ Minimal Redis protocol (RESP2) client connection """
+
+    def __init__(self, host, port, password=None, db=0, timeout=5):
+        self._sock = socket.create_connection((host, port), timeout=timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._sock.makefile('rb')
+        if password:
+            self.execute('AUTH', password)
+        if db:
+            self.execute('SELECT', db)
+
+    @staticmethod
+    def _encode(args):
+        out = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode('utf-8')
+            elif not isinstance(arg, (bytes, bytearray)):
+                arg = str(arg).encode('utf-8')
+            out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(out)
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed by server')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode('utf-8')
+        if kind == b'-':
+            return RedisError(payload.decode('utf-8'))
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(payload)
+            if length == -1:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RedisError(f'Unexpected reply: {line!r}')
+
+    def execute(self, *args):
+        return self.pipeline([args])[0]
+
+    def send(self, commands):
+        """ Write several commands in one go, replies are read with read() """
+
+        self._sock.sendall(b''.join(self._encode(args) for args in commands))
+
+    def read(self, count):
+        replies = [self._read_reply() for _ in range(count)]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def pipeline(self, commands):
+        """ Send several commands in one write and read all replies """
+
+        self.send(commands)
+        return self.read(len(commands))
+
+    def close(self):
+        try:
+            self._reader.close()
+            self._sock.close()
+        except OSError:
+            pass
+
+
+class RedisCache(CacheBackend):
+    """
+        Backend for any server speaking the Redis protocol.
+
+        Entries are stored as an 8-byte expiry followed by the encoded value
+        and carry a Redis TTL covering the stale grace window, so the server
+        evicts them on its own. Stats live in a hash and logs in a capped
+        list. Connections are kept one per thread.
+    """
+
+    max_logs = 10000
+    # commands that are safe to send again when their replies were lost
+    read_only = frozenset(('GET', 'MGET', 'GETRANGE', 'EXISTS', 'HGET', 'HGETALL', 'HLEN', 'LRANGE', 'LLEN', 'SCAN'))
+
+    def __init__(self, url=None, prefix='pg:', stale_grace=None):
+        url = urlparse(url or os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+        self.host = url.hostname or 'localhost'
+        self.port = url.port or 6379
+        self.password = url.password
+        self.db = int((url.path or '/0').lstrip('/') or 0)
+        self.prefix = prefix
+        self.stale_grace = default_stale_grace() if stale_grace is None else stale_grace
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = _RespConnection(self.host, self.port, self.password, self.db)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _execute(self, *args):
+        return self._pipeline([args])[0]
+
+    def _drop(self, conn):
+        """ Close a broken connection so the next call on this thread opens a new one """
+
+        conn.close()
+        with self._connections_lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        self._local.conn = None
+
+    def _pipeline(self, commands):
+        if not commands:
+            return []
+        conn = self._conn()
+        try:
+            conn.send(commands)
+        except OSError:
+            # nothing was written, reconnect once and send again
+            self._drop(conn)
+            conn = self._conn()
+            conn.send(commands)
+        try:
+            return conn.read(len(commands))
+        except OSError:
+            # the server may already have run them, HINCRBY/INCRBY/LPUSH must not run twice
+            self._drop(conn)
+            if not all(str(args[0]).upper() in self.read_only for args in commands):
+                raise
+        return self._conn().pipeline(commands)
+
+    def _key(self, kind, key):
+        return f'{self.prefix}{kind}:{key.lower()}'
+
+    def _pack(self, show_info, expire):
+        return struct.pack('<d', expire) + encode_value(show_info)
+
+    def _set_args(self, key, show_info, expire):
+        args = ['SET', self._key('e', key), self._pack(show_info, expire)]
+        if expire:
+            # keep the row through the stale grace window, then let redis drop it
+            args += ['PX', max(1, int((expire + self.stale_grace - time()) * 1000))]
+        return args
+
+    def _unpack(self, raw, allow_stale=False):
+        if raw is None:
+            return None, False
+        expire = struct.unpack('<d', raw[:8])[0]
+        now = time()
+        if expire == 0 or expire > now:
+            return decode_value(raw[8:]), False
+        if allow_stale and self.stale_grace > 0 and expire > now - self.stale_grace:
+            return decode_value(raw[8:]), True
+        return None, False
+
+    def get(self, key):
+        return self._unpack(self._execute('GET', self._key('e', key)))[0]
+
+    def get_with_stale(self, key):
+        return self._unpack(self._execute('GET', self._key('e', key)), allow_stale=True)
+
+    def set(self, key, show_info, timeout=None):
+        self._execute(*self._set_args(key, show_info, expiry_from_timeout(timeout)))
+
+    def get_many(self, keys):
+        keys = list(dict.fromkeys(k.lower() for k in keys))
+        if not keys:
+            return {}
+        raws = self._execute('MGET', *[self._key('e', key) for key in keys])
+        results = {}
+        for key, raw in zip(keys, raws):
+            value = self._unpack(raw)[0]
+            if value is not None:
+                results[key] = value
+        return results
+
+    def get_many_with_stale(self, keys):
+        keys = list(dict.fromkeys(k.lower() for k in keys))
+        if not keys:
+            return {}
+        raws = self._execute('MGET', *[self._key('e', key) for key in keys])
+        results = {}
+        for key, raw in zip(keys, raws):
+            value, is_stale = self._unpack(raw, allow_stale=True)
+            if value is not None:
+                results[key] = (value, is_stale)
+        return results
+
+    def set_many(self, items, timeout=None):
+        commands = [self._set_args(key, show_info, expiry_from_timeout(item_timeout))
+                    for key, show_info, item_timeout in items_with_timeouts(items, timeout)]
+        self._pipeline(commands)
+        return len(commands)
+
+    def delete(self, key):
+        self._execute('DEL', self._key('e', key))
+
+    def delete_many(self, keys):
+        keys = [self._key('e', key) for key in keys]
+        if keys:
+            self._execute('DEL', *keys)
+
+    def get_exp(self, key):
+        raw = self._execute('GETRANGE', self._key('e', key), 0, 7)
+        return struct.unpack('<d', raw)[0] if raw else None
+
+    def _scan(self, pattern):
+        cursor = b'0'
+        while True:
+            cursor, keys = self._execute('SCAN', cursor, 'MATCH', pattern, 'COUNT', 500)
+            yield from keys
+            if cursor in (b'0', 0):
+                break
+
+    def clear(self):
+        keys = list(self._scan(f'{self.prefix}*'))
+        for i in range(0, len(keys), 500):
+            self._execute('DEL', *keys[i:i + 500])
+
+    def get_cached_records_count(self):
+        return sum(1 for _ in self._scan(f'{self.prefix}e:*'))
+
+    def set_negative(self, key, timeout):
+        self._execute('SET', self._key('n', key), 1, 'PX', max(1, int(float(timeout) * 1000)))
+
+    def is_negative(self, key):
+        return self._execute('EXISTS', self._key('n', key)) == 1
+
+    def are_negative(self, keys):
+        keys = list(dict.fromkeys(k.lower() for k in keys))
+        replies = self._pipeline([('EXISTS', self._key('n', key)) for key in keys])
+        return {key for key, exists in zip(keys, replies) if exists == 1}
+
+    def delete_negative(self, key):
+        self._execute('DEL', self._key('n', key))
+
+    def set_alias(self, alias, key, replace=True):
+        args = ['SET', self._key('a', alias), key.lower()]
+        if not replace:
+            args.append('NX')
+        self._execute(*args)
+
+    def resolve_alias(self, alias):
+        value = self._execute('GET', self._key('a', alias))
+        return value.decode('utf-8') if value is not None else None
+
+    def set_stat(self, key, value):
+        self._execute('HSET', f'{self.prefix}stats', key, json.dumps(value))
+
+    def get_stat(self, key):
+        value = self._execute('HGET', f'{self.prefix}stats', key)
+        return json.loads(value) if value is not None else None
+
+    def get_all_stats(self):
+        flat = self._execute('HGETALL', f'{self.prefix}stats') or []
+        return nest_stats({flat[i].decode('utf-8'): json.loads(flat[i + 1]) for i in range(0, len(flat), 2)})
+
+    def incr_stats(self, counts):
+        if counts:
+            self._pipeline([('HINCRBY', f'{self.prefix}stats', key, amount) for key, amount in counts.items()])
+
+    def clear_stats(self):
+        self._execute('DEL', f'{self.prefix}stats')
+
+    def get_stats_count(self):
+        return self._execute('HLEN', f'{self.prefix}stats')
+
+    def add_log(self, level, message):
+        self.add_logs([(datetime.now().isoformat(), level, message)])
+
+    def add_logs(self, rows):
+        if not rows:
+            return
+        # reserve a block of ids with one INCRBY, then push every row in one LPUSH
+        last_id = self._execute('INCRBY', f'{self.prefix}logs:id', len(rows))
+        first_id = last_id - len(rows) + 1
+        encoded = [json.dumps([first_id + i, timestamp, level, message])
+                   for i, (timestamp, level, message) in enumerate(rows)]
+        self._pipeline([('LPUSH', f'{self.prefix}logs', *encoded),
+                        ('LTRIM', f'{self.prefix}logs', 0, self.max_logs - 1)])
+
+    def get_logs(self, limit=100, offset=0, before=None, search=None, level=None, since=None, until=None):
+        if before is None and not (search or level or since or until):
+            rows = self._execute('LRANGE', f'{self.prefix}logs', offset, offset + limit - 1) or []
+            return [tuple(json.loads(row)) for row in rows]
+        # the list is capped at max_logs, filtering it client side stays cheap
+        rows = [tuple(json.loads(row)) for row in self._execute('LRANGE', f'{self.prefix}logs', 0, -1) or []]
+        return filter_logs(rows, before, search, level, since, until)[offset:offset + limit]
+
+    def clear_logs(self):
+        self._execute('DEL', f'{self.prefix}logs')
+
+    def get_logs_count(self):
+        return self._execute('LLEN', f'{self.prefix}logs')
+
+    def get_omdb_cache(self, key):
+        value = self._execute('GET', self._key('o', key))
+        return decode_value(value) if value is not None else None
+
+    def set_omdb_cache(self, key, value):
+        self._execute('SET', self._key('o', key), encode_value(value), 'PX', OMDB_CACHING_PERIOD * 1000)
+
+    def close(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+def default_db_path():
+    return '/tmp/cache.sqlite' if os.environ.get('VERCEL_ENV') else 'cache.sqlite'
+
+
+def create_cache(db_path=None, backend=None):
+    """ Build the backend named by CACHE_BACKEND (sqlite, memory or redis) """
+
+    backend = (backend or os.environ.get('CACHE_BACKEND', 'sqlite')).lower()
+    if backend == 'memory':
+        return MemoryCache()
+    if backend == 'redis':
+        return RedisCache()
+    if backend == 'sqlite':
+        from SQLiteCache import SqliteCache
+        return SqliteCache(db_path or default_db_path())
+    raise ValueError(f'Unknown cache backend: {backend}')
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+def get_cache():
+    """ The process-wide cache instance shared by every module """
+
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = create_cache()
+        return _shared_cache
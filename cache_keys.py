@@ -0,0 +1,99 @@
+"""
+    Canonical cache keys.
+
+    Requests for the same review can arrive with different provider spellings
+    (dove / dovefoundation, csm / commonsense), different title casing, or a
+    title instead of its IMDb ID. Everything is mapped to one key of the form
+    "<provider>:<imdb id>" (or "<provider>:<normalized title>" when the ID is
+    unknown) so equivalent requests share a single cache entry.
+"""
+
+import re
+import threading
+
+import provider_registry
+
+_IMDB_ID = re.compile(r'^tt\d+$')
+
+
+def canonical_provider(provider):
+    """ Map a provider name or alias to its canonical id, None if unknown """
+
+    registered = provider_registry.get(provider)
+    return registered.name if registered else None
+
+
+def normalize_title(video_name):
+    """ Lowercase, drop punctuation and collapse whitespace """
+
+    title = re.sub(r'[^\w\s]', '', (video_name or '').lower())
+    return ' '.join(title.split())
+
+
+def is_imdb_id(value):
+    return bool(value) and _IMDB_ID.match(str(value).strip().lower()) is not None
+
+
+def cache_key(provider, imdb_id=None, video_name=None):
+    if imdb_id:
+        return f"{provider}:{imdb_id.strip().lower()}"
+    return f"{provider}:{normalize_title(video_name)}"
+
+
+def title_alias(video_name, release_year=None):
+    return f"title:{normalize_title(video_name)}:{release_year or ''}"
+
+
+class KeyResolver:
+    """
+        Resolves titles to IMDb IDs through alias rows stored in the cache
+        and keeps counters of how many hits canonical keys produced that
+        the raw request key would have missed.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.canonical_hits = 0
+        self.title_resolutions = 0
+
+    def resolve_imdb_id(self, video_name, release_year=None):
+        """ IMDb ID previously seen for this title, None if unknown """
+
+        imdb_id = self.db.resolve_alias(title_alias(video_name, release_year))
+        if imdb_id:
+            with self._lock:
+                self.title_resolutions += 1
+        return imdb_id
+
+    def remember_title(self, video_name, release_year, imdb_id):
+        if not video_name or not is_imdb_id(imdb_id):
+            return
+        imdb_id = imdb_id.strip().lower()
+        self.db.set_alias(title_alias(video_name, release_year), imdb_id)
+        if release_year:
+            # a bare title keeps pointing at the first ID it resolved to
+            self.db.set_alias(title_alias(video_name), imdb_id, replace=False)
+
+    def record_lookup(self, raw_key, key, hit):
+        """ Count a cache lookup, raw_key is the key the request would have used before canonicalization """
+
+        with self._lock:
+            self.lookups += 1
+            if hit:
+                self.hits += 1
+                if raw_key.lower() != key:
+                    self.canonical_hits += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'canonical_hits': self.canonical_hits,
+                'title_resolutions': self.title_resolutions,
+                'hit_ratio': round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                'hit_ratio_gain': round(self.canonical_hits / self.lookups, 4) if self.lookups else 0.0,
+            }
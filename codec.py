@@ -0,0 +1,198 @@
+"""
+    Value encoding for cached blobs.
+
+    Every blob starts with a header byte: the low nibble names the
+    serializer and the high nibble the compression, so the format can
+    change without breaking rows written by older versions. Rows written
+    before the header existed are bare pickles; those always start with
+    the pickle PROTO opcode (0x80) and still decode.
+"""
+
+import itertools
+import json
+import os
+import pickle
+import threading
+import zlib
+from time import perf_counter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMAT_PICKLE = 0x01
+FORMAT_JSON = 0x02
+
+COMPRESS_NONE = 0x00
+COMPRESS_ZLIB = 0x10
+COMPRESS_ZSTD = 0x20
+
+_SERIALIZER_MASK = 0x0F
+_COMPRESSION_MASK = 0xF0
+_LEGACY_PICKLE = 0x80
+
+# one decode in this many is timed for the admin panel, timing every call costs more than a small unpickle
+DECODE_SAMPLE_EVERY = 64
+
+_formats = {'pickle': FORMAT_PICKLE, 'json': FORMAT_JSON}
+_compressions = {'none': COMPRESS_NONE, 'zlib': COMPRESS_ZLIB, 'zstd': COMPRESS_ZSTD}
+
+
+class CodecStats:
+    """ Process-wide counters for the admin panel """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.encoded = 0
+        self.compressed = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.decoded = 0
+        self.decode_seconds = 0.0
+
+    def record_encode(self, raw_size, stored_size, compressed):
+        with self._lock:
+            self.encoded += 1
+            self.compressed += compressed
+            self.raw_bytes += raw_size
+            self.stored_bytes += stored_size
+
+    def record_decode(self, seconds, count=1):
+        with self._lock:
+            self.decoded += count
+            self.decode_seconds += seconds * count
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'encoded': self.encoded,
+                'compressed': self.compressed,
+                'raw_bytes': self.raw_bytes,
+                'stored_bytes': self.stored_bytes,
+                'ratio': round(self.raw_bytes / self.stored_bytes, 2) if self.stored_bytes else 1.0,
+                'decoded': self.decoded,
+                'avg_decode_us': round(self.decode_seconds / self.decoded * 1e6, 2) if self.decoded else 0.0,
+            }
+
+
+stats = CodecStats()
+_decode_calls = itertools.count()
+_json_decode = json.JSONDecoder().decode
+
+
+def default_format():
+    return _formats.get(os.environ.get('CACHE_VALUE_FORMAT', 'json').lower(), FORMAT_JSON)
+
+
+def _is_json_native(value):
+    """ True if the value comes back from JSON unchanged (no tuples, sets, non-str keys, ...) """
+
+    kind = type(value)
+    if kind is dict:
+        return all(type(key) is str and _is_json_native(item) for key, item in value.items())
+    if kind is list:
+        return all(_is_json_native(item) for item in value)
+    return kind in (str, int, float, bool) or value is None
+
+
+def default_compression():
+    return _compressions.get(os.environ.get('CACHE_COMPRESSION', 'zlib').lower(), COMPRESS_ZLIB)
+
+
+def compress_threshold():
+    return int(os.environ.get('CACHE_COMPRESS_MIN_BYTES', 1024))
+
+
+def _compress(payload, compression):
+    if compression == COMPRESS_ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+    return zlib.compress(payload, 6)
+
+
+def _decompress(payload, compression):
+    if compression == COMPRESS_ZLIB:
+        return zlib.decompress(payload)
+    if compression == COMPRESS_ZSTD:
+        if zstandard is None:
+            raise ValueError('Cache value is zstd compressed but zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f'Unknown cache value compression: {compression:#04x}')
+
+
+def encode_value(value, fmt=None, compression=None):
+    """ Serialize a value into a header-prefixed blob, compressing large payloads """
+
+    fmt = fmt or default_format()
+    payload = None
+    if fmt == FORMAT_JSON and _is_json_native(value):
+        payload = json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    if payload is None:
+        # not representable in JSON, pickle keeps it lossless
+        fmt = FORMAT_PICKLE
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    raw_size = len(payload)
+    compression = default_compression() if compression is None else compression
+    if compression == COMPRESS_ZSTD and zstandard is None:
+        # zstandard is optional, fall back to zlib when it isn't installed
+        compression = COMPRESS_ZLIB
+    header = fmt
+    if compression != COMPRESS_NONE and raw_size >= compress_threshold():
+        packed = _compress(payload, compression)
+        # only keep the compressed form when it actually saves space
+        if len(packed) < raw_size:
+            payload = packed
+            header |= compression
+
+    stats.record_encode(raw_size, len(payload), header != fmt)
+    return bytes((header,)) + payload
+
+
+def uncompressed(blob):
+    """ The same value with its payload decompressed, for tiers that trade memory for decode time """
+
+    header = blob[0]
+    compression = header & _COMPRESSION_MASK
+    if header == _LEGACY_PICKLE or not compression:
+        return blob
+    return bytes((header & _SERIALIZER_MASK,)) + _decompress(memoryview(blob)[1:], compression)
+
+
+def _decode(blob, header):
+    # everything but the two plain pickle forms: compressed payloads, JSON, unknown headers
+    if header == _LEGACY_PICKLE:
+        return pickle.loads(blob)
+    payload = memoryview(blob)[1:]
+    compression = header & _COMPRESSION_MASK
+    if compression:
+        payload = _decompress(payload, compression)
+    fmt = header & _SERIALIZER_MASK
+    if fmt == FORMAT_PICKLE:
+        return pickle.loads(payload)
+    if fmt == FORMAT_JSON:
+        return _json_decode(str(payload, 'utf-8'))
+    raise ValueError(f'Unknown cache value format: {header:#04x}')
+
+
+def decode_value(blob):
+    """ Deserialize a blob written by encode_value or by the legacy pickle format """
+
+    if next(_decode_calls) % DECODE_SAMPLE_EVERY == 0:
+        started = perf_counter()
+        value = _decode(blob, blob[0])
+        stats.record_decode(perf_counter() - started, DECODE_SAMPLE_EVERY)
+        return value
+    # hot path: one branch on the header byte, then straight into the deserializer
+    header = blob[0]
+    if header == FORMAT_PICKLE:
+        # a bytes slice beats a memoryview for blobs this small
+        return pickle.loads(blob[1:])
+    if header == FORMAT_JSON:
+        return _json_decode(str(blob[1:], 'utf-8'))
+    if header == _LEGACY_PICKLE:
+        return pickle.loads(blob)
+    return _decode(blob, header)
@@ -2,6 +2,7 @@ import requests
 from bs4 import BeautifulSoup
 import re
 import json
+from provider_registry import register
 
 
 def CommonSenseScrapper(ID, videoName):
@@ -106,3 +107,7 @@ def CommonSenseScrapper(ID, videoName):
 
 
     return Review
+
+
+register('commonsense', lambda imdb_id, video_name, release_year: CommonSenseScrapper(imdb_id, video_name),
+         aliases=('commonsensemedia', 'csm'), negative_ttl=3 * 24 * 60 * 60)
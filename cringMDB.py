@@ -2,6 +2,7 @@ import requests
 from bs4 import BeautifulSoup
 import re
 import json
+from provider_registry import register
 
 def cringMDBScraper(ID,videoName):
     Session = requests.Session()
@@ -71,3 +72,7 @@ def cringMDBScraper(ID,videoName):
             "review-link": None
                 }
     return show_info
+
+
+register('cringmdb', lambda imdb_id, video_name, release_year: cringMDBScraper(imdb_id, video_name),
+         aliases=('cring', 'cringemdb'), negative_ttl=3 * 24 * 60 * 60)
@@ -3,16 +3,13 @@ from bs4 import BeautifulSoup
 import re
 from difflib import SequenceMatcher
 import os
+import omdb
+from provider_registry import register
 def getIMDBID(name):
-    omdb_api_key = os.environ.get('OMDB_API_KEY')
-    url = f"http://www.omdbapi.com/?t={name.strip()}&apikey={omdb_api_key}&plot=full&r=json"
-    res = requests.get(url).json()
-
-    if res.get("Response") != 'False':
-        return res.get("imdbID")
-    else:
+    imdb_id = omdb.get_client().imdb_id_for_title(name)
+    if not imdb_id:
         print("Couldn't find IMDB ID")
-        return None
+    return imdb_id
 
 def getDesc(soup, s):
     descs = soup.findAll("h5", {"class": "details-title"})
@@ -98,3 +95,7 @@ def create_failed_review(videoName):
         "review-items": None,
         "review-link": None
     }
+
+
+register('dove', lambda imdb_id, video_name, release_year: DoveFoundationScrapper(video_name),
+         aliases=('dovefoundation',), negative_ttl=3 * 24 * 60 * 60)
@@ -0,0 +1,110 @@
+"""
+    Multi-provider lookups for /get_all.
+
+    All providers of a title are looked up in one cache batch. The misses
+    are scraped at the same time, each on its provider's own pool, and
+    results are yielded as they arrive, so a caller waits about as long as
+    the slowest provider it asked for, not the sum of all of them. Every
+    provider has its own time budget (its registered timeout, optionally
+    capped by the request). A scrape that overruns it is reported as a
+    timeout but keeps running, and its result is still cached when it
+    finishes.
+"""
+
+import logging
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from cache_keys import cache_key, is_imdb_id
+from metrics import CACHE_LOOKUPS
+from providers import get_provider, is_cacheable, store_result, submit_to_provider
+
+logger = logging.getLogger(__name__)
+
+# status of a provider's answer in the stream
+CACHED, STALE, FRESH, NOT_FOUND, TIMEOUT, ERROR = 'cached', 'stale', 'fresh', 'not_found', 'timeout', 'error'
+
+
+def store_finished(db, key_resolver, provider, key, imdb_id, video_name, release_year, future):
+    """ Cache a finished scrape like get_data does, runs on the scraper's worker thread """
+
+    if future.cancelled() or future.exception() is not None:
+        return
+    result = future.result()
+    try:
+        # title-only requests are stored under the IMDb ID the provider found
+        if is_cacheable(result) and not imdb_id and is_imdb_id(result.get('id')):
+            key_resolver.remember_title(video_name, release_year, result['id'])
+            key = cache_key(provider, result['id'])
+        store_result(db, key, provider, result)
+    except Exception as e:
+        logger.error(f"Could not cache {provider} result for {key}: {e}")
+
+
+def fan_out(db, key_resolver, providers, imdb_id, video_name, release_year, budget=None, revalidate=None,
+            resolve_title=None):
+    """ Yield (provider, status, result, error) for every provider as soon as it is known
+
+        Cached answers come first, from one batched read. Expired entries
+        still inside the stale grace are served as STALE and handed to
+        revalidate(key, provider, result) when given. Misses are scraped
+        concurrently and yielded in the order they finish; scrapers that
+        need a title get resolve_title() when the request had only an ID.
+    """
+
+    keys = {provider: cache_key(provider, imdb_id, video_name) for provider in providers}
+    # one read for live and stale entries, one for the known misses among the rest
+    cached = db.get_many_with_stale(keys.values())
+    negative = db.are_negative([key for key in keys.values() if key.lower() not in cached])
+    started = time.monotonic()
+    pending = {}
+    for provider in providers:
+        key = keys[provider]
+        result, is_stale = cached.get(key.lower(), (None, False))
+        if result is not None:
+            CACHE_LOOKUPS.inc(provider, 'stale' if is_stale else 'hit')
+            if is_stale and revalidate is not None:
+                revalidate(key, provider, result)
+            yield provider, STALE if is_stale else CACHED, result, None
+            continue
+        if key.lower() in negative:
+            CACHE_LOOKUPS.inc(provider, 'negative')
+            yield provider, NOT_FOUND, None, None
+            continue
+
+        CACHE_LOOKUPS.inc(provider, 'miss')
+        if not video_name and resolve_title is not None:
+            # only looked up once something actually has to be scraped, and only once
+            video_name, resolve_title = resolve_title(), (lambda: None)
+            if not video_name:
+                yield provider, ERROR, None, "Could not retrieve video name from OMDB"
+                continue
+
+        timeout = get_provider(provider).timeout
+        if budget:
+            timeout = min(timeout, budget)
+        future = submit_to_provider(provider, imdb_id, video_name, release_year)
+        future.add_done_callback(lambda f, provider=provider, key=key: store_finished(
+            db, key_resolver, provider, key, imdb_id, video_name, release_year, f))
+        pending[future] = (provider, started + timeout)
+
+    while pending:
+        next_deadline = min(deadline for _, deadline in pending.values())
+        done, _ = wait(pending, timeout=max(0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        for future in done:
+            provider, _ = pending.pop(future)
+            error = future.exception()
+            if error is not None:
+                logger.error(f"{provider} scrape failed in fan-out: {error}")
+                yield provider, ERROR, None, str(error)
+            elif is_cacheable(future.result()):
+                yield provider, FRESH, future.result(), None
+            else:
+                yield provider, NOT_FOUND, None, None
+        now = time.monotonic()
+        for future, (provider, deadline) in list(pending.items()):
+            if deadline <= now:
+                del pending[future]
+                # only drops it if it is still queued, a running scrape finishes and is cached
+                future.cancel()
+                yield provider, TIMEOUT, None, f"{provider} did not answer within {deadline - started:g}s"
@@ -0,0 +1,94 @@
+"""
+    Country lookups for the request stats.
+
+    The GeoLite2 reader is opened on the first lookup, memory-mapped so the
+    database is paged in by the OS instead of read into the heap, and a
+    missing file only means every country is "Unknown". Lookups go through
+    a bounded LRU keyed by IP, so a repeat client costs one dict lookup.
+
+    X-Forwarded-For is ignored by default, any client can send one. Behind
+    a reverse proxy or a platform like Vercel set GEOIP_PROXY_HOPS to the
+    number of proxies in front of the app (usually 1).
+"""
+
+import ipaddress
+import logging
+import os
+import threading
+from functools import lru_cache
+
+import geoip2.database
+import geoip2.errors
+
+logger = logging.getLogger(__name__)
+
+GEOIP_DB_PATH = os.environ.get('GEOIP_DB_PATH', 'GeoLite2-Country.mmdb')
+GEOIP_CACHE_SIZE = int(os.environ.get('GEOIP_CACHE_SIZE', 4096))
+# Proxies in front of the app that append to X-Forwarded-For, 0 ignores the header
+PROXY_HOPS = int(os.environ.get('GEOIP_PROXY_HOPS', 0))
+
+_reader = None
+_reader_failed = False
+_reader_lock = threading.Lock()
+
+
+def get_reader():
+    """ The shared reader, opened on first use, None if the database can't be opened """
+
+    global _reader, _reader_failed
+    if _reader is None and not _reader_failed:
+        with _reader_lock:
+            if _reader is None and not _reader_failed:
+                try:
+                    _reader = geoip2.database.Reader(GEOIP_DB_PATH, mode=geoip2.database.MODE_MMAP)
+                except (OSError, ValueError) as e:
+                    _reader_failed = True
+                    logger.warning(f"GeoIP database {GEOIP_DB_PATH} could not be opened, countries will be Unknown: {e}")
+    return _reader
+
+
+@lru_cache(maxsize=GEOIP_CACHE_SIZE)
+def country_for_ip(ip):
+    try:
+        # Check if the IP is a private address
+        if ipaddress.ip_address(ip).is_private:
+            return "Private IP"
+    except ValueError:
+        return "Invalid IP"
+
+    reader = get_reader()
+    if reader is None:
+        return "Unknown"
+    try:
+        return reader.country(ip).country.name or "Unknown"
+    except geoip2.errors.AddressNotFoundError:
+        return "Unknown"
+
+
+def client_ip(remote_addr, forwarded_for=None, hops=None):
+    """ The address of the client behind `hops` trusted proxies
+
+        Each proxy appends the address it received the request from, so
+        the client is the hops-th entry from the right. Entries further
+        left are client supplied and not trusted.
+    """
+
+    if hops is None:
+        hops = PROXY_HOPS
+    if forwarded_for and hops > 0:
+        addresses = [address.strip() for address in forwarded_for.split(',') if address.strip()]
+        if addresses:
+            return addresses[-min(hops, len(addresses))]
+    return remote_addr
+
+
+def get_country(remote_addr, forwarded_for=None):
+    return country_for_ip(client_ip(remote_addr, forwarded_for))
+
+
+def close():
+    global _reader
+    with _reader_lock:
+        if _reader is not None:
+            _reader.close()
+            _reader = None
@@ -11,6 +11,9 @@ import time
 import os
 import traceback
 
+from metrics import UPSTREAM_RESPONSES, UPSTREAM_RETRIES
+from provider_registry import register
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -37,9 +40,9 @@ USER_AGENTS = {
 }
 
 def get_scenes(section):
-    logger.info(f"Getting scenes from section: {section.get('id', 'Unknown section')}")
+    logger.debug("Getting scenes from section: %s", section.get('id', 'Unknown section'))
     scenes_raw = section.find_all('li', class_='ipc-zebra-list__item')
-    logger.info(f"Found {len(scenes_raw)} raw scenes")
+    logger.debug("Found %d raw scenes", len(scenes_raw))
     scenes = []
     for scene in scenes_raw:
         # Exclude voting elements
@@ -47,12 +50,12 @@ def get_scenes(section):
             scene_text = scene.text.strip()
             scene_text = scene_text.replace('Edit', '').strip()
             scenes.append(scene_text)
-    logger.info(f"Processed {len(scenes)} scenes")
+    logger.debug("Processed %d scenes", len(scenes))
     return scenes
 
 @lru_cache(maxsize=128)
 def get_cat(section):
-    logger.info(f"Getting category for section: {section.get('id', 'Unknown section')}")
+    logger.debug("Getting category for section: %s", section.get('id', 'Unknown section'))
     vote_container = section.find(class_='advisory-severity-vote__container')
     
     if not vote_container:
@@ -65,7 +68,7 @@ def get_cat(section):
         return None, None, None, None
     
     cat = span.text
-    logger.info(f"Found category: {cat}")
+    logger.debug("Found category: %s", cat)
     
     a_tag = vote_container.find('a', class_='advisory-severity-vote__message')
     if not a_tag:
@@ -82,30 +85,37 @@ def get_cat(section):
     vote = int(m[1].replace(',', ''))
     outof = int(m[2].replace(',', ''))
     percent = round((vote/outof) * 100)
-    logger.info(f"Parsed vote: {vote} of {outof} ({percent}%)")
+    logger.debug("Parsed vote: %s of %s (%s%%)", vote, outof, percent)
     return cat, vote, outof, percent
 
 def get_episode_info(soup):
-    logger.info("Getting episode info")
+    logger.debug("Getting episode info")
     episode_info = soup.find("div", class_="episode-info")
     if episode_info:
         episode_title = episode_info.find("h3").text.strip()
         episode_number = episode_info.find("div", class_="ipc-metadata-list-item__content-container").text.strip()
-        logger.info(f"Found episode info: {episode_title} ({episode_number})")
+        logger.debug("Found episode info: %s (%s)", episode_title, episode_number)
         return f"{episode_title} ({episode_number})"
-    logger.info("No episode info found")
+    logger.debug("No episode info found")
     return None
 
 def fetch_url(url, max_retries=5):
     for attempt in range(max_retries):
+        status = None
+        if attempt:
+            UPSTREAM_RETRIES.inc('imdb')
         try:
             impersonate_option = random.choice(IMPERSONATE_OPTIONS)
             user_agent = USER_AGENTS[impersonate_option]
             
             response = session.get(url, impersonate=impersonate_option)
+            status = response.status_code
+            UPSTREAM_RESPONSES.inc('imdb', str(status))
             response.raise_for_status()
             return response.text
         except requests.RequestsError as e:
+            if status is None:
+                UPSTREAM_RESPONSES.inc('imdb', 'error')
             if "impersonate" in str(e):
                 logger.warning(f"Impersonation failed for {impersonate_option}, falling back to standard request")
                 try:
@@ -153,10 +163,10 @@ def imdb_parentsguide(tid, videoName):
 
     try:
         if new_structure and not old_structure:
-            logger.info("Processing new page structure")
+            logger.debug("Processing new page structure")
             return process_new_structure(soup, tid, videoName, pg_url)
         elif old_structure and not new_structure:
-            logger.info("Processing old page structure")
+            logger.debug("Processing old page structure")
             return process_old_structure(soup, tid, videoName, pg_url)
         else:
             logger.warning("Unclear page structure, defaulting to old structure")
@@ -176,7 +186,7 @@ def imdb_parentsguide(tid, videoName):
         }
 
 def process_new_structure(soup, tid, videoName, pg_url):
-    logger.info("Processing new page structure")
+    logger.debug("Processing new page structure")
     
     # Find the script tag containing the JSON data
     script_tag = soup.find('script', {'id': '__NEXT_DATA__', 'type': 'application/json'})
@@ -276,7 +286,7 @@ def create_error_result(tid, videoName, pg_url):
     }
 
 def process_old_structure(soup, tid, videoName, pg_url):
-    logger.info("Processing old page structure")
+    logger.debug("Processing old page structure")
     
     main_content = soup.find("div", id="main")
     if not main_content:
@@ -377,4 +387,10 @@ def clean_text(text):
     text = re.sub(r'<[^>]+>', '', text)
     # Remove extra whitespace and newline characters
     text = re.sub(r'\s+', ' ', text).strip()
-    return text
\ No newline at end of file
+    return text
+
+
+# up to five attempts with 1+2+4+8s backoff in fetch_url, give it room
+register('imdb', lambda imdb_id, video_name, release_year: imdb_parentsguide(imdb_id, video_name),
+         negative_ttl=6 * 60 * 60,  # IMDb covers almost everything, misses are usually transient
+         concurrency=4, timeout=60)
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, render_template_string, Response, render_template, redirect, url_for, session
+from flask import Flask, request, jsonify, render_template_string, Response, render_template, redirect, url_for, session, g, stream_with_context
 from bs4 import BeautifulSoup
 import requests
 import json
@@ -6,21 +6,25 @@ import re
 import time
 from datetime import datetime
 import logging
-import imdb
-from kidsinmind import KidsInMindScraper
-import dove
-import parentpreviews
-import cringMDB
-import commonsensemedia
-import movieguide
-from SQLiteCache import SqliteCache
+from providers import PROVIDERS, fetch_from_provider, is_cacheable, miss_ttl, ttl, ProviderTimeout
+from fanout import fan_out, store_finished, STALE, FRESH
+from cache_backends import get_cache
+import codec
+import metrics
+from cache_keys import KeyResolver, canonical_provider, cache_key, is_imdb_id
+from revalidate import Revalidator
+from stats_aggregator import StatsAggregator
+from log_sink import QueuedDatabaseHandler
+import omdb
+from title_index import get_index as get_title_index
+import request_log
+from request_log import SamplingFilter, log_event, log_payload
 from waitress import serve
 from paste.translogger import TransLogger
 import traceback
 from collections import defaultdict
 import sqlite3
-import geoip2.database
-import ipaddress
+import geoip
 import atexit
 import os
 import threading
@@ -31,27 +35,27 @@ from functools import wraps
 # Create the Flask app instance
 app = Flask(__name__)
 
-# Set up logging to use the database
-class DatabaseHandler(logging.Handler):
-    def __init__(self, db):
-        super().__init__()
-        self.db = db
-
-    def emit(self, record):
-        self.db.add_log(record.levelname, self.format(record))
-
-# Initialize the SqliteCache
-db_path = '/tmp/cache.sqlite' if os.environ.get('VERCEL_ENV') else 'cache.sqlite'
-db = SqliteCache(db_path)
+# Initialize the shared cache backend (SqliteCache unless CACHE_BACKEND says otherwise)
+db = get_cache()
 db.ensure_omdb_cache_table()  # Add this line
-
-# Set up the logger to use the database handler
+db.start_sweeper()
+key_resolver = KeyResolver(db)
+revalidator = Revalidator()
+stats_aggregator = StatsAggregator(db)
+omdb_client = omdb.get_client()
+title_index = get_title_index()
+
+# Set up the logger to write to the logs table from a background thread
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-db_handler = DatabaseHandler(db)
+db_handler = QueuedDatabaseHandler(db)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 db_handler.setFormatter(formatter)
 logger.addHandler(db_handler)
+# Drop a share of chatty INFO/DEBUG lines before they are formatted (LOG_SAMPLE_RATES)
+log_sampler = SamplingFilter()
+for handler in logger.handlers:
+    handler.addFilter(log_sampler)
 
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'default_secret_key')
 
@@ -91,8 +95,9 @@ def admin_panel():
         'stats': db.get_stats_count(),
         'cache': db.get_cached_records_count()
     }
+    l1_stats = db.get_l1_stats()
     message = request.args.get('message')
-    return render_template('admin_panel.html', api_status=api_status, env_vars=env_vars, record_counts=record_counts, message=message)
+    return render_template('admin_panel.html', api_status=api_status, env_vars=env_vars, record_counts=record_counts, l1_stats=l1_stats, last_sweep=db.last_sweep, key_stats=key_resolver.stats(), codec_stats=codec.stats.snapshot(), log_stats=db_handler.stats(), message=message)
 
 @app.route('/admin/clear_logs')
 @admin_required
@@ -119,169 +124,101 @@ def update_env():
     os.environ['OMDB_API_KEY'] = omdb_api_key
     return redirect(url_for('admin_panel', message='Environment variables updated successfully'))
 
-# Update the update_stats function
 def update_stats(is_cached, sex_nudity_category, country):
-    stats = db.get_all_stats()
-    current_year = datetime.now().year
-    current_month = datetime.now().strftime('%Y-%m')
-    current_day = datetime.now().strftime('%Y-%m-%d')
-
-    # Initialize stats if they don't exist
-    stats['total_hits'] = stats.get('total_hits', 0) + 1
-    stats['cached_hits'] = stats.get('cached_hits', 0)
-    stats['fresh_hits'] = stats.get('fresh_hits', 0)
+    """ Count a served request, written to the stats tables in batches by stats_aggregator """
 
-    if is_cached:
-        stats['cached_hits'] += 1
-    else:
-        stats['fresh_hits'] += 1
-
-    # Update This Year's Statistics
-    hits_by_year = stats.get('hits_by_year', {})
-    hits_by_year[str(current_year)] = hits_by_year.get(str(current_year), 0) + 1
-    stats['hits_by_year'] = hits_by_year
-
-    # Update This Month's Statistics
-    hits_by_month = stats.get('hits_by_month', {})
-    hits_by_month[current_month] = hits_by_month.get(current_month, 0) + 1
-    stats['hits_by_month'] = hits_by_month
+    minute = datetime.now().strftime('%Y-%m-%d %H:%M')
+    counts = {'total_hits': 1, 'cached_hits' if is_cached else 'fresh_hits': 1}
+    series = {
+        (minute, 'hits', 'total'): 1,
+        (minute, 'hits', 'cached' if is_cached else 'fresh'): 1,
+    }
+    if sex_nudity_category:
+        series[(minute, 'sex_nudity', sex_nudity_category)] = 1
+    if country:
+        series[(minute, 'country', country)] = 1
+    stats_aggregator.incr(counts, series)
 
-    # Update daily hits
-    hits_by_day = stats.get('hits_by_day', {})
-    hits_by_day[current_day] = hits_by_day.get(current_day, 0) + 1
-    stats['hits_by_day'] = hits_by_day
+def get_country_from_request():
+    """ Country of the client, behind a proxy the address comes from X-Forwarded-For """
 
-    # Update Sex & Nudity Categories
-    if sex_nudity_category:
-        sex_nudity_categories = stats.get('sex_nudity_categories', {})
-        sex_nudity_categories[sex_nudity_category] = sex_nudity_categories.get(sex_nudity_category, 0) + 1
-        stats['sex_nudity_categories'] = sex_nudity_categories
+    return geoip.get_country(request.remote_addr, request.headers.get('X-Forwarded-For'))
 
-    # Update Countries Using the API
-    if country:
-        countries = stats.get('countries', {})
-        countries[country] = countries.get(country, 0) + 1
-        stats['countries'] = countries
+# The reader is opened lazily on the first lookup, close it when the app exits
+atexit.register(geoip.close)
 
-    # Save all stats
-    for key, value in stats.items():
-        db.set_stat(key, value)
+def remember_miss(key, provider, result=None):
+    db.set_negative(key, miss_ttl(provider, result))
 
-    # Log the updated stats for debugging
-    logger.info(f"Updated stats: Total Hits: {stats['total_hits']}, Cached Hits: {stats['cached_hits']}, Fresh Hits: {stats['fresh_hits']}")
+def refresh_entry(key, provider, imdb_id, video_name, release_year):
+    """ Re-scrape a stale entry, returns True if the cache was updated """
 
-# Initialize the GeoIP reader
-geoip_reader = geoip2.database.Reader('GeoLite2-Country.mmdb')
+    result = fetch_from_provider(provider, imdb_id, video_name, release_year)
+    if not is_cacheable(result):
+        return False
+    db.set(key, result, timeout=ttl(provider))
+    return True
 
-def get_country_from_ip(ip):
-    try:
-        # Check if the IP is a private address
-        if ipaddress.ip_address(ip).is_private:
-            return "Private IP"
-        
-        # Look up the IP
-        response = geoip_reader.country(ip)
-        return response.country.name or "Unknown"
-    except geoip2.errors.AddressNotFoundError:
-        return "Unknown"
-    except ValueError:
-        return "Invalid IP"
-
-# Don't forget to close the reader when your application exits
-# You can do this in your main block or use atexit to ensure it's called
-atexit.register(geoip_reader.close)
-
-# Add this function to get movie/TV show name from OMDB API
-def get_title_from_omdb(imdb_id):
-    omdb_api_key = os.environ.get('OMDB_API_KEY')
-    if not omdb_api_key:
-        app.logger.error("OMDB API key not found in environment variables")
-        return None
-
-    cache_key = f"omdb_title_{imdb_id}"
-    cached_data = db.get_omdb_cache(cache_key)
-    if cached_data:
-        app.logger.info(f"Retrieved title for {imdb_id} from OMDB cache")
-        return cached_data.get('Title')
-
-    url = f"http://www.omdbapi.com/?i={imdb_id}&apikey={omdb_api_key}"
-    
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-        
-        if data.get('Response') == 'True':
-            db.set_omdb_cache(cache_key, data)
-            return data.get('Title')
-        else:
-            app.logger.warning(f"No title found for IMDb ID: {imdb_id}")
-            return None
-    except requests.RequestException as e:
-        app.logger.error(f"Error fetching data from OMDB: {str(e)}")
-        return None
-
-def get_imdb_id_from_omdb(video_name, release_year=None):
-    omdb_api_key = os.environ.get('OMDB_API_KEY')
-    if not omdb_api_key:
-        app.logger.error("OMDB API key not found in environment variables")
-        return None
-
-    cache_key = f"omdb_id_{video_name}_{release_year}"
-    cached_data = db.get_omdb_cache(cache_key)
-    if cached_data:
-        app.logger.info(f"Retrieved data for {video_name} ({release_year}) from OMDB cache")
-        return cached_data
-
-    url = f"http://www.omdbapi.com/?t={video_name}&y={release_year}&apikey={omdb_api_key}"
-    
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-        
-        if data.get('Response') == 'True':
-            db.set_omdb_cache(cache_key, data)
-            return data
-        else:
-            app.logger.warning(f"No IMDB data found for: {video_name}")
-            return None
-    except requests.RequestException as e:
-        app.logger.error(f"Error fetching data from OMDB: {str(e)}")
-        return None
+def resolve_imdb_id(video_name, release_year):
+    """ IMDb ID and release year of a title: a known title alias first, then the offline title index, then OMDB """
+
+    imdb_id = key_resolver.resolve_imdb_id(video_name, release_year)
+    if imdb_id:
+        app.logger.debug("Resolved IMDB ID from title alias: %s", imdb_id)
+        return imdb_id, release_year
+    imdb_id, index_year = title_index.lookup(video_name, release_year)
+    if imdb_id:
+        app.logger.debug("Resolved IMDB ID from the title index: %s", imdb_id)
+        return imdb_id, release_year or index_year
+    omdb_data = omdb_client.by_title(video_name, release_year)
+    if omdb_data:
+        imdb_id = omdb_data.get('imdbID')
+        key_resolver.remember_title(video_name, release_year, imdb_id)
+        if not release_year:
+            release_year = omdb_data.get('Year')
+    app.logger.debug("Retrieved IMDB ID from OMDB: %s, Release Year: %s", imdb_id, release_year)
+    return imdb_id, release_year
+
+def sex_nudity_category_of(result):
+    return next((item.get('cat') for item in result.get('review-items') or [] if item.get('name') == 'Sex & Nudity'), None)
 
 @app.route('/get_data', methods=['GET'])
 def get_data():
     try:
-        app.logger.info("Received request for /get_data")
         starttime = time.time()
 
         # Get parameters from the query string
         imdb_id = request.args.get('imdb_id')
         video_name = request.args.get('video_name', '').replace("+"," ").replace("%20"," ").replace(":","").replace("%3A", "")
         release_year = request.args.get('release_year')
-        provider = request.args.get('provider', '').lower()
+        raw_provider = request.args.get('provider', '').lower()
 
-        app.logger.info(f"Request parameters: imdb_id={imdb_id}, video_name={video_name}, release_year={release_year}, provider={provider}")
+        app.logger.debug("Request parameters: imdb_id=%s, video_name=%s, release_year=%s, provider=%s",
+                         imdb_id, video_name, release_year, raw_provider)
+        g.log_fields = {'provider': raw_provider, 'imdb_id': imdb_id, 'title': video_name or None}
 
-        if not provider:
+        if not raw_provider:
             return jsonify({"error": "Provider parameter is required"}), 400
 
-        # If IMDB ID is not provided, try to get it from OMDB
+        # Map provider aliases (csm, dovefoundation, ...) to one provider id
+        provider = canonical_provider(raw_provider)
+        if not provider:
+            return jsonify({"error": f"Unknown provider: {raw_provider}"}), 400
+        g.log_fields['provider'] = provider
+
         if not imdb_id and video_name:
-            omdb_data = get_imdb_id_from_omdb(video_name, release_year)
-            if omdb_data:
-                imdb_id = omdb_data.get('imdbID')
-                if not release_year:
-                    release_year = omdb_data.get('Year')
-            app.logger.info(f"Retrieved IMDB ID from OMDB: {imdb_id}, Release Year: {release_year}")
+            imdb_id, release_year = resolve_imdb_id(video_name, release_year)
+            g.log_fields['imdb_id'] = imdb_id
 
-        key = f"{provider}:{imdb_id or video_name}"
-        cached_result = db.get(key)
+        key = cache_key(provider, imdb_id, video_name)
+        g.log_fields['key'] = key
+        cached_result, is_stale = db.get_with_stale(key)
+        key_resolver.record_lookup(f"{raw_provider}:{imdb_id or video_name}", key, cached_result is not None)
 
         if cached_result:
-            app.logger.info(f"Cached result structure: {json.dumps(cached_result, indent=2)}")
-            app.logger.info(f"Returning cached result for {cached_result.get('title', 'Unknown title')} from {provider}")
+            metrics.CACHE_LOOKUPS.inc(provider, 'stale' if is_stale else 'hit')
+            g.log_fields['cache'] = 'stale' if is_stale else 'hit'
+            log_payload(app.logger, "Cached result structure", cached_result)
             
             # Check if review-items exist and are not empty
             review_items = cached_result.get('review-items')
@@ -292,47 +229,39 @@ def get_data():
                 sex_nudity_category = next((item.get('cat') for item in review_items if item.get('name') == 'Sex & Nudity'), None)
             
             # Get country from IP
-            ip_address = request.remote_addr
-            country = get_country_from_ip(ip_address)
+            country = get_country_from_request()
 
             # When calling update_stats, include the country
             update_stats(True, sex_nudity_category, country)
+
+            # Expired but inside the grace window: answer now, refresh in the background
+            if is_stale:
+                app.logger.debug("Serving stale result for %s, scheduling refresh", key)
+                refresh_name = video_name or cached_result.get('title')
+                revalidator.schedule(key, lambda: refresh_entry(key, provider, imdb_id, refresh_name, release_year))
+
             cached_result['is_cached'] = True
+            cached_result['stale'] = is_stale
             return jsonify(cached_result)
-        
+
+        # Titles this provider recently had nothing for are answered without scraping
+        if db.is_negative(key):
+            metrics.CACHE_LOOKUPS.inc(provider, 'negative')
+            g.log_fields['cache'] = 'negative'
+            return jsonify({"error": "No data found"}), 404
+
+        metrics.CACHE_LOOKUPS.inc(provider, 'miss')
+        g.log_fields['cache'] = 'miss'
+
         # Get video name from OMDB if not provided
         if not video_name:
-            video_name = get_title_from_omdb(imdb_id)
+            video_name = omdb_client.title_for_id(imdb_id)
             if not video_name:
                 return jsonify({"error": "Could not retrieve video name from OMDB"}), 400
         
-        app.logger.info(f"Fetching fresh data for {video_name or imdb_id} from {provider}")
+        app.logger.debug("Fetching fresh data for %s from %s", video_name or imdb_id, provider)
         
-        # Provider-specific logic
-        if "imdb" in provider:
-            result = imdb.imdb_parentsguide(imdb_id, video_name)
-        elif "kidsinmind" in provider:
-            result = KidsInMindScraper(imdb_id, video_name, release_year)
-        elif "dove" in provider:
-            result = dove.DoveFoundationScrapper(video_name)
-        elif "dovefoundation" in provider:
-            result = dove.DoveFoundationScrapper(video_name)
-        elif "parentpreview" in provider:
-            result = parentpreviews.ParentPreviewsScraper(imdb_id, video_name)
-        elif "parentpreviews" in provider:
-            result = parentpreviews.ParentPreviewsScraper(imdb_id, video_name)
-        elif "cring" in provider:
-            result = cringMDB.cringMDBScraper(imdb_id, video_name)
-        elif "commonsense" in provider:
-            result = commonsensemedia.CommonSenseScrapper(imdb_id, video_name)
-        elif "csm" in provider:
-            result = commonsensemedia.CommonSenseScrapper(imdb_id, video_name)
-        elif "movieguide" in provider:
-            result = movieguide.MovieGuideOrgScrapper(imdb_id, video_name)
-        elif "movieguideorg" in provider:
-            result = movieguide.MovieGuideOrgScrapper(imdb_id, video_name)
-        else:
-            return jsonify({"error": f"Unknown provider: {provider}"}), 400
+        result = fetch_from_provider(provider, imdb_id, video_name, release_year)
 
         if result:
             if not isinstance(result, dict):
@@ -346,37 +275,160 @@ def get_data():
             # Check if review-items exist and are not empty
             review_items = result.get('review-items')
             if not review_items:
-                app.logger.warning(f"No review items found for {video_name or imdb_id} from {provider}")
-                sex_nudity_category = None
-            else:
-                sex_nudity_category = next((item.get('cat') for item in review_items if item.get('name') == 'Sex & Nudity'), None)
+                # answered exactly like the negative cache will answer the next request
+                app.logger.warning(f"No review items found for {video_name or imdb_id} from {provider} "
+                                   f"(status {result.get('status')})")
+                g.log_fields['stored'] = False
+                remember_miss(key, provider, result)
+                return jsonify({"error": "No data found"}), 404
+
+            sex_nudity_category = next((item.get('cat') for item in review_items if item.get('name') == 'Sex & Nudity'), None)
             
             # Get country from IP
-            ip_address = request.remote_addr
-            country = get_country_from_ip(ip_address)
+            country = get_country_from_request()
 
             # When calling update_stats, include the country
             update_stats(False, sex_nudity_category, country)
             
-            # Only store in cache if review-items are not null
-            if review_items:
-                app.logger.info(f"Storing result in cache for {result['title']} from {provider}")
-                app.logger.info(f"Storing result in cache: {json.dumps(result, indent=2)}")
-                db.set(key, result)
-            else:
-                app.logger.info(f"Not storing result in cache due to null review-items for {result['title']} from {provider}")
+            # Title-only requests are stored under the IMDb ID the provider found
+            if not imdb_id and is_imdb_id(result.get('id')):
+                key_resolver.remember_title(video_name, release_year, result['id'])
+                key = cache_key(provider, result['id'])
+
+            g.log_fields['stored'] = True
+            log_payload(app.logger, "Storing result in cache", result)
+            db.set(key, result, timeout=ttl(provider))
+            db.delete_negative(key)
             
             result['is_cached'] = False
+            result['stale'] = False
             return jsonify(result)
         else:
-            app.logger.info(f"No data found for {video_name or imdb_id} from {provider}")
+            g.log_fields['stored'] = False
+            remember_miss(key, provider)
             return jsonify({"error": "No data found"}), 404
 
+    except ProviderTimeout as e:
+        app.logger.warning(f"Timed out in get_data: {e}")
+        if e.future is not None:
+            # the scrape keeps running, cache what it finds for the next request like /get_all does
+            e.future.add_done_callback(lambda f: store_finished(
+                db, key_resolver, provider, key, imdb_id, video_name, release_year, f))
+        return jsonify({"error": str(e)}), 504
     except Exception as e:
         app.logger.error(f"Error in get_data: {str(e)}")
         app.logger.error(f"Error traceback: {traceback.format_exc()}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/get_all', methods=['GET'])
+def get_all():
+    """ Every provider's review of a title, streamed as each provider answers
+
+        Cached providers come back from one batched cache read, the rest are
+        scraped concurrently on their own pools, each within its own timeout
+        (capped by the optional `timeout` parameter). The response is NDJSON,
+        or Server-Sent Events with format=sse or Accept: text/event-stream.
+        Every line/event is {"provider", "status", "data", "error", "ms"}
+        with status cached, stale, fresh, not_found, timeout or error, and
+        the stream ends with a {"done": true, "status": "ok" or "error", ...}
+        summary.
+    """
+
+    imdb_id = request.args.get('imdb_id')
+    video_name = request.args.get('video_name', '').replace("+"," ").replace("%20"," ").replace(":","").replace("%3A", "")
+    release_year = request.args.get('release_year')
+    raw_providers = request.args.get('providers', '')
+    budget = request.args.get('timeout', type=float)
+    sse = request.args.get('format') == 'sse' or 'text/event-stream' in request.headers.get('Accept', '')
+    g.log_fields = {'provider': raw_providers or 'all', 'imdb_id': imdb_id, 'title': video_name or None}
+
+    if not imdb_id and not video_name:
+        return jsonify({"error": "imdb_id or video_name parameter is required"}), 400
+
+    if raw_providers:
+        providers = []
+        for raw_provider in raw_providers.lower().split(','):
+            provider = canonical_provider(raw_provider.strip())
+            if not provider:
+                return jsonify({"error": f"Unknown provider: {raw_provider}"}), 400
+            if provider not in providers:
+                providers.append(provider)
+    else:
+        providers = list(PROVIDERS)
+
+    try:
+        if not imdb_id:
+            imdb_id, release_year = resolve_imdb_id(video_name, release_year)
+            g.log_fields['imdb_id'] = imdb_id
+        # once per request, not once per provider
+        country = get_country_from_request()
+    except Exception as e:
+        app.logger.error(f"Error in get_all: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+    def revalidate(key, provider, cached_result):
+        refresh_name = video_name or cached_result.get('title')
+        revalidator.schedule(key, lambda: refresh_entry(key, provider, imdb_id, refresh_name, release_year))
+
+    def event(payload, name='result'):
+        line = json.dumps(payload)
+        return f"event: {name}\ndata: {line}\n\n" if sse else line + "\n"
+
+    def generate():
+        started = time.perf_counter()
+        counts = defaultdict(int)
+        results = fan_out(db, key_resolver, providers, imdb_id, video_name, release_year, budget=budget,
+                          revalidate=revalidate, resolve_title=lambda: omdb_client.title_for_id(imdb_id))
+        try:
+            for provider, status, result, error in results:
+                counts[status] += 1
+                if result is not None:
+                    update_stats(status != FRESH, sex_nudity_category_of(result), country)
+                    result['is_cached'] = status != FRESH
+                    result['stale'] = status == STALE
+                yield event({'provider': provider, 'status': status, 'data': result, 'error': error,
+                             'ms': round((time.perf_counter() - started) * 1000, 1)})
+        except Exception as e:
+            # the 200 is already sent, so the failure has to travel in the stream
+            app.logger.error(f"Error in get_all: {str(e)}")
+            app.logger.error(f"Error traceback: {traceback.format_exc()}")
+            yield event({'done': True, 'status': 'error', 'error': str(e), 'providers': len(providers), 'results': counts,
+                         'ms': round((time.perf_counter() - started) * 1000, 1)}, 'done')
+            return
+        yield event({'done': True, 'status': 'ok', 'providers': len(providers), 'results': counts,
+                     'ms': round((time.perf_counter() - started) * 1000, 1)}, 'done')
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    mimetype = 'text/event-stream' if sse else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers=headers)
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+    g.log_sample_token = request_log.begin_request()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.HTTP_REQUESTS.inc(endpoint, str(response.status_code))
+    if 'request_started' in g:
+        elapsed = time.perf_counter() - g.request_started
+        metrics.HTTP_SECONDS.observe(elapsed, endpoint)
+        # one structured line per API request instead of a line per step
+        if 'log_fields' in g:
+            log_event(app.logger, endpoint, status=response.status_code, **g.log_fields,
+                      ms=round(elapsed * 1000, 1), sampled=request_log.is_sampled() or None)
+    return response
+
+@app.teardown_request
+def end_log_sampling(exc):
+    if 'log_sample_token' in g:
+        request_log.end_request(g.log_sample_token)
+
+@app.route('/metrics', methods=['GET'])
+def show_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # Add this function to check the API status
 def is_api_running():
     # You can implement a more sophisticated check here if needed
@@ -388,33 +440,33 @@ def api_documentation():
     api_status = "green" if is_api_running() else "red"
     return render_template('documentation.html', api_status=api_status)
 
-# Update the logging configuration
-@app.before_first_request
-def setup_logging():
-    logging.basicConfig(level=logging.INFO)
-    app.logger.setLevel(logging.INFO)
-
-    class SQLiteHandler(logging.Handler):
-        def emit(self, record):
-            db.add_log(record.levelname, self.format(record))
-
-    handler = SQLiteHandler()
-    handler.setLevel(logging.INFO)
-    app.logger.addHandler(handler)
-
 # Add a new route for logs
 @app.route('/logs', methods=['GET'])
 def show_logs():
     api_status = "green" if is_api_running() else "red"
-    page = request.args.get('page', 1, type=int)
     per_page = 50
-    offset = (page - 1) * per_page
-    logs = db.get_logs(limit=per_page, offset=offset)
-    
+    # keyset pagination: the next page starts after the (timestamp, id) of the last row shown
+    before_ts = request.args.get('before_ts')
+    before_id = request.args.get('before_id', type=int)
+    before = (before_ts, before_id) if before_ts and before_id is not None else None
+    # search and filters, since/until come from datetime-local inputs and compare as ISO strings
+    filters = {name: request.args.get(name, '').strip() for name in ('q', 'level', 'since', 'until')}
+    active_filters = {name: value for name, value in filters.items() if value}
+    # one extra row tells whether there is an older page
+    logs = db.get_logs(limit=per_page + 1, before=before, search=filters['q'] or None,
+                       level=filters['level'] or None, since=filters['since'] or None, until=filters['until'] or None)
+    has_more = len(logs) > per_page
+    logs = logs[:per_page]
+    next_cursor = dict(active_filters, before_ts=logs[-1][1], before_id=logs[-1][0]) if has_more else None
+
     return render_template('logs.html', 
                            api_status=api_status,
                            logs=logs,
-                           page=page,
+                           filters=filters,
+                           active_filters=active_filters,
+                           log_levels=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
+                           is_first_page=before is None,
+                           next_cursor=next_cursor,
                            get_log_level_color=get_log_level_color)
 
 def get_log_level_color(level):
@@ -437,7 +489,8 @@ def show_stats():
     # Get cached records count
     cached_records_count = db.get_cached_records_count()
 
-    # Get all stats
+    # Get all stats, including hits not written yet
+    stats_aggregator.flush()
     stats = db.get_all_stats()
 
     # Retrieve stats, use 0 as default if not found
@@ -462,7 +515,9 @@ def show_stats():
     
     # This Year's Statistics (per month)
     months_this_year = [f"{current_year}-{month:02d}" for month in range(1, 13)]
-    hits_by_month = stats.get('hits_by_month', {})
+    hits_by_month = {bucket: count for (bucket, value), count
+                     in db.get_stats_series('hits', 'month', str(current_year), str(current_year + 1)).items()
+                     if value == 'total'}
     this_year_data = {
         'labels': months_this_year,
         'total': [hits_by_month.get(month, 0) for month in months_this_year],
@@ -471,7 +526,9 @@ def show_stats():
     # This Month's Statistics (per day)
     days_in_month = calendar.monthrange(current_year, int(current_month.split('-')[1]))[1]
     days_this_month = [f"{current_month}-{day:02d}" for day in range(1, days_in_month + 1)]
-    hits_by_day = stats.get('hits_by_day', {})
+    hits_by_day = {bucket: count for (bucket, value), count
+                   in db.get_stats_series('hits', 'day', current_month, days_this_month[-1] + '~').items()
+                   if value == 'total'}
     this_month_data = {
         'labels': days_this_month,
         'total': [hits_by_day.get(day, 0) for day in days_this_month],
@@ -488,8 +545,17 @@ def show_stats():
                            current_year=current_year,
                            current_month=current_month,
                            cached_records_count=cached_records_count,
-                           sex_nudity_categories=stats.get('sex_nudity_categories', {}),
-                           countries=stats.get('countries', {}))
+                           eviction_stats=db.get_eviction_stats(),
+                           sex_nudity_categories=series_totals('sex_nudity'),
+                           countries=series_totals('country'))
+
+def series_totals(dimension):
+    """ All-time count per value of a stats dimension, largest first """
+
+    totals = defaultdict(int)
+    for (bucket, value), count in db.get_stats_series(dimension, 'month').items():
+        totals[value] += count
+    return dict(sorted(totals.items(), key=lambda item: item[1], reverse=True))
 
 @app.route('/tryout', methods=['GET', 'POST'])
 def tryout():
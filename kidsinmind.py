@@ -3,6 +3,7 @@ from bs4 import BeautifulSoup
 import re
 from difflib import SequenceMatcher
 import logging
+from provider_registry import register
 
 logger = logging.getLogger(__name__)
 
@@ -198,3 +199,7 @@ def KidsInMindScraper(ID, videoName, release_year=None):
         }
 
     return Review
+
+
+register('kidsinmind', lambda imdb_id, video_name, release_year: KidsInMindScraper(imdb_id, video_name, release_year),
+         negative_ttl=3 * 24 * 60 * 60)
@@ -0,0 +1,126 @@
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+from datetime import datetime
+
+# what to do with a record when the queue is full
+OVERFLOW_POLICIES = ('drop_new', 'drop_old', 'block')
+
+
+class QueuedDatabaseHandler(logging.Handler):
+    """
+        Logging handler that writes records to the cache backend's logs
+        table from a background thread.
+
+        emit() only formats the record and puts it on a bounded queue; the
+        writer thread inserts whatever has queued up with one add_logs call
+        per batch. When the queue is full the overflow policy decides
+        between dropping the new record, dropping the oldest queued one or
+        blocking the caller. Pending records are written on close(), which
+        also runs at interpreter exit.
+    """
+
+    def __init__(self, db, capacity=None, batch_size=None, flush_interval=None, overflow=None):
+        super().__init__()
+        if capacity is None:
+            capacity = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+        if batch_size is None:
+            batch_size = int(os.environ.get('LOG_BATCH_SIZE', 200))
+        if flush_interval is None:
+            flush_interval = float(os.environ.get('LOG_FLUSH_INTERVAL', 0.5))
+        overflow = (overflow or os.environ.get('LOG_OVERFLOW', 'drop_new')).lower()
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown log overflow policy {overflow}, use one of {', '.join(OVERFLOW_POLICIES)}")
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=capacity)
+        self._write_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._writer = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def emit(self, record):
+        try:
+            row = (datetime.fromtimestamp(record.created).isoformat(), record.levelname, self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+        if self.overflow == 'block':
+            self._queue.put(row)
+            return
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            if self.overflow == 'drop_old':
+                try:
+                    self._queue.get_nowait()
+                    self._queue.put_nowait(row)
+                except (queue.Empty, queue.Full):
+                    pass
+            self.dropped += 1
+
+    def _drain(self, first=None):
+        rows = [] if first is None else [first]
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _write(self, rows):
+        if not rows:
+            return
+        try:
+            self.db.add_logs(rows)
+            self.written += len(rows)
+        except Exception as e:
+            # logging here would feed the failure back into this handler
+            print(f"Failed to write {len(rows)} log records: {e}", file=sys.stderr)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            # a request logs a burst of lines, let them queue up into one batch
+            if self._queue.qsize() < self.batch_size:
+                self._stopping.wait(self.flush_interval)
+            with self._write_lock:
+                self._write(self._drain(first))
+
+    def flush(self):
+        """ Write everything queued so far on the calling thread """
+
+        with self._write_lock:
+            while True:
+                rows = self._drain()
+                if not rows:
+                    break
+                self._write(rows)
+
+    def close(self):
+        if not self._stopping.is_set():
+            self._stopping.set()
+            self._writer.join(timeout=5)
+            self.flush()
+            if self.dropped:
+                print(f"Log queue overflowed, {self.dropped} records were dropped", file=sys.stderr)
+        super().close()
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'overflow': self.overflow,
+        }
@@ -0,0 +1,127 @@
+"""
+    In-process metrics exposed in the Prometheus text format on /metrics.
+
+    Each metric keeps its series in a dict keyed by the label values and
+    guards it with its own lock, so recording a value is a dict lookup and
+    an add and threads only contend when they touch the same metric.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# latency buckets in seconds, from a sqlite lookup up to a slow scrape
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """ Monotonically increasing count per label set """
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in sorted(values):
+            yield f'{self.name}{_format_labels(self.labels, label_values)} {value}'
+
+
+class Histogram:
+    """ Cumulative bucket counts, sum and count of observed values per label set """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *label_values):
+        # first bucket the value fits in, len(buckets) means +Inf only
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def samples(self):
+        with self._lock:
+            series = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items()]
+        for label_values, (counts, total, count) in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % ('+Inf' if bound == float('inf') else repr(float(bound)))
+                yield f'{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labels, label_values)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labels, label_values)} {count}'
+
+
+def render():
+    """ Every registered metric in the Prometheus text exposition format """
+
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+CACHE_LOOKUPS = Counter('pg_cache_lookups_total', 'Cache lookups in get_data by provider and result '
+                        '(hit, stale, negative or miss)', ('provider', 'result'))
+SCRAPE_SECONDS = Histogram('pg_scrape_duration_seconds', 'Provider scrape latency by outcome '
+                           '(ok, empty or error)', ('provider', 'outcome'))
+UPSTREAM_RESPONSES = Counter('pg_upstream_responses_total', 'HTTP responses from scraped sites by status code',
+                             ('provider', 'status'))
+UPSTREAM_RETRIES = Counter('pg_upstream_retries_total', 'Retried upstream requests', ('provider',))
+OMDB_LOOKUPS = Counter('pg_omdb_lookups_total', 'OMDb lookups by kind (title or id) and result', ('kind', 'result'))
+TITLE_INDEX_LOOKUPS = Counter('pg_title_index_lookups_total', 'Offline title index lookups by result '
+                              '(hit, miss or ambiguous)', ('result',))
+HTTP_REQUESTS = Counter('pg_http_requests_total', 'API responses by endpoint and status code', ('endpoint', 'status'))
+HTTP_SECONDS = Histogram('pg_http_request_duration_seconds', 'API response time by endpoint', ('endpoint',))
+SQLITE_SECONDS = Histogram('pg_sqlite_operation_seconds', 'SqliteCache operation latency', ('operation',))
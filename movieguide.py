@@ -3,17 +3,14 @@ from bs4 import BeautifulSoup
 import re
 import json
 import os
+import omdb
+from provider_registry import register
 
 def getIMDBID(name):
-    omdb_api_key = os.environ.get('OMDB_API_KEY')
-    url = f"http://www.omdbapi.com/?t={name.strip()}&apikey={omdb_api_key}&plot=full&r=json"
-    res = requests.get(url).json()
-
-    if res.get("Response") != 'False':
-        return res.get("imdbID")
-    else:
+    imdb_id = omdb.get_client().imdb_id_for_title(name)
+    if not imdb_id:
         print("Couldn't find IMDB ID")
-        return None
+    return imdb_id
 
 def MovieGuideOrgScrapper(ID, videoName):
     moviename = videoName.lower().strip().replace(" ","-").replace(":","").strip()
@@ -106,3 +103,6 @@ def MovieGuideOrgScrapper(ID, videoName):
         }
     return Review
 
+
+register('movieguide', lambda imdb_id, video_name, release_year: MovieGuideOrgScrapper(imdb_id, video_name),
+         aliases=('movieguideorg',), negative_ttl=3 * 24 * 60 * 60)
@@ -0,0 +1,164 @@
+"""
+    Shared OMDb client.
+
+    Every OMDb lookup (the API, the warm-up tool and the scrapers that need
+    an IMDb ID) goes through one OmdbClient: a pooled requests session with
+    timeouts and retries, the backend's omdb_cache table as its store under
+    normalized keys, and coalescing so concurrent lookups of the same title
+    make a single HTTP request.
+"""
+
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cache_keys import normalize_title
+from metrics import OMDB_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+OMDB_URL = 'https://www.omdbapi.com/'
+
+
+def id_key(imdb_id):
+    return f"omdb:id:{imdb_id.strip().lower()}"
+
+
+def title_key(video_name, release_year=None):
+    return f"omdb:title:{normalize_title(video_name)}:{release_year or ''}"
+
+
+class _Call:
+    """ A lookup in progress that other threads can wait on """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class OmdbClient:
+    """ OMDb lookups by IMDb ID or by title, cached in the backend's omdb_cache """
+
+    def __init__(self, db, api_key=None, timeout=None, pool_size=None):
+        self.db = db
+        self._api_key = api_key
+        if timeout is None:
+            timeout = float(os.environ.get('OMDB_TIMEOUT', 5))
+        if pool_size is None:
+            pool_size = int(os.environ.get('OMDB_POOL_SIZE', 10))
+        # (connect, read)
+        self.timeout = (min(timeout, 3.05), timeout)
+        self.session = requests.Session()
+        retries = Retry(total=2, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=('GET',))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @property
+    def api_key(self):
+        # read on every request, the admin panel can change the key at runtime
+        return self._api_key or os.environ.get('OMDB_API_KEY')
+
+    def by_id(self, imdb_id):
+        """ The OMDb record of an IMDb ID, None if OMDb doesn't know it """
+
+        if not imdb_id:
+            return None
+        return self._lookup('title', id_key(imdb_id), {'i': imdb_id.strip()},
+                            legacy_key=f"omdb_title_{imdb_id}")
+
+    def by_title(self, video_name, release_year=None):
+        """ The OMDb record best matching a title and optional year """
+
+        if not video_name or not video_name.strip():
+            return None
+        params = {'t': video_name.strip()}
+        if release_year:
+            params['y'] = release_year
+        return self._lookup('id', title_key(video_name, release_year), params,
+                            legacy_key=f"omdb_id_{video_name}_{release_year}")
+
+    def title_for_id(self, imdb_id):
+        data = self.by_id(imdb_id)
+        return data.get('Title') if data else None
+
+    def imdb_id_for_title(self, video_name, release_year=None):
+        data = self.by_title(video_name, release_year)
+        return data.get('imdbID') if data else None
+
+    def _lookup(self, kind, key, params, legacy_key=None):
+        data = self.db.get_omdb_cache(key)
+        if data is None and legacy_key:
+            # entries written before the keys were normalized
+            data = self.db.get_omdb_cache(legacy_key)
+            if data is not None:
+                self.db.set_omdb_cache(key, data)
+        if data is not None:
+            logger.debug("OMDb cache hit for %s", key)
+            OMDB_LOOKUPS.inc(kind, 'cached')
+            return data
+
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _Call()
+        if not leader:
+            OMDB_LOOKUPS.inc(kind, 'coalesced')
+            call.done.wait(self.timeout[1] * 4)
+            return call.result
+
+        try:
+            call.result = self._fetch(kind, key, params)
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            call.done.set()
+        return call.result
+
+    def _fetch(self, kind, key, params):
+        if not self.api_key:
+            logger.error("OMDB API key not found in environment variables")
+            OMDB_LOOKUPS.inc(kind, 'no_key')
+            return None
+        try:
+            response = self.session.get(OMDB_URL, params=dict(params, apikey=self.api_key), timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            OMDB_LOOKUPS.inc(kind, 'error')
+            logger.error(f"Error fetching data from OMDB: {e}")
+            return None
+
+        if data.get('Response') != 'True':
+            OMDB_LOOKUPS.inc(kind, 'not_found')
+            logger.warning(f"No OMDB data found for {params.get('i') or params.get('t')}")
+            return None
+        OMDB_LOOKUPS.inc(kind, 'found')
+        self.db.set_omdb_cache(key, data)
+        # a title search returns the full record, so the ID lookup is answered too
+        if kind == 'id' and data.get('imdbID'):
+            self.db.set_omdb_cache(id_key(data['imdbID']), data)
+        return data
+
+
+_shared_client = None
+_shared_lock = threading.Lock()
+
+
+def get_client():
+    """ The process-wide client, backed by the shared cache """
+
+    global _shared_client
+    with _shared_lock:
+        if _shared_client is None:
+            from cache_backends import get_cache
+            _shared_client = OmdbClient(get_cache())
+        return _shared_client
@@ -1,6 +1,7 @@
 import requests
 from bs4 import BeautifulSoup
 import re
+from provider_registry import register
 
 
 def ParentPreviewsScraper(ID,videoName):
@@ -92,3 +93,6 @@ def ParentPreviewsScraper(ID,videoName):
         }
     return Review
 
+
+register('parentpreviews', lambda imdb_id, video_name, release_year: ParentPreviewsScraper(imdb_id, video_name),
+         aliases=('parentpreview',), negative_ttl=3 * 24 * 60 * 60)
@@ -0,0 +1,139 @@
+"""
+    Registry of review providers.
+
+    Each scraper module registers its canonical id, the spellings callers
+    may use for it, a uniform scraper(imdb_id, video_name, release_year)
+    callable and its execution policy: how long results, misses and
+    failed scrapes are cached, how many scrapes may run at once and how
+    long a caller waits.
+    Every default can be overridden per provider from the environment,
+    e.g. PROVIDER_IMDB_TIMEOUT=20 or PROVIDER_DOVE_CONCURRENCY=1.
+
+    Looking a provider up is one dict access on the normalized name.
+"""
+
+import contextvars
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from cache_backends import DEFAULT_CACHING_PERIOD
+
+DEFAULT_NEGATIVE_TTL = 24 * 60 * 60
+# a "Failed" result is usually the site erroring, so it is only remembered long enough to not hammer it
+DEFAULT_FAILURE_TTL = 15 * 60
+DEFAULT_CONCURRENCY = 2
+DEFAULT_TIMEOUT = 30
+
+# canonical id -> Provider, in registration order
+_providers = {}
+# every normalized spelling -> Provider
+_by_name = {}
+_loaded = False
+
+
+class ProviderTimeout(Exception):
+    """ The scrape did not finish within the provider's timeout
+
+        `future` is the scrape that is still running, so its result can be
+        cached once it finishes.
+    """
+
+    def __init__(self, message, future=None):
+        super().__init__(message)
+        self.future = future
+
+
+def _normalize(name):
+    return re.sub(r'[^a-z0-9]', '', (name or '').lower())
+
+
+def _setting(name, setting, default, cast):
+    value = os.environ.get(f'PROVIDER_{name.upper()}_{setting}')
+    return cast(value) if value else default
+
+
+class Provider:
+    """ A registered provider and its execution policy """
+
+    def __init__(self, name, scraper, aliases=(), ttl=DEFAULT_CACHING_PERIOD, negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 failure_ttl=DEFAULT_FAILURE_TTL, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT):
+        self.name = name
+        self.scraper = scraper
+        self.aliases = tuple(aliases)
+        self.ttl = _setting(name, 'TTL', ttl, float)
+        self.negative_ttl = _setting(name, 'NEGATIVE_TTL', negative_ttl, float)
+        self.failure_ttl = _setting(name, 'FAILURE_TTL', failure_ttl, float)
+        self.concurrency = _setting(name, 'CONCURRENCY', concurrency, int)
+        self.timeout = _setting(name, 'TIMEOUT', timeout, float)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        # created on first use, its size is the provider's concurrency cap
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                                    thread_name_prefix=f'scrape-{self.name}')
+            return self._executor
+
+    def submit(self, imdb_id, video_name, release_year):
+        """ Start the scraper on the provider's pool, returns its Future """
+
+        # carry the request's context (log sampling) over to the worker thread
+        context = contextvars.copy_context()
+        return self.executor().submit(context.run, self.scraper, imdb_id, video_name, release_year)
+
+    def fetch(self, imdb_id, video_name, release_year):
+        """ Run the scraper on the provider's pool and wait at most `timeout` seconds
+
+            Time spent queued behind other scrapes of the same provider
+            counts against the timeout. A scrape that times out still runs
+            to completion on its worker, the caller just stops waiting.
+        """
+
+        future = self.submit(imdb_id, video_name, release_year)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise ProviderTimeout(f"{self.name} did not answer within {self.timeout:g}s", future)
+
+    def __repr__(self):
+        return f'<Provider {self.name}>'
+
+
+def register(name, scraper, aliases=(), **policy):
+    """ Register a provider under its canonical id and aliases, returns the Provider """
+
+    provider = Provider(name, scraper, aliases, **policy)
+    _providers[name] = provider
+    for alias in (name,) + provider.aliases:
+        _by_name[_normalize(alias)] = provider
+    return provider
+
+
+def _load():
+    # the scraper modules register themselves when providers imports them
+    global _loaded
+    if not _loaded:
+        import providers  # noqa: F401
+        _loaded = True
+
+
+def get(name):
+    """ The Provider for a canonical id or alias, None if unknown """
+
+    provider = _by_name.get(name)
+    if provider is None:
+        provider = _by_name.get(_normalize(name))
+    if provider is None and not _loaded:
+        _load()
+        provider = _by_name.get(_normalize(name))
+    return provider
+
+
+def all_providers():
+    _load()
+    return list(_providers.values())
@@ -0,0 +1,120 @@
+"""
+    Scraper dispatch shared by the API and the command line tools.
+
+    Importing this module imports every scraper module, each of which
+    registers itself with provider_registry along with its aliases and
+    execution policy (cache TTLs, concurrency cap, timeout). This module
+    runs scrapes through that policy and holds the caching rules for
+    provider results.
+"""
+
+import time
+
+import provider_registry
+from provider_registry import ProviderTimeout
+from metrics import SCRAPE_SECONDS
+
+# imported for their register() calls, in the order providers are listed to users
+import imdb
+import kidsinmind
+import dove
+import parentpreviews
+import cringMDB
+import commonsensemedia
+import movieguide
+
+# canonical provider ids
+PROVIDERS = tuple(provider.name for provider in provider_registry.all_providers())
+
+
+def get_provider(provider):
+    """ The registered Provider for a canonical id, raises ValueError if unknown """
+
+    registered = provider_registry.get(provider)
+    if registered is None:
+        raise ValueError(f"Unknown provider: {provider}")
+    return registered
+
+
+def ttl(provider):
+    return get_provider(provider).ttl
+
+
+def negative_ttl(provider):
+    return get_provider(provider).negative_ttl
+
+
+def is_failure(result):
+    """ Scrapers report upstream errors (non-200 responses, parse errors) as status Failed """
+
+    return isinstance(result, dict) and result.get('status') == 'Failed'
+
+
+def miss_ttl(provider, result):
+    """ How long a result without reviews is remembered, upstream failures only briefly """
+
+    registered = get_provider(provider)
+    return registered.failure_ttl if is_failure(result) else registered.negative_ttl
+
+
+def fetch_from_provider(provider, imdb_id, video_name, release_year):
+    """ Run a provider's scraper under its concurrency cap and timeout, timed in pg_scrape_duration_seconds """
+
+    registered = get_provider(provider)
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        result = registered.fetch(imdb_id, video_name, release_year)
+        outcome = 'ok' if is_cacheable(result) else 'failed' if is_failure(result) else 'empty'
+        return result
+    except ProviderTimeout:
+        outcome = 'timeout'
+        raise
+    finally:
+        SCRAPE_SECONDS.observe(time.perf_counter() - started, registered.name, outcome)
+
+
+def submit_to_provider(provider, imdb_id, video_name, release_year):
+    """ Start a scrape on the provider's pool without waiting, returns its Future
+
+        The scrape is timed in pg_scrape_duration_seconds when it finishes,
+        whether or not anyone is still waiting for it.
+    """
+
+    registered = get_provider(provider)
+    started = time.perf_counter()
+
+    def record(future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            outcome = 'error'
+        else:
+            result = future.result()
+            outcome = 'ok' if is_cacheable(result) else 'failed' if is_failure(result) else 'empty'
+        SCRAPE_SECONDS.observe(time.perf_counter() - started, registered.name, outcome)
+
+    future = registered.submit(imdb_id, video_name, release_year)
+    future.add_done_callback(record)
+    return future
+
+
+def is_cacheable(result):
+    """ Only results that carry review items are worth caching """
+
+    return isinstance(result, dict) and bool(result.get('review-items'))
+
+
+def store_result(db, key, provider, result):
+    """ Cache a scraper result, or remember the miss when it has no reviews
+
+        Failed results are remembered for the provider's short failure_ttl,
+        real misses for its negative_ttl. Returns True if the result was stored.
+    """
+
+    if is_cacheable(result):
+        db.set(key, result, timeout=ttl(provider))
+        db.delete_negative(key)
+        return True
+    db.set_negative(key, miss_ttl(provider, result))
+    return False
@@ -0,0 +1,128 @@
+"""
+    Logging helpers that keep the per-request logging cost small.
+
+    - SamplingFilter keeps only a fraction of the INFO and DEBUG records of
+      chatty loggers (LOG_SAMPLE_RATES="imdb=0.05,kidsinmind=0.1").
+      Warnings and errors always pass.
+    - A small share of requests is sampled (LOG_REQUEST_SAMPLE_RATE). Every
+      record logged while serving a sampled request passes the filter and
+      payload dumps are logged at INFO for it.
+    - RequestEvent and LazyJSON only build their text when a handler
+      actually formats the record, so dropped records cost next to nothing.
+"""
+
+import json
+import logging
+import os
+import random
+from contextvars import ContextVar
+
+_sampled = ContextVar('log_request_sampled', default=False)
+
+
+def parse_sample_rates(spec):
+    """ "imdb=0.05,kidsinmind=0.1" -> {'imdb': 0.05, 'kidsinmind': 0.1} """
+
+    rates = {}
+    for item in (spec or '').split(','):
+        name, _, rate = item.partition('=')
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+REQUEST_SAMPLE_RATE = float(os.environ.get('LOG_REQUEST_SAMPLE_RATE', 0.01))
+
+
+def begin_request(rate=None):
+    """ Decide whether the current request is sampled, returns a token for end_request """
+
+    if rate is None:
+        rate = REQUEST_SAMPLE_RATE
+    return _sampled.set(random.random() < rate)
+
+
+def end_request(token):
+    _sampled.reset(token)
+
+
+def is_sampled():
+    return _sampled.get()
+
+
+class SamplingFilter(logging.Filter):
+    """ Keep a per-logger fraction of records below WARNING
+
+        A logger without a rate of its own uses the rate of its closest
+        configured parent, then `default_rate`.
+    """
+
+    def __init__(self, rates=None, default_rate=None):
+        super().__init__()
+        if rates is None:
+            rates = parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES', ''))
+        if default_rate is None:
+            default_rate = float(os.environ.get('LOG_SAMPLE_RATE', 1.0))
+        self.rates = rates
+        self.default_rate = default_rate
+        self._resolved = {}
+        self.dropped = 0
+
+    def rate_for(self, name):
+        rate = self._resolved.get(name)
+        if rate is None:
+            parts = name.split('.')
+            while parts and '.'.join(parts) not in self.rates:
+                parts.pop()
+            rate = self._resolved[name] = self.rates['.'.join(parts)] if parts else self.default_rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or _sampled.get():
+            return True
+        rate = self.rate_for(record.name)
+        if rate >= 1 or random.random() < rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class LazyJSON:
+    """ json.dumps(value) run only when the record is formatted """
+
+    __slots__ = ('value', 'indent')
+
+    def __init__(self, value, indent=2):
+        self.value = value
+        self.indent = indent
+
+    def __str__(self):
+        return json.dumps(self.value, indent=self.indent, default=str)
+
+
+class RequestEvent:
+    """ One line per request, "get_data status=200 provider=imdb cache=hit ms=1.2" """
+
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join([self.name] + [f'{key}={value}' for key, value in self.fields.items() if value is not None])
+
+
+def log_event(logger, name, **fields):
+    """ Log a structured event at INFO, the fields are also on the record as `event_fields` """
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info('%s', RequestEvent(name, fields), extra={'event': name, 'event_fields': fields})
+
+
+def log_payload(logger, message, payload):
+    """ Dump a result at DEBUG, or at INFO when the request is sampled """
+
+    level = logging.INFO if _sampled.get() else logging.DEBUG
+    if logger.isEnabledFor(level):
+        logger.log(level, '%s: %s', message, LazyJSON(payload))
@@ -0,0 +1,60 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Revalidator:
+    """
+        Refreshes stale cache entries on a small background pool.
+
+        Each key is refreshed at most once at a time; requests that hit the
+        same stale entry while a refresh is running just keep serving the
+        stale copy.
+    """
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = int(os.environ.get('CACHE_REVALIDATE_WORKERS', 2))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='revalidate')
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self.scheduled = 0
+        self.refreshed = 0
+        self.failed = 0
+
+    def schedule(self, key, refresh):
+        """ Run refresh() in the background unless key is already being refreshed
+
+            refresh must return True when the entry was replaced.
+        """
+
+        with self._lock:
+            if key in self._in_flight:
+                return False
+            self._in_flight.add(key)
+            self.scheduled += 1
+        self._executor.submit(self._run, key, refresh)
+        return True
+
+    def _run(self, key, refresh):
+        try:
+            ok = refresh()
+        except Exception as e:
+            logger.error(f"Revalidation of {key} failed, keeping stale entry: {e}")
+            ok = False
+        with self._lock:
+            self._in_flight.discard(key)
+            if ok:
+                self.refreshed += 1
+            else:
+                self.failed += 1
+        if ok:
+            logger.info(f"Revalidated stale cache entry {key}")
+        else:
+            logger.warning(f"Provider could not refresh {key}, stale entry kept")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
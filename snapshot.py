@@ -0,0 +1,182 @@
+#!/usr/bin/python
+"""
+Export and import the cache as a portable snapshot.
+
+Usage: python snapshot.py export FILE [options]
+       python snapshot.py import FILE [options]
+
+A snapshot is gzip-compressed NDJSON: a header line followed by one line
+per cached result (entries) and OMDb lookup (omdb_cache). Values are
+written as plain JSON, so a snapshot can be loaded by an instance with a
+different value format or compression setting. Logs and stats are never
+included.
+
+Values that aren't JSON-able are exported as the raw encoded blob. An
+encoded blob is a pickle and unpickling runs code, so import skips blob
+lines unless --trust-blobs is given; only pass it for snapshots you made.
+
+Both directions stream in batches, so memory use stays flat however big
+the cache is. Importing skips rows the target already holds with the same
+or a later expiry, which makes re-importing a snapshot cheap.
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+from cache_backends import default_db_path
+from cache_keys import canonical_provider
+from codec import encode_value, decode_value
+from SQLiteCache import SqliteCache
+
+SNAPSHOT_FORMAT = 'pg-cache-snapshot'
+SNAPSHOT_VERSION = 1
+TABLES = ('entries', 'omdb_cache')
+BATCH_SIZE = 500
+
+
+def row_to_line(table, key, blob, exp):
+    record = {'table': table, 'key': key, 'exp': exp, 'value': decode_value(blob)}
+    try:
+        return json.dumps(record, separators=(',', ':'))
+    except (TypeError, ValueError):
+        # not JSON-able, carried as the encoded blob instead
+        del record['value']
+        record['blob'] = base64.b64encode(blob).decode('ascii')
+        return json.dumps(record, separators=(',', ':'))
+
+
+def record_to_row(record):
+    if 'blob' in record:
+        blob = base64.b64decode(record['blob'])
+    else:
+        blob = encode_value(record['value'])
+    return record['key'], blob, record['exp']
+
+
+def min_expiry(args):
+    """ Earliest expiry a row may have to be exported or imported, None for no limit """
+
+    if args.include_expired:
+        return None
+    return time.time() + args.min_ttl
+
+
+def keep_record(record, args, min_exp):
+    if record['table'] == 'omdb_cache' and (args.no_omdb or args.provider):
+        return False
+    if args.provider and not record['key'].startswith(f'{args.provider}:'):
+        return False
+    return min_exp is None or record['exp'] == 0 or record['exp'] >= min_exp
+
+
+def export_snapshot(db, path, args):
+    tables = [table for table in TABLES if not (table == 'omdb_cache' and (args.no_omdb or args.provider))]
+    min_exp = min_expiry(args)
+    counts = dict.fromkeys(tables, 0)
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        header = {'format': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION,
+                  'created': datetime.now().isoformat(timespec='seconds'), 'tables': tables}
+        f.write(json.dumps(header) + '\n')
+        for table in tables:
+            provider = args.provider if table == 'entries' else None
+            for key, blob, exp in db.iter_rows(table, provider=provider, min_exp=min_exp):
+                f.write(row_to_line(table, key, blob, exp) + '\n')
+                counts[table] += 1
+    return counts
+
+
+def read_records(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline() or '{}')
+        if header.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError(f'{path} is not a cache snapshot')
+        if header.get('version', 0) > SNAPSHOT_VERSION:
+            raise ValueError(f"Snapshot version {header['version']} is newer than this tool supports")
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def import_snapshot(db, path, args):
+    min_exp = min_expiry(args)
+    counts = {table: {'written': 0, 'skipped': 0, 'filtered': 0, 'rejected': 0} for table in TABLES}
+    batches = {table: [] for table in TABLES}
+
+    def flush(table):
+        written, skipped = db.import_rows(table, batches[table])
+        counts[table]['written'] += written
+        counts[table]['skipped'] += skipped
+        batches[table] = []
+
+    for record in read_records(path):
+        table = record.get('table')
+        if table not in batches:
+            continue
+        if not keep_record(record, args, min_exp):
+            counts[table]['filtered'] += 1
+            continue
+        if 'blob' in record and not args.trust_blobs:
+            counts[table]['rejected'] += 1
+            continue
+        batches[table].append(record_to_row(record))
+        if len(batches[table]) >= BATCH_SIZE:
+            flush(table)
+    for table in TABLES:
+        if batches[table]:
+            flush(table)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export or import a cache snapshot.')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('file', help='snapshot file (gzip NDJSON)')
+    parser.add_argument('--db', default=os.environ.get('SQLITE_DB_PATH', default_db_path()),
+                        help='cache database (default: the one the app uses)')
+    parser.add_argument('-p', '--provider', help='only cached results of this provider (skips OMDb lookups)')
+    parser.add_argument('--min-ttl', type=float, default=0,
+                        help='only rows still valid for at least this many seconds (default: 0, live rows)')
+    parser.add_argument('--include-expired', action='store_true', help='also copy expired rows, e.g. for stale serving')
+    parser.add_argument('--no-omdb', action='store_true', help='leave out the OMDb lookup cache')
+    parser.add_argument('--trust-blobs', action='store_true',
+                        help='import values carried as encoded (pickled) blobs, only for snapshots you made')
+    args = parser.parse_args()
+
+    if args.provider:
+        provider = canonical_provider(args.provider)
+        if provider is None:
+            parser.error(f'unknown provider: {args.provider}')
+        args.provider = provider
+
+    db = SqliteCache(args.db)
+    started = time.perf_counter()
+    try:
+        if args.command == 'export':
+            counts = export_snapshot(db, args.file, args)
+            elapsed = time.perf_counter() - started
+            summary = ', '.join(f'{count} {table}' for table, count in counts.items())
+            print(f' * Exported {summary} to {args.file} in {elapsed:.1f}s '
+                  f'({os.path.getsize(args.file)} bytes, Database: {args.db})')
+        else:
+            counts = import_snapshot(db, args.file, args)
+            elapsed = time.perf_counter() - started
+            for table, c in counts.items():
+                print(f" * {table}: {c['written']} written, {c['skipped']} unchanged, {c['filtered']} filtered out")
+                if c['rejected']:
+                    print(f"[!] {table}: {c['rejected']} pickled blobs not imported, use --trust-blobs if you made this snapshot")
+            print(f' * Imported {args.file} in {elapsed:.1f}s (Database: {args.db})')
+    except (OSError, ValueError) as e:
+        print(f'[!] {e}')
+        sys.exit(1)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import atexit
+import logging
+import os
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class StatsAggregator:
+    """
+        Collects stat increments in memory and writes them to the cache
+        backend in one batch.
+
+        Requests only bump an in-process counter under a lock. A background
+        thread flushes every `flush_interval` seconds, or sooner once
+        `flush_every` hits are pending, using the backend's atomic
+        incr_stats / add_stats_series so several workers never overwrite
+        each other's counts.
+    """
+
+    def __init__(self, db, flush_interval=None, flush_every=None):
+        if flush_interval is None:
+            flush_interval = float(os.environ.get('STATS_FLUSH_INTERVAL', 5))
+        if flush_every is None:
+            flush_every = int(os.environ.get('STATS_FLUSH_EVERY', 100))
+        self.db = db
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self._pending = Counter()
+        self._pending_series = Counter()
+        self._hits = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.flushes = 0
+        self._thread = threading.Thread(target=self._run, name='stats-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def incr(self, counts, series=None):
+        """ Add a hit's counters and its {(minute bucket, dimension, value): count} time series points """
+
+        with self._lock:
+            self._pending.update(counts)
+            if series:
+                self._pending_series.update(series)
+            self._hits += 1
+            due = self._hits >= self.flush_every
+        if due:
+            self._wake.set()
+
+    def flush(self):
+        """ Write pending counters, returns the number of counters written """
+
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, Counter()
+                series, self._pending_series = self._pending_series, Counter()
+                self._hits = 0
+            written = len(pending) + len(series)
+            if not written:
+                return 0
+            try:
+                self.db.incr_stats(dict(pending))
+                pending = None
+                self.db.add_stats_series(dict(series))
+            except Exception as e:
+                # keep the counts for the next attempt rather than losing them
+                logger.error(f"Failed to flush stats: {e}")
+                with self._lock:
+                    self._pending.update(pending or {})
+                    self._pending_series.update(series)
+                return 0
+            self.flushes += 1
+            return written
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=5)
+        self.flush()
@@ -0,0 +1,330 @@
+"""
+    RedisCache against a fake in-process Redis server.
+
+    The fake speaks just enough RESP2 for the commands the backend sends
+    (strings with PX/NX expiry, hashes, lists, SCAN), so the protocol
+    client, pipelining and key layout are exercised without a real server.
+
+    Run with: python -m pytest test_cache_backends.py (or python -m unittest)
+"""
+
+import fnmatch
+import socketserver
+import threading
+import time
+import unittest
+
+from cache_backends import RedisCache, RedisError
+
+
+class _Store:
+    """ Keyspace of the fake server, values are bytes, dicts or lists """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.lock = threading.Lock()
+
+    def alive(self, key):
+        expire = self.expires.get(key)
+        if expire is not None and expire <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data[key] if self.alive(key) else default
+
+    def delete(self, key):
+        existed = self.alive(key)
+        self.data.pop(key, None)
+        self.expires.pop(key, None)
+        return existed
+
+
+def _bulk(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def _array(values):
+    return b'*%d\r\n' % len(values) + b''.join(_bulk(value) for value in values)
+
+
+def _int(value):
+    return b':%d\r\n' % value
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:-2])):
+                length = int(self.rfile.readline()[1:-2])
+                args.append(self.rfile.read(length + 2)[:-2])
+            with self.server.store.lock:
+                try:
+                    reply = self.command(self.server.store, args[0].upper().decode(), args[1:])
+                except (ValueError, TypeError, AttributeError) as e:
+                    reply = b'-ERR %s\r\n' % str(e).encode()
+                if self.server.drop_replies:
+                    # the command ran but the client never hears back
+                    self.server.drop_replies -= 1
+                    return
+            self.wfile.write(reply)
+
+    def command(self, store, name, args):
+        if name in ('AUTH', 'SELECT', 'PING'):
+            return b'+OK\r\n'
+        if name == 'FLUSHALL':
+            store.data.clear()
+            store.expires.clear()
+            return b'+OK\r\n'
+        if name == 'SET':
+            key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+            if b'NX' in options and store.alive(key):
+                return _bulk(None)
+            store.delete(key)
+            store.data[key] = value
+            if b'PX' in options:
+                store.expires[key] = time.time() + int(args[2 + options.index(b'PX') + 1]) / 1000
+            if b'EX' in options:
+                store.expires[key] = time.time() + int(args[2 + options.index(b'EX') + 1])
+            return b'+OK\r\n'
+        if name == 'GET':
+            return _bulk(store.get(args[0]))
+        if name == 'MGET':
+            return _array([store.get(key) for key in args])
+        if name == 'GETRANGE':
+            value = store.get(args[0], b'')
+            return _bulk(value[int(args[1]):int(args[2]) + 1])
+        if name == 'DEL':
+            return _int(sum(store.delete(key) for key in args))
+        if name == 'EXISTS':
+            return _int(sum(store.alive(key) for key in args))
+        if name == 'INCRBY':
+            store.data[args[0]] = b'%d' % (int(store.get(args[0], b'0')) + int(args[1]))
+            return _int(int(store.data[args[0]]))
+        if name == 'SCAN':
+            pattern = args[args.index(b'MATCH') + 1].decode() if b'MATCH' in args else '*'
+            keys = [key for key in list(store.data) if store.alive(key) and fnmatch.fnmatchcase(key.decode(), pattern)]
+            return b'*2\r\n' + _bulk('0') + _array(keys)
+        if name == 'HSET':
+            store.data.setdefault(args[0], {})[args[1]] = args[2]
+            return _int(1)
+        if name == 'HGET':
+            return _bulk(store.get(args[0], {}).get(args[1]))
+        if name == 'HGETALL':
+            return _array([item for pair in store.get(args[0], {}).items() for item in pair])
+        if name == 'HLEN':
+            return _int(len(store.get(args[0], {})))
+        if name == 'HINCRBY':
+            fields = store.data.setdefault(args[0], {})
+            fields[args[1]] = b'%d' % (int(fields.get(args[1], b'0')) + int(args[2]))
+            return _int(int(fields[args[1]]))
+        if name == 'LPUSH':
+            items = store.data.setdefault(args[0], [])
+            for value in args[1:]:
+                items.insert(0, value)
+            return _int(len(items))
+        if name == 'LTRIM':
+            items = store.get(args[0], [])
+            end = int(args[2])
+            store.data[args[0]] = items[int(args[1]):end + 1 if end != -1 else None]
+            return b'+OK\r\n'
+        if name == 'LRANGE':
+            end = int(args[2])
+            return _array(store.get(args[0], [])[int(args[1]):end + 1 if end != -1 else None])
+        if name == 'LLEN':
+            return _int(len(store.get(args[0], [])))
+        return b'-ERR unknown command %s\r\n' % name.encode()
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """ In-process RESP2 server on a free local port """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.store = _Store()
+        self.drop_replies = 0
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-redis', daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return f'redis://127.0.0.1:{self.server_address[1]}/0'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RedisCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeRedisServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.cache = RedisCache(self.server.url, prefix='test:', stale_grace=60)
+        self.cache.clear()
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_set_and_get(self):
+        show_info = {'id': 'tt0111161', 'title': 'The Shawshank Redemption', 'review-items': [{'cat': 'Mild'}]}
+        self.cache.set('imdb:tt0111161', show_info)
+        self.assertEqual(self.cache.get('imdb:tt0111161'), show_info)
+        # keys are case insensitive like the sqlite backend
+        self.assertEqual(self.cache.get('IMDB:TT0111161'), show_info)
+        self.assertIsNone(self.cache.get('imdb:tt0000000'))
+        self.assertEqual(self.cache.get_cached_records_count(), 1)
+
+    def test_get_many_and_set_many(self):
+        self.assertEqual(self.cache.set_many({'a': 1, 'b': [2]}, timeout=60), 2)
+        self.assertEqual(self.cache.get_many(['A', 'b', 'missing']), {'a': 1, 'b': [2]})
+        self.cache.delete_many(['a', 'b'])
+        self.assertEqual(self.cache.get_many(['a', 'b']), {})
+
+    def test_set_many_keeps_per_item_timeouts(self):
+        self.cache.set_many([('short', 1, 0.05), ('long', 2, 60), ('default', 3)], timeout=30)
+        self.assertLess(self.cache.get_exp('short'), time.time() + 1)
+        self.assertGreater(self.cache.get_exp('long'), time.time() + 50)
+        self.assertLess(self.cache.get_exp('default'), time.time() + 31)
+        time.sleep(0.1)
+        self.assertEqual(self.cache.get_many(['short', 'long', 'default']), {'long': 2, 'default': 3})
+
+    def test_expiry_and_stale(self):
+        self.cache.set('short', 'value', timeout=0.05)
+        self.assertGreater(self.cache.get_exp('short'), time.time())
+        time.sleep(0.1)
+        self.assertIsNone(self.cache.get('short'))
+        # still inside the grace window
+        self.assertEqual(self.cache.get_with_stale('short'), ('value', True))
+        self.assertEqual(self.cache.get_with_stale('missing'), (None, False))
+
+    def test_expired_past_grace_is_dropped_by_the_server(self):
+        cache = RedisCache(self.server.url, prefix='test:', stale_grace=0)
+        try:
+            cache.set('gone', 'value', timeout=0.05)
+            time.sleep(0.1)
+            self.assertEqual(cache.get_with_stale('gone'), (None, False))
+            self.assertIsNone(cache.get_exp('gone'))
+        finally:
+            cache.close()
+
+    def test_batched_stale_and_negative_reads(self):
+        self.cache.set('live', 'fresh', timeout=60)
+        self.cache.set('old', 'stale', timeout=0.05)
+        self.cache.set_negative('miss', 60)
+        time.sleep(0.1)
+        self.assertEqual(self.cache.get_many_with_stale(['LIVE', 'old', 'miss']),
+                         {'live': ('fresh', False), 'old': ('stale', True)})
+        self.assertEqual(self.cache.are_negative(['live', 'MISS', 'unknown']), {'miss'})
+        self.assertEqual(self.cache.are_negative([]), set())
+
+    def test_delete(self):
+        self.cache.set('key', 'value')
+        self.cache.delete('key')
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_negative(self):
+        self.assertFalse(self.cache.is_negative('dove:tt1'))
+        self.cache.set_negative('dove:tt1', 60)
+        self.assertTrue(self.cache.is_negative('dove:tt1'))
+        self.cache.delete_negative('dove:tt1')
+        self.assertFalse(self.cache.is_negative('dove:tt1'))
+        self.cache.set_negative('dove:tt2', 0.05)
+        time.sleep(0.1)
+        self.assertFalse(self.cache.is_negative('dove:tt2'))
+
+    def test_alias(self):
+        self.cache.set_alias('title:the matrix:1999', 'imdb:TT0133093')
+        self.assertEqual(self.cache.resolve_alias('title:the matrix:1999'), 'imdb:tt0133093')
+        self.cache.set_alias('title:the matrix:1999', 'imdb:tt9999999', replace=False)
+        self.assertEqual(self.cache.resolve_alias('title:the matrix:1999'), 'imdb:tt0133093')
+        self.assertIsNone(self.cache.resolve_alias('title:unknown:'))
+
+    def test_stats(self):
+        self.cache.incr_stats({'total_hits': 2, 'cached_hits': 1})
+        self.cache.incr_stats({'total_hits': 1})
+        self.cache.set_stat('last_seen', '2024-01-01')
+        self.assertEqual(self.cache.get_stat('total_hits'), 3)
+        self.assertEqual(self.cache.get_stat('last_seen'), '2024-01-01')
+        self.assertEqual(self.cache.get_all_stats()['cached_hits'], 1)
+        self.assertEqual(self.cache.get_stats_count(), 3)
+        self.cache.clear_stats()
+        self.assertIsNone(self.cache.get_stat('total_hits'))
+
+    def test_logs(self):
+        self.cache.add_logs([('2024-01-01T10:00:00', 'INFO', 'first'),
+                             ('2024-01-01T11:00:00', 'ERROR', 'second failed')])
+        self.cache.add_log('INFO', 'third')
+        logs = self.cache.get_logs()
+        self.assertEqual([row[3] for row in logs], ['third', 'second failed', 'first'])
+        self.assertEqual([row[0] for row in logs], [3, 2, 1])
+        self.assertEqual(self.cache.get_logs_count(), 3)
+        self.assertEqual([row[3] for row in self.cache.get_logs(level='error')], ['second failed'])
+        self.assertEqual([row[3] for row in self.cache.get_logs(search='failed')], ['second failed'])
+        self.assertEqual([row[3] for row in self.cache.get_logs(before=(logs[1][1], logs[1][0]))], ['first'])
+        self.cache.clear_logs()
+        self.assertEqual(self.cache.get_logs(), [])
+
+    def test_omdb_cache(self):
+        self.cache.set_omdb_cache('omdb:id:tt0133093', {'Title': 'The Matrix'})
+        self.assertEqual(self.cache.get_omdb_cache('omdb:id:tt0133093'), {'Title': 'The Matrix'})
+
+    def test_clear_only_touches_the_prefix(self):
+        other = RedisCache(self.server.url, prefix='other:')
+        try:
+            other.set('key', 'kept')
+            self.cache.set('key', 'dropped')
+            self.cache.clear()
+            self.assertIsNone(self.cache.get('key'))
+            self.assertEqual(other.get('key'), 'kept')
+        finally:
+            other.clear()
+            other.close()
+
+    def test_server_errors_are_raised(self):
+        with self.assertRaises(RedisError):
+            self.cache._execute('NOSUCHCOMMAND')
+
+    def test_reconnects_after_a_dropped_connection(self):
+        self.cache.set('key', 'value')
+        self.cache._conn()._sock.close()
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.assertEqual(len(self.cache._connections), 1)
+
+    def test_reads_are_retried_when_the_reply_is_lost(self):
+        self.cache.set('key', 'value')
+        self.server.drop_replies = 1
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.assertEqual(len(self.cache._connections), 1)
+
+    def test_writes_are_not_retried_when_the_reply_is_lost(self):
+        self.server.drop_replies = 1
+        with self.assertRaises(OSError):
+            self.cache.incr_stats({'total_hits': 1})
+        # counted once, not once per attempt
+        self.assertEqual(self.cache.get_stat('total_hits'), 1)
+        self.assertEqual(len(self.cache._connections), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
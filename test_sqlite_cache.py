@@ -0,0 +1,309 @@
+"""
+    SqliteCache against throwaway files: the migrations from older file
+    layouts, the negative cache, batched reads, eviction, snapshot import
+    and the /get_all fan-out on top of it.
+
+    Run with: python -m pytest test_sqlite_cache.py (or python -m unittest)
+"""
+
+import base64
+import gzip
+import json
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from argparse import Namespace
+from datetime import datetime, timedelta
+
+import provider_registry
+import snapshot
+from bloom import BloomFilter
+from cache_keys import KeyResolver
+from fanout import fan_out, CACHED, FRESH, NOT_FOUND, TIMEOUT, ERROR
+from providers import store_result
+from SQLiteCache import SqliteCache
+
+
+class _TempCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.sqlite')
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def open(self, **options):
+        cache = SqliteCache(self.path, **options)
+        self.caches.append(cache)
+        return cache
+
+
+class LegacyMigrationTest(_TempCache):
+
+    def write_legacy_file(self, rows, stats=()):
+        """ A file as the pickled-expiry versions left it """
+
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE entries (key TEXT PRIMARY KEY, val BLOB, exp BLOB)')
+        conn.executemany('INSERT INTO entries VALUES (?, ?, ?)',
+                         [(key, pickle.dumps(value), pickle.dumps(exp)) for key, value, exp in rows])
+        conn.execute('CREATE TABLE stats (key TEXT PRIMARY KEY, value TEXT)')
+        conn.executemany('INSERT INTO stats VALUES (?, ?)', [(key, json.dumps(value)) for key, value in stats])
+        conn.commit()
+        conn.close()
+
+    def test_entries_are_moved_and_keys_lowercased(self):
+        self.write_legacy_file([('Dove:TT0111161', {'title': 'Shawshank'}, time.time() + 60),
+                                ('imdb:tt0133093', {'title': 'The Matrix'}, time.time() + 60),
+                                ('imdb:tt0000001', {'title': 'Expired'}, time.time() - 60)])
+        cache = self.open(stale_grace=0)
+        # looked up before the background migration got to it
+        self.assertEqual(cache.get('dove:tt0111161'), {'title': 'Shawshank'})
+        cache.migrate_legacy_entries()
+        keys = [row[0] for row in cache._get_conn().execute('SELECT key FROM entries ORDER BY key')]
+        self.assertEqual(keys, ['dove:tt0111161', 'imdb:tt0000001', 'imdb:tt0133093'])
+        self.assertEqual(cache.get('IMDB:TT0133093'), {'title': 'The Matrix'})
+        self.assertIsNone(cache.get('imdb:tt0000001'))
+        self.assertIsNone(cache._get_conn().execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'entries_legacy'").fetchone())
+
+    def test_grouped_stats_set_the_rollup_marks(self):
+        yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+        self.write_legacy_file([], stats=[('hits_by_day', {yesterday: 5}), ('countries', {'NL': 2})])
+        cache = self.open()
+        marks = dict(cache._get_conn().execute('SELECT granularity, rolled_until FROM stats_rollups'))
+        self.assertEqual(sorted(marks), ['day', 'hour', 'month'])
+        self.assertEqual(cache.get_stats_series('hits', 'day'), {(yesterday, 'total'): 5})
+        # the migrated days are not rolled into the month a second time
+        cache.rollup_stats()
+        month = yesterday[:7]
+        if month != datetime.now().strftime('%Y-%m'):
+            self.assertEqual(cache.get_stats_series('hits', 'month', month, month + '~'), {(month, 'total'): 5})
+
+
+class RollupTest(_TempCache):
+
+    def test_new_file_has_no_rollup_marks(self):
+        cache = self.open()
+        self.assertEqual(cache._get_conn().execute('SELECT COUNT(*) FROM stats_rollups').fetchone()[0], 0)
+
+    def test_minutes_roll_up_into_hours_and_days(self):
+        cache = self.open()
+        two_days_ago = datetime.now() - timedelta(days=2)
+        minute = two_days_ago.strftime('%Y-%m-%d %H:%M')
+        cache.add_stats_series({(minute, 'hits', 'total'): 3})
+        cache.add_stats_series({(minute[:-1] + ('1' if minute[-1] != '1' else '2'), 'hits', 'total'): 4})
+        cache.rollup_stats()
+        self.assertEqual(cache.get_stats_series('hits', 'hour', minute[:13], minute[:13] + '~'),
+                         {(minute[:13], 'total'): 7})
+        self.assertEqual(cache.get_stats_series('hits', 'day', minute[:10], minute[:10] + '~'),
+                         {(minute[:10], 'total'): 7})
+
+
+class NegativeCacheTest(_TempCache):
+
+    def negative_ttl_of(self, cache, key):
+        row = cache._get_conn().execute('SELECT exp FROM negative_cache WHERE key = ?', (key,)).fetchone()
+        return round(row[0] - time.time())
+
+    def test_set_and_check(self):
+        cache = self.open()
+        cache.set_negative('Dove:TT1', 60)
+        cache.set_negative('dove:tt2', 0.05)
+        self.assertTrue(cache.is_negative('dove:tt1'))
+        time.sleep(0.1)
+        self.assertFalse(cache.is_negative('dove:tt2'))
+        self.assertEqual(cache.are_negative(['DOVE:TT1', 'dove:tt2', 'dove:tt3']), {'dove:tt1'})
+        cache.delete_negative('dove:tt1')
+        self.assertFalse(cache.is_negative('dove:tt1'))
+
+    def test_failed_scrapes_are_remembered_briefly(self):
+        cache = self.open()
+        dove = provider_registry.get('dove')
+        self.assertFalse(store_result(cache, 'dove:tt1', 'dove', {'status': 'Failed', 'review-items': None}))
+        self.assertFalse(store_result(cache, 'dove:tt2', 'dove', {'status': 'Success', 'review-items': []}))
+        self.assertEqual(self.negative_ttl_of(cache, 'dove:tt1'), round(dove.failure_ttl))
+        self.assertEqual(self.negative_ttl_of(cache, 'dove:tt2'), round(dove.negative_ttl))
+        self.assertLess(dove.failure_ttl, dove.negative_ttl)
+
+    def test_storing_a_result_clears_the_miss(self):
+        cache = self.open()
+        cache.set_negative('dove:tt1', 60)
+        self.assertTrue(store_result(cache, 'dove:tt1', 'dove', {'status': 'Success', 'review-items': [{'cat': 'Mild'}]}))
+        self.assertFalse(cache.is_negative('dove:tt1'))
+        self.assertEqual(cache.get('dove:tt1')['review-items'], [{'cat': 'Mild'}])
+
+    def test_bloom_filter_counts_distinct_keys(self):
+        bloom = BloomFilter(capacity=10)
+        for _ in range(50):
+            bloom.add('dove:tt1')
+        self.assertEqual(bloom.count, 1)
+        self.assertFalse(bloom.is_saturated())
+
+    def test_full_filter_is_regrown_by_the_sweeper(self):
+        os.environ['NEGATIVE_CACHE_CAPACITY'] = '10'
+        try:
+            cache = self.open()
+        finally:
+            del os.environ['NEGATIVE_CACHE_CAPACITY']
+        for i in range(30):
+            cache.set_negative(f'dove:tt{i}', 60)
+        self.assertEqual(cache._negative_filter.capacity, 10)
+        cache.start_sweeper(0.05)
+        deadline = time.time() + 5
+        while cache._negative_filter.capacity == 10 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertGreater(cache._negative_filter.capacity, 10)
+        self.assertTrue(all(cache.is_negative(f'dove:tt{i}') for i in range(30)))
+
+
+class BatchReadTest(_TempCache):
+
+    def test_get_many_with_stale(self):
+        cache = self.open(stale_grace=60)
+        cache.set('live', 'fresh', timeout=60)
+        cache.set('old', 'stale', timeout=0.05)
+        time.sleep(0.1)
+        self.assertEqual(cache.get_many_with_stale(['LIVE', 'old', 'missing']),
+                         {'live': ('fresh', False), 'old': ('stale', True)})
+        # get_many leaves the stale row in place for the next stale read
+        self.assertEqual(cache.get_many(['live', 'old']), {'live': 'fresh'})
+        self.assertEqual(cache.get_with_stale('old'), ('stale', True))
+
+    def test_set_many_keeps_per_item_timeouts(self):
+        cache = self.open(stale_grace=0)
+        cache.set_many([('short', 1, 0.05), ('long', 2, 60), ('default', 3)], timeout=30)
+        self.assertAlmostEqual(cache.get_exp('default'), time.time() + 30, delta=2)
+        time.sleep(0.1)
+        self.assertEqual(cache.get_many(['short', 'long', 'default']), {'long': 2, 'default': 3})
+
+
+class EvictionTest(_TempCache):
+
+    def test_lru_drops_the_least_recently_read(self):
+        cache = self.open(max_entries=10, eviction_policy='lru', l1_max_bytes=0)
+        for i in range(10):
+            cache.set(f'key{i}', i)
+        time.sleep(0.01)
+        for i in range(5):
+            cache.get(f'key{i}')
+        time.sleep(0.01)
+        for i in range(10, 13):
+            cache.set(f'key{i}', i)
+        # 13 rows, evicted down to 9: four of the five never read
+        cache.evict()
+        kept = set(cache.get_many(f'key{i}' for i in range(13)))
+        self.assertEqual(len(kept), 9)
+        self.assertTrue({f'key{i}' for i in (0, 1, 2, 3, 4, 10, 11, 12)} <= kept)
+
+    def test_lfu_keeps_the_most_read(self):
+        cache = self.open(max_entries=10, eviction_policy='lfu', l1_max_bytes=0)
+        for i in range(15):
+            cache.set(f'key{i}', i)
+        for _ in range(3):
+            for i in range(12, 15):
+                cache.get(f'key{i}')
+        cache.evict()
+        kept = set(cache.get_many(f'key{i}' for i in range(15)))
+        self.assertLessEqual(len(kept), 9)
+        self.assertTrue({'key12', 'key13', 'key14'} <= kept)
+
+
+class SnapshotImportTest(_TempCache):
+
+    def write_snapshot(self, records):
+        path = os.path.join(self.dir, 'snapshot.ndjson.gz')
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            f.write(json.dumps({'format': snapshot.SNAPSHOT_FORMAT, 'version': snapshot.SNAPSHOT_VERSION}) + '\n')
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        return path
+
+    def args(self, **options):
+        defaults = {'include_expired': False, 'min_ttl': 0, 'no_omdb': False, 'provider': None, 'trust_blobs': False}
+        defaults.update(options)
+        return Namespace(**defaults)
+
+    def test_pickled_blobs_need_trust(self):
+        exp = time.time() + 60
+        blob = base64.b64encode(b'\x80' + pickle.dumps({'title': 'pickled'})[1:]).decode('ascii')
+        path = self.write_snapshot([{'table': 'entries', 'key': 'dove:tt1', 'exp': exp, 'value': {'title': 'json'}},
+                                    {'table': 'entries', 'key': 'dove:tt2', 'exp': exp, 'blob': blob}])
+        cache = self.open()
+        counts = snapshot.import_snapshot(cache, path, self.args())
+        self.assertEqual((counts['entries']['written'], counts['entries']['rejected']), (1, 1))
+        self.assertEqual(cache.get('dove:tt1'), {'title': 'json'})
+        self.assertIsNone(cache.get('dove:tt2'))
+
+        counts = snapshot.import_snapshot(cache, path, self.args(trust_blobs=True))
+        self.assertEqual(counts['entries']['rejected'], 0)
+        self.assertEqual(cache.get('dove:tt2'), {'title': 'pickled'})
+
+
+class FanOutTest(_TempCache):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.release = threading.Event()
+
+        def slow(imdb_id, video_name, release_year):
+            cls.release.wait(5)
+            return {'id': imdb_id, 'title': video_name, 'review-items': [{'cat': 'Late'}]}
+
+        def broken(imdb_id, video_name, release_year):
+            raise ValueError('site changed its markup')
+
+        def empty(imdb_id, video_name, release_year):
+            return {'id': imdb_id, 'title': video_name, 'status': 'Failed', 'review-items': None}
+
+        def quick(imdb_id, video_name, release_year):
+            return {'id': imdb_id, 'title': video_name, 'review-items': [{'cat': 'Mild'}]}
+
+        provider_registry.register('testslow', slow, timeout=0.1)
+        provider_registry.register('testbroken', broken)
+        provider_registry.register('testempty', empty)
+        provider_registry.register('testquick', quick)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.release.set()
+
+    def test_statuses_and_late_results(self):
+        cache = self.open()
+        cache.set('testquick:tt1', {'review-items': [{'cat': 'Cached'}]})
+        answers = {provider: (status, error) for provider, status, _, error in fan_out(
+            cache, KeyResolver(cache), ['testquick', 'testslow', 'testbroken', 'testempty'], 'tt1', 'Title', None)}
+        self.assertEqual(answers['testquick'], (CACHED, None))
+        self.assertEqual(answers['testslow'][0], TIMEOUT)
+        self.assertEqual(answers['testbroken'], (ERROR, 'site changed its markup'))
+        self.assertEqual(answers['testempty'], (NOT_FOUND, None))
+        self.assertTrue(cache.is_negative('testempty:tt1'))
+
+        # the scrape that overran its budget is still cached when it finishes
+        self.release.set()
+        deadline = time.time() + 5
+        while cache.get('testslow:tt1') is None and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(cache.get('testslow:tt1')['review-items'], [{'cat': 'Late'}])
+
+    def test_fresh_results_are_stored(self):
+        cache = self.open()
+        answers = list(fan_out(cache, KeyResolver(cache), ['testquick'], 'tt2', 'Title', None))
+        self.assertEqual([(provider, status) for provider, status, _, _ in answers], [('testquick', FRESH)])
+        deadline = time.time() + 5
+        while cache.get('testquick:tt2') is None and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(cache.get('testquick:tt2')['review-items'], [{'cat': 'Mild'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
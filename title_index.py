@@ -0,0 +1,252 @@
+#!/usr/bin/python
+"""
+Offline title -> IMDb ID index built from IMDb's public dataset dumps.
+
+Usage: python title_index.py import title.basics.tsv.gz [--ratings title.ratings.tsv.gz] [options]
+       python title_index.py lookup TITLE [YEAR]
+
+The import streams the dump in chunks into a separate SQLite file
+(TITLE_INDEX_PATH, default title_index.sqlite) keyed by normalized title
+and start year, so memory use stays flat for the full ~10M line file.
+It builds a fresh file next to the old one and swaps it in when done, so
+a running app keeps answering from the previous index meanwhile.
+
+get_data asks this index before OMDb when a request has only a title. A
+lookup is one indexed query on a local file. A year narrows the
+candidates to that year (or one off). Titles shared by several releases
+resolve to the one with the most votes when ratings were imported, then
+by title type (movie, then series, then TV movie, see TYPE_RANK). Only a
+tie on both is ambiguous; that and unknown titles fall back to OMDb.
+"""
+
+import argparse
+import gzip
+import io
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+
+from cache_keys import normalize_title
+from metrics import TITLE_INDEX_LOOKUPS
+
+# title types worth resolving, episodes alone are over half of the dump
+DEFAULT_TITLE_TYPES = ('movie', 'tvMovie', 'tvSeries', 'tvMiniSeries', 'tvSpecial', 'short', 'video')
+# preferred when votes can't tell two releases apart
+TYPE_RANK = {'movie': 0, 'tvSeries': 1, 'tvMiniSeries': 1, 'tvMovie': 2}
+CHUNK_SIZE = 10000
+
+
+def default_index_path():
+    return os.environ.get('TITLE_INDEX_PATH', 'title_index.sqlite')
+
+
+def _open_dump(path):
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, 'rb'), encoding='utf-8', newline='\n')
+    return open(path, encoding='utf-8', newline='\n')
+
+
+def _read_tsv(path):
+    """ Yield a dict per row of an IMDb TSV dump, \\N becomes None """
+
+    with _open_dump(path) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        for line in f:
+            values = line.rstrip('\n').split('\t')
+            yield {name: (None if value == '\\N' else value) for name, value in zip(header, values)}
+
+
+def _chunks(rows, size=CHUNK_SIZE):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _title_rows(path, title_types, include_adult):
+    """ (normalized title, year, tconst, type) for the primary and original title of every kept row """
+
+    for row in _read_tsv(path):
+        if row.get('titleType') not in title_types:
+            continue
+        if row.get('isAdult') == '1' and not include_adult:
+            continue
+        year = int(row['startYear']) if (row.get('startYear') or '').isdigit() else None
+        seen = set()
+        for name in (row.get('primaryTitle'), row.get('originalTitle')):
+            title = normalize_title(name)
+            if title and title not in seen:
+                seen.add(title)
+                yield title, year, row['tconst'], row['titleType']
+
+
+def build_index(basics_path, index_path=None, ratings_path=None, title_types=DEFAULT_TITLE_TYPES,
+                include_adult=False):
+    """ Import a title.basics dump (and optionally title.ratings) into a new index file
+
+        Returns the number of title rows written.
+    """
+
+    index_path = index_path or default_index_path()
+    tmp_path = index_path + '.importing'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        # a throwaway file until the swap, durability only costs time here
+        conn.execute('PRAGMA journal_mode=OFF')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute('''CREATE TABLE titles
+                        (title TEXT NOT NULL, year INTEGER, tconst TEXT NOT NULL, type TEXT,
+                         votes INTEGER NOT NULL DEFAULT 0)''')
+        conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        rows = 0
+        for chunk in _chunks(_title_rows(basics_path, set(title_types), include_adult)):
+            with conn:
+                conn.executemany('INSERT INTO titles (title, year, tconst, type) VALUES (?, ?, ?, ?)', chunk)
+            rows += len(chunk)
+
+        if ratings_path:
+            conn.execute('CREATE TABLE ratings (tconst TEXT PRIMARY KEY, votes INTEGER) WITHOUT ROWID')
+            for chunk in _chunks((row['tconst'], int(row['numVotes'] or 0)) for row in _read_tsv(ratings_path)):
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO ratings (tconst, votes) VALUES (?, ?)', chunk)
+            with conn:
+                conn.execute('UPDATE titles SET votes = ratings.votes FROM ratings WHERE ratings.tconst = titles.tconst')
+                conn.execute('DROP TABLE ratings')
+
+        # built after the load, one sort instead of ten million index updates
+        conn.execute('CREATE INDEX titles_title_index ON titles (title, year)')
+        with conn:
+            conn.executemany('INSERT INTO meta (key, value) VALUES (?, ?)', [
+                ('source', os.path.basename(basics_path)),
+                ('ratings', os.path.basename(ratings_path) if ratings_path else ''),
+                ('imported_at', datetime.now().isoformat(timespec='seconds')),
+                ('rows', str(rows)),
+            ])
+        conn.execute('ANALYZE')
+    finally:
+        conn.close()
+    os.replace(tmp_path, index_path)
+    return rows
+
+
+class TitleIndex:
+    """ Read-only lookups in an index file, a missing file just never matches """
+
+    def __init__(self, path=None):
+        self.path = path or default_index_path()
+        self._local = threading.local()
+        self._checked_at = 0
+        self._available = False
+
+    def available(self):
+        # the file may be imported while the app runs, look for it again once a minute
+        if not self._available and time.time() - self._checked_at > 60:
+            self._checked_at = time.time()
+            self._available = os.path.exists(self.path)
+        return self._available
+
+    def _get_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        inode = os.stat(self.path).st_ino
+        # reopen after an import swapped the file
+        if conn is None or self._local.inode != inode:
+            if conn is not None:
+                conn.close()
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+            self._local.conn = conn
+            self._local.inode = inode
+        return conn
+
+    def candidates(self, video_name, release_year=None):
+        """ (tconst, year, type, votes) rows for a title, best match first """
+
+        title = normalize_title(video_name)
+        if not title or not self.available():
+            return []
+        try:
+            rows = self._get_conn().execute(
+                'SELECT tconst, year, type, votes FROM titles WHERE title = ?', (title,)).fetchall()
+        except (OSError, sqlite3.Error):
+            self._available = False
+            return []
+        year = int(release_year) if str(release_year or '').isdigit() else None
+        if year is not None:
+            # IMDb and the caller often disagree by a year around release dates
+            rows = [row for row in rows if row[1] == year] or [row for row in rows if row[1] in (year - 1, year + 1)]
+        return sorted(rows, key=lambda row: (-row[3], TYPE_RANK.get(row[2], 3), -(row[1] or 0)))
+
+    def lookup(self, video_name, release_year=None):
+        """ The IMDb ID and year of a title, (None, None) when unknown or ambiguous """
+
+        rows = self.candidates(video_name, release_year)
+        if not rows:
+            TITLE_INDEX_LOOKUPS.inc('miss')
+            return None, None
+        if len(rows) > 1 and rows[0][3] == rows[1][3] and TYPE_RANK.get(rows[0][2], 3) == TYPE_RANK.get(rows[1][2], 3):
+            TITLE_INDEX_LOOKUPS.inc('ambiguous')
+            return None, None
+        TITLE_INDEX_LOOKUPS.inc('hit')
+        tconst, year, _, _ = rows[0]
+        return tconst, str(year) if year else None
+
+    def info(self):
+        if not self.available():
+            return None
+        try:
+            return dict(self._get_conn().execute('SELECT key, value FROM meta').fetchall())
+        except (OSError, sqlite3.Error):
+            self._available = False
+            return None
+
+
+_shared_index = None
+_shared_lock = threading.Lock()
+
+
+def get_index():
+    global _shared_index
+    with _shared_lock:
+        if _shared_index is None:
+            _shared_index = TitleIndex()
+        return _shared_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query the offline title -> IMDb ID index.')
+    parser.add_argument('command', choices=['import', 'lookup'])
+    parser.add_argument('args', nargs='+', help='import: title.basics.tsv(.gz) / lookup: TITLE [YEAR]')
+    parser.add_argument('--db', default=default_index_path(), help='index file (default: TITLE_INDEX_PATH)')
+    parser.add_argument('--ratings', help='title.ratings.tsv(.gz), ranks titles shared by several releases')
+    parser.add_argument('--types', default=','.join(DEFAULT_TITLE_TYPES),
+                        help='comma separated title types to keep (default: everything but episodes)')
+    parser.add_argument('--include-adult', action='store_true', help='keep adult titles')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        started = time.perf_counter()
+        try:
+            rows = build_index(args.args[0], args.db, args.ratings, args.types.split(','), args.include_adult)
+        except (OSError, ValueError, KeyError) as e:
+            print(f'[!] {e}')
+            sys.exit(1)
+        print(f' * Indexed {rows} titles in {time.perf_counter() - started:.1f}s '
+              f'({os.path.getsize(args.db)} bytes, Database: {args.db})')
+    else:
+        index = TitleIndex(args.db)
+        name, year = args.args[0], args.args[1] if len(args.args) > 1 else None
+        for tconst, row_year, title_type, votes in index.candidates(name, year):
+            print(f'   {tconst:12}{row_year or "-":>6}  {title_type:14}{votes:>9} votes')
+        print(f' * {name}: {index.lookup(name, year)[0] or "not resolved"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+"""
+Pre-populate the cache before a release.
+
+Usage: python warmup.py TITLES_FILE [options]
+
+TITLES_FILE has one title per line, either an IMDb ID or a title with an
+optional year ("The Matrix, 1999" or "The Matrix<TAB>1999"). Blank lines
+and lines starting with # are skipped.
+
+Every title is scraped from every selected provider, with at most
+--concurrency scrapes per provider running at once (never more than the
+provider's registered cap, PROVIDER_<NAME>_CONCURRENCY), and the results are
+written through the normal cache path (stored when they have review items,
+remembered as a miss otherwise). Titles that are already cached or known
+misses are skipped unless --force is given.
+
+Finished (provider, title) pairs are appended to a state file as they
+complete, so an interrupted run picks up where it stopped when started
+again with the same file. Use --restart to ignore the state file.
+"""
+
+import argparse
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from cache_backends import get_cache
+from cache_keys import KeyResolver, canonical_provider, cache_key, is_imdb_id, normalize_title
+from omdb import OmdbClient
+from title_index import get_index as get_title_index
+from providers import PROVIDERS, fetch_from_provider, get_provider, store_result
+
+logger = logging.getLogger('warmup')
+
+# outcomes of a single (provider, title) job
+STORED, MISSED, FAILED, SKIPPED = 'stored', 'missed', 'failed', 'skipped'
+
+
+def parse_titles(path):
+    """ Yield (imdb_id, video_name, release_year) for every line of the titles file """
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if is_imdb_id(line):
+                yield line.lower(), None, None
+                continue
+            match = re.match(r'^(.*?)\s*[,\t]\s*(\d{4})$', line)
+            if match:
+                yield None, match.group(1), match.group(2)
+            else:
+                yield None, line, None
+
+
+def job_id(provider, imdb_id, video_name, release_year):
+    """ Stable identifier of a job, used in the state file """
+
+    return f"{provider}\t{imdb_id or normalize_title(video_name)}\t{release_year or ''}"
+
+
+class WarmupState:
+    """ Append-only record of finished jobs, one job id per line """
+
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.done = set()
+        if restart and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.done = {line.rstrip('\n') for line in f if line.strip()}
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def mark_done(self, job):
+        with self._lock:
+            self._file.write(job + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class Warmer:
+    """ Runs the scrapes of a warm-up with a bounded thread pool per provider """
+
+    def __init__(self, db, providers, concurrency, force=False, state=None, omdb_client=None):
+        self.db = db
+        self.key_resolver = KeyResolver(db)
+        self.omdb = omdb_client or OmdbClient(db)
+        self.title_index = get_title_index()
+        self.providers = providers
+        self.force = force
+        self.state = state
+        # at most the provider's registered cap: jobs beyond it would only queue in the
+        # provider's own pool, where the wait counts against its timeout
+        self._pools = {}
+        for provider in providers:
+            cap = get_provider(provider).concurrency
+            self._pools[provider] = ThreadPoolExecutor(max_workers=min(concurrency, cap) if concurrency else cap,
+                                                       thread_name_prefix=f'warmup-{provider}')
+        self._lock = threading.Lock()
+        self.outcomes = defaultdict(lambda: defaultdict(int))
+        self.scrape_time = defaultdict(float)
+        self.completed = 0
+
+    def run(self, titles, progress_every=50):
+        futures = []
+        resumed = 0
+        for imdb_id, video_name, release_year in titles:
+            for provider in self.providers:
+                job = job_id(provider, imdb_id, video_name, release_year)
+                if self.state is not None and job in self.state.done:
+                    resumed += 1
+                    continue
+                futures.append(self._pools[provider].submit(
+                    self._warm, job, provider, imdb_id, video_name, release_year))
+        if resumed:
+            print(f' * Resuming, {resumed} jobs already done in a previous run')
+        print(f' * Warming {len(futures)} jobs across {len(self.providers)} providers')
+
+        for future in futures:
+            future.result()
+            with self._lock:
+                self.completed += 1
+                completed = self.completed
+            if completed % progress_every == 0:
+                print(f'   {completed}/{len(futures)} done')
+        for pool in self._pools.values():
+            pool.shutdown()
+        return len(futures)
+
+    def cancel(self):
+        """ Drop queued jobs, scrapes already running still finish """
+
+        for pool in self._pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _warm(self, job, provider, imdb_id, video_name, release_year):
+        try:
+            outcome = self._warm_one(provider, imdb_id, video_name, release_year)
+        except Exception as e:
+            logger.error(f"Warm-up of {imdb_id or video_name} from {provider} failed: {e}")
+            outcome = FAILED
+        with self._lock:
+            self.outcomes[provider][outcome] += 1
+        # failures are retried on the next run
+        if self.state is not None and outcome != FAILED:
+            self.state.mark_done(job)
+
+    def _warm_one(self, provider, imdb_id, video_name, release_year):
+        # same resolution as get_data: a known title alias first, then the offline title index, then OMDb
+        if not imdb_id and video_name:
+            imdb_id = self.key_resolver.resolve_imdb_id(video_name, release_year)
+            if not imdb_id:
+                imdb_id, index_year = self.title_index.lookup(video_name, release_year)
+                release_year = release_year or index_year
+            if not imdb_id:
+                omdb_data = self.omdb.by_title(video_name, release_year)
+                if omdb_data and is_imdb_id(omdb_data.get('imdbID')):
+                    imdb_id = omdb_data['imdbID'].lower()
+                    self.key_resolver.remember_title(video_name, release_year, imdb_id)
+                    release_year = release_year or omdb_data.get('Year')
+
+        key = cache_key(provider, imdb_id, video_name)
+        if not self.force and (self.db.get(key) is not None or self.db.is_negative(key)):
+            return SKIPPED
+
+        # scrapers search by name, ID-only lines need the title
+        if not video_name:
+            video_name = self.omdb.title_for_id(imdb_id)
+
+        started = time.perf_counter()
+        try:
+            result = fetch_from_provider(provider, imdb_id, video_name, release_year)
+        finally:
+            with self._lock:
+                self.scrape_time[provider] += time.perf_counter() - started
+
+        # title-only lines are stored under the IMDb ID the provider found, like get_data does
+        if isinstance(result, dict) and not imdb_id and is_imdb_id(result.get('id')):
+            self.key_resolver.remember_title(video_name, release_year, result['id'])
+            key = cache_key(provider, result['id'])
+        return STORED if store_result(self.db, key, provider, result) else MISSED
+
+    def report(self, elapsed):
+        total = sum(sum(counts.values()) for counts in self.outcomes.values())
+        scraped = sum(counts[STORED] + counts[MISSED] + counts[FAILED] for counts in self.outcomes.values())
+        print(f' * {total} jobs in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.2f} jobs/s, '
+              f'{scraped / elapsed if elapsed else 0:.2f} scrapes/s)')
+        print(f"   {'provider':16}{'stored':>8}{'missed':>8}{'failed':>8}{'skipped':>9}{'success':>9}{'avg s':>8}")
+        for provider in self.providers:
+            counts = self.outcomes[provider]
+            attempted = counts[STORED] + counts[MISSED] + counts[FAILED]
+            success = f'{counts[STORED] / attempted:.0%}' if attempted else '-'
+            avg = f'{self.scrape_time[provider] / attempted:.2f}' if attempted else '-'
+            print(f'   {provider:16}{counts[STORED]:8}{counts[MISSED]:8}{counts[FAILED]:8}{counts[SKIPPED]:9}'
+                  f'{success:>9}{avg:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-populate the parental guide cache.')
+    parser.add_argument('titles', help='file with one IMDb ID or "title, year" per line')
+    parser.add_argument('-p', '--providers', default=','.join(PROVIDERS),
+                        help='comma separated providers to warm (default: all)')
+    parser.add_argument('-c', '--concurrency', type=int, default=int(os.environ.get('WARMUP_CONCURRENCY', 0)),
+                        help='concurrent scrapes per provider, capped by the provider\'s registered '
+                             'concurrency (default: that cap)')
+    parser.add_argument('--state', help='resume file (default: TITLES_FILE.state)')
+    parser.add_argument('--restart', action='store_true', help='ignore the resume file and start over')
+    parser.add_argument('--force', action='store_true', help='re-scrape titles that are already cached')
+    args = parser.parse_args()
+
+    providers = []
+    for name in args.providers.split(','):
+        provider = canonical_provider(name)
+        if provider is None:
+            parser.error(f'unknown provider: {name}')
+        if provider not in providers:
+            providers.append(provider)
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    db = get_cache()
+    state = WarmupState(args.state or args.titles + '.state', restart=args.restart)
+    warmer = Warmer(db, providers, max(0, args.concurrency), force=args.force, state=state)
+    started = time.perf_counter()
+    try:
+        warmer.run(list(parse_titles(args.titles)))
+    except KeyboardInterrupt:
+        warmer.cancel()
+        print(' * Interrupted, run again with the same arguments to resume')
+        sys.exit(1)
+    finally:
+        state.close()
+        warmer.report(time.perf_counter() - started)
+        db.close()
+
+
+if __name__ == '__main__':
+    main()